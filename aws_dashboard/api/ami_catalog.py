@@ -0,0 +1,160 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local catalog of public AMIs.
+
+Wildcard name filters on describe_images scan every public AMI of the
+region, which takes seconds and returns megabytes. The catalog runs those
+filters in a background thread on a schedule, keeps only the fields the
+tables use and answers lookups from an in-memory index.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from aws_dashboard.api import client_pool
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_FILTERS = [
+    {
+        "Name": "name",
+        "Values": [
+            "RHEL-7*",
+            "suse-sles-12-*",
+            "ubuntu/images/hvm-ssd/ubuntu-xenial-16.04-amd64-server-*",
+            "amzn-ami-hvm-*",
+            "Windows_Server-2016*",
+        ]
+    },
+]
+AMI_CATALOG_FILTERS = getattr(settings, "AMI_CATALOG_FILTERS", DEFAULT_FILTERS)
+AMI_CATALOG_REFRESH_INTERVAL = getattr(settings, "AMI_CATALOG_REFRESH_INTERVAL", 6 * 60 * 60)
+
+# Fields of describe_images kept in the catalog.
+CATALOG_FIELDS = ("ImageId", "Name", "Description", "OwnerId", "ImageOwnerAlias",
+                  "ImageType", "State", "StateReason", "ImageLocation", "Public",
+                  "CreationDate", "Architecture", "Platform", "Hypervisor",
+                  "VirtualizationType", "RootDeviceType", "RootDeviceName",
+                  "EnaSupport", "SriovNetSupport")
+
+
+def _slim(image):
+    return dict((k, image[k]) for k in CATALOG_FIELDS if k in image)
+
+
+class ImageIndex(object):
+    """Immutable index of catalog images sorted by lower-cased name."""
+
+    def __init__(self, images):
+        self.images = sorted((_slim(i) for i in images),
+                             key=lambda i: i.get("Name", "").lower())
+        self._names = [i.get("Name", "").lower() for i in self.images]
+        self.refreshed_at = time.time()
+
+    def __len__(self):
+        return len(self.images)
+
+    def _prefix_range(self, prefix):
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self._names, prefix)
+        end = bisect.bisect_left(self._names, prefix + u"\uffff", start)
+        return start, end
+
+    def search(self, prefix=None, name=None, owner=None, architecture=None):
+        """Find images by name prefix, name substring, owner and architecture.
+
+        ``owner`` matches either the owner id or the owner alias.
+        """
+        start, end = self._prefix_range(prefix) if prefix else (0, len(self.images))
+        name = name.lower() if name else None
+        result = []
+        for i in range(start, end):
+            image = self.images[i]
+            if name and name not in self._names[i]:
+                continue
+            if owner and owner not in (image.get("OwnerId"), image.get("ImageOwnerAlias")):
+                continue
+            if architecture and image.get("Architecture") != architecture:
+                continue
+            result.append(image)
+        return result
+
+
+class AmiCatalog(object):
+    """Per project and region image indexes refreshed in the background."""
+
+    def __init__(self, filters=AMI_CATALOG_FILTERS,
+                 refresh_interval=AMI_CATALOG_REFRESH_INTERVAL):
+        self.filters = filters
+        self.refresh_interval = refresh_interval
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _describe(self, project_id, region_name):
+        client = client_pool.get_client(project_id, "ec2", region_name)
+        response = client.describe_images(Filters=self.filters)
+        return ImageIndex(response.get("Images", []))
+
+    def refresh(self, project_id, region_name=None):
+        key = (project_id, region_name)
+        start_time = time.time()
+        index = self._describe(project_id, region_name)
+        with self._lock:
+            self._indexes[key] = index
+        LOG.debug("Refresh AMI catalog : %s (%s) %d images in %.1f sec"
+                  % (project_id, region_name, len(index), time.time() - start_time))
+        return index
+
+    def get_index(self, project_id, region_name=None):
+        """Get the index, loading it on first use."""
+        index = self._indexes.get((project_id, region_name))
+        if index is None:
+            index = self.refresh(project_id, region_name)
+            self._start()
+        return index
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="ami-catalog")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(min(self.refresh_interval, 60))
+            for key, index in list(self._indexes.items()):
+                if time.time() - index.refreshed_at < self.refresh_interval:
+                    continue
+                try:
+                    self.refresh(*key)
+                except Exception as e:
+                    # Keep serving the previous index until the next attempt.
+                    LOG.error("AMI catalog refresh failed : {} ({})".format(key, e))
+
+
+CATALOG = AmiCatalog()
+
+
+def search(project_id, region_name=None, **filters):
+    """Search the catalog images of the project region.
+
+    See ImageIndex.search for the filters.
+    """
+    return CATALOG.get_index(project_id, region_name).search(**filters)
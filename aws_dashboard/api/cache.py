@@ -0,0 +1,224 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shared inventory cache for AWS describe_* results.
+
+Results are stored compressed in the Django cache backend so that every
+Horizon worker shares them, with a small in-process LRU in front of it.
+Each (project, resource) pair has a generation counter in the shared cache;
+mutations bump it, which invalidates the cached entries of every worker.
+"""
+import collections
+import functools
+import hashlib
+import logging
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import caches
+from six.moves import cPickle as pickle
+
+from aws_dashboard.api.hybrid.utils import get_api_keys
+
+LOG = logging.getLogger(__name__)
+
+INSTANCES = "instances"
+IMAGES = "images"
+SECURITY_GROUPS = "security_groups"
+KEYPAIRS = "keypairs"
+REGIONS = "regions"
+AVAILABILITY_ZONES = "availability_zones"
+OVERVIEW = "overview"
+
+DEFAULT_TTL = {
+    INSTANCES: 10,
+    IMAGES: 300,
+    SECURITY_GROUPS: 60,
+    KEYPAIRS: 60,
+    REGIONS: 3600,
+    AVAILABILITY_ZONES: 3600,
+    OVERVIEW: 60,
+}
+AWS_CACHE_BACKEND = getattr(settings, "AWS_CACHE_BACKEND", "default")
+AWS_CACHE_TTL = dict(DEFAULT_TTL, **getattr(settings, "AWS_CACHE_TTL", {}))
+AWS_CACHE_LOCAL_MAX_BYTES = getattr(settings, "AWS_CACHE_LOCAL_MAX_BYTES", 32 * 1024 * 1024)
+AWS_CACHE_LOCK_TIMEOUT = getattr(settings, "AWS_CACHE_LOCK_TIMEOUT", 10)
+
+
+class LocalCache(object):
+    """Thread-safe LRU of serialized values bounded by total size."""
+
+    def __init__(self, max_bytes=AWS_CACHE_LOCAL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expire_at, blob = entry
+            if expire_at < time.time():
+                self._size -= len(blob)
+                return None
+            self._entries[key] = entry
+            return blob
+
+    def set(self, key, blob, ttl):
+        if len(blob) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1])
+            self._entries[key] = (time.time() + ttl, blob)
+            self._size += len(blob)
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+LOCAL_CACHE = LocalCache()
+
+
+def _shared_cache():
+    return caches[AWS_CACHE_BACKEND]
+
+
+def _dumps(value):
+    return zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL), 1)
+
+
+def _loads(blob):
+    return pickle.loads(zlib.decompress(blob))
+
+
+def _generation_key(project_id, resource):
+    return "aws_dashboard:gen:%s:%s" % (project_id, resource)
+
+
+def _get_generation(project_id, resource):
+    key = _generation_key(project_id, resource)
+    cache = _shared_cache()
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, 1, None)
+        generation = cache.get(key, 1)
+    return generation
+
+
+def invalidate(project_id, *resources):
+    """Invalidate cached results of the resources in every worker."""
+    cache = _shared_cache()
+    for resource in resources:
+        key = _generation_key(project_id, resource)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time()), None)
+        LOG.debug("Invalidate AWS cache : %s (%s)" % (resource, project_id))
+
+
+def _make_key(project_id, resource, name, args, kwargs):
+    region_name = get_api_keys(project_id)[2]
+    call = repr((name, args, sorted(kwargs.items())))
+    digest = hashlib.md5(call.encode("utf-8")).hexdigest()
+    generation = _get_generation(project_id, resource)
+    return "aws_dashboard:%s:%s:%s:%s:%s" % (resource, project_id, region_name,
+                                             generation, digest)
+
+
+def _wait_for(key):
+    deadline = time.time() + AWS_CACHE_LOCK_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.1)
+        blob = _shared_cache().get(key)
+        if blob is not None:
+            return blob
+    return None
+
+
+def get_or_call(project_id, resource, name, func, *args, **kwargs):
+    """Get the cached result of ``func(*args, **kwargs)`` for the project.
+
+    ``name``, ``args`` and ``kwargs`` make the cache key, so ``func`` may
+    close over objects which have no stable repr, such as a request.
+    """
+    ttl = AWS_CACHE_TTL.get(resource, 0)
+    if not ttl:
+        return func(*args, **kwargs)
+    key = _make_key(project_id, resource, name, args, kwargs)
+
+    blob = LOCAL_CACHE.get(key)
+    if blob is None:
+        blob = _shared_cache().get(key)
+        if blob is not None:
+            LOCAL_CACHE.set(key, blob, ttl)
+    if blob is not None:
+        return _loads(blob)
+
+    # Only one worker refreshes a missing entry, the others wait for it.
+    lock_key = key + ":lock"
+    if not _shared_cache().add(lock_key, 1, AWS_CACHE_LOCK_TIMEOUT):
+        blob = _wait_for(key)
+        if blob is not None:
+            LOCAL_CACHE.set(key, blob, ttl)
+            return _loads(blob)
+    try:
+        value = func(*args, **kwargs)
+        blob = _dumps(value)
+        _shared_cache().set(key, blob, ttl)
+        LOCAL_CACHE.set(key, blob, ttl)
+    finally:
+        _shared_cache().delete(lock_key)
+    return value
+
+
+def cached(resource):
+    """Cache the result of a describe call for the resource TTL.
+
+    The decorated function is called as ``func(request, *args, **kwargs)``;
+    the uncached function stays reachable as ``func.uncached``.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(request, *args, **kwargs):
+            def call(*args, **kwargs):
+                return func(request, *args, **kwargs)
+            return get_or_call(request.user.tenant_id, resource, func.__name__,
+                               call, *args, **kwargs)
+        wrapped.uncached = func
+        return wrapped
+    return decorator
+
+
+def invalidates(*resources):
+    """Invalidate the cached resources once the decorated mutation ran."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(request, *args, **kwargs):
+            try:
+                return func(request, *args, **kwargs)
+            finally:
+                invalidate(request.user.tenant_id, *resources)
+        return wrapped
+    return decorator
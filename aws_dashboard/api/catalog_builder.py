@@ -0,0 +1,330 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Build per-region flavor catalogs from AWS bulk files.
+
+Sources are the EC2 price list offer file (``AmazonEC2/.../index.json``)
+and the saved output of ``aws ec2 describe-instance-types``, one or more
+pages. Both are read incrementally: only the members under the paths of
+interest are decoded, one at a time, everything else is skipped without
+being built, so a multi-GB offer file runs in constant memory.
+
+The emitted catalog has the layout of ``instanceType.json`` plus an
+``OnDemandPrice`` (USD per hour) and is what flavor_catalog loads.
+"""
+import json
+import logging
+import os
+import re
+
+LOG = logging.getLogger(__name__)
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+# Next character skip_value has to look at, outside or inside a string
+STRUCTURE = re.compile(r'["{}\[\]]')
+STRING_END = re.compile(r'["\\]')
+# Characters a number split at the end of a chunk may go on with
+NUMBER_TAIL = re.compile(r"[0-9.eE+-]*\Z")
+
+# Offer files before 2019 only carry the location name of a product.
+LOCATIONS = {
+    "US East (N. Virginia)": "us-east-1",
+    "US East (Ohio)": "us-east-2",
+    "US West (N. California)": "us-west-1",
+    "US West (Oregon)": "us-west-2",
+    "Canada (Central)": "ca-central-1",
+    "EU (Ireland)": "eu-west-1",
+    "EU (Frankfurt)": "eu-central-1",
+    "EU (London)": "eu-west-2",
+    "Asia Pacific (Singapore)": "ap-southeast-1",
+    "Asia Pacific (Sydney)": "ap-southeast-2",
+    "Asia Pacific (Seoul)": "ap-northeast-2",
+    "Asia Pacific (Tokyo)": "ap-northeast-1",
+    "Asia Pacific (Mumbai)": "ap-south-1",
+    "South America (Sao Paulo)": "sa-east-1",
+}
+# Keys of an instanceType.json entry, "-" when a source does not know them.
+CATALOG_KEYS = ("InstanceType", "vCPU", "Memory", "Storage", "PhysicalProcessor",
+                "ClockSpeed", "EBS_OPT", "EnhancedNetworking", "IntelAVX2",
+                "IntelAVX", "IntelTurbo", "NetworkingPerformance", "OnDemandPrice")
+
+
+class JsonStream(object):
+    """Incremental reader over a JSON text file."""
+
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        data = self.fp.read(self.chunk_size)
+        if not data:
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character, or "" at the end."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected %r at offset %d" % (char, self.pos))
+        self.pos += 1
+
+    def read_value(self):
+        """Decode the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number is complete only once something else follows it:
+            # "12." or "1e" at the end of the buffer go on in the next chunk.
+            if (isinstance(value, (int, float)) and not isinstance(value, bool) and
+                    NUMBER_TAIL.match(self.buf, end) and self._fill()):
+                continue
+            self.pos = end
+            return value
+
+    def skip_value(self):
+        """Skip the next value without decoding it.
+
+        Only quotes, escapes and brackets are looked at, each found with a
+        regex search over the buffered chunk.
+        """
+        depth = 0
+        in_string = False
+        char = self.peek()
+        if char not in "{[\"":
+            self.read_value()
+            return
+        while True:
+            match = (STRING_END if in_string else STRUCTURE).search(self.buf, self.pos)
+            if match is None:
+                self.pos = len(self.buf)
+                if not self._fill():
+                    raise ValueError("Unexpected end of JSON")
+                continue
+            char = match.group()
+            self.pos = match.end()
+            if char == "\\":
+                # The escaped character may start the next chunk.
+                if self.pos >= len(self.buf) and not self._fill():
+                    raise ValueError("Unexpected end of JSON")
+                self.pos += 1
+            elif char == '"':
+                in_string = not in_string
+                if not in_string and depth == 0:
+                    return
+            elif char in "{[":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def iter_container(self):
+        """Iterate the keys of an object or the indexes of an array.
+
+        The caller reads or skips each member value before the next step.
+        """
+        opening = self.peek()
+        if opening not in "{[":
+            raise ValueError("Expected an object or an array at offset %d" % self.pos)
+        closing = "}" if opening == "{" else "]"
+        self.pos += 1
+        index = 0
+        while True:
+            char = self.peek()
+            if char == closing:
+                self.pos += 1
+                return
+            if index:
+                self.expect(",")
+            if opening == "{":
+                key = self.read_value()
+                self.expect(":")
+            else:
+                key = index
+            yield key
+            index += 1
+
+
+def walk(stream, handlers, path=(), on_enter=None):
+    """Call ``handlers[path](key, value)`` for each member under a path.
+
+    ``on_enter(path)`` is called when a handler path is reached, even
+    without members. Values outside of the handler paths are skipped
+    without decoding.
+    """
+    for key in stream.iter_container():
+        sub_path = path + (key,)
+        if sub_path in handlers:
+            if on_enter is not None:
+                on_enter(sub_path)
+            for member in stream.iter_container():
+                handlers[sub_path](member, stream.read_value())
+        elif any(p[:len(sub_path)] == sub_path for p in handlers):
+            walk(stream, handlers, sub_path, on_enter)
+        else:
+            stream.skip_value()
+
+
+def walk_documents(stream, handlers, on_enter=None):
+    """Walk every top level document, e.g. concatenated CLI output pages."""
+    while stream.peek():
+        walk(stream, handlers, on_enter=on_enter)
+
+
+def _is_default_compute_product(product):
+    attributes = product.get("attributes", {})
+    return (product.get("productFamily") == "Compute Instance" and
+            attributes.get("tenancy") == "Shared" and
+            attributes.get("operatingSystem") == "Linux" and
+            attributes.get("preInstalledSw", "NA") == "NA" and
+            attributes.get("licenseModel", "No License required") == "No License required" and
+            attributes.get("capacitystatus", "Used") == "Used")
+
+
+def _yes_no(value):
+    return "Yes" if value in ("Yes", True) else "-"
+
+
+def _strip_unit(value, unit):
+    return value.replace(unit, "").strip() if value else "-"
+
+
+def _from_offer_attributes(attributes):
+    return {
+        "InstanceType": attributes.get("instanceType"),
+        "vCPU": attributes.get("vcpu", "-"),
+        "Memory": _strip_unit(attributes.get("memory"), "GiB"),
+        "Storage": attributes.get("storage", "-"),
+        "PhysicalProcessor": attributes.get("physicalProcessor", "-"),
+        "ClockSpeed": _strip_unit(attributes.get("clockSpeed"), "GHz"),
+        "EBS_OPT": _yes_no(attributes.get("ebsOptimized")),
+        "EnhancedNetworking": _yes_no(attributes.get("enhancedNetworkingSupported")),
+        "IntelAVX2": _yes_no(attributes.get("intelAvx2Available")),
+        "IntelAVX": _yes_no(attributes.get("intelAvxAvailable")),
+        "IntelTurbo": _yes_no(attributes.get("intelTurboAvailable")),
+        "NetworkingPerformance": attributes.get("networkPerformance", "-"),
+    }
+
+
+def _from_instance_type_info(info):
+    storage = info.get("InstanceStorageInfo")
+    if storage:
+        storage = " + ".join("%d x %d %s" % (d.get("Count", 1), d.get("SizeInGB", 0),
+                                             d.get("Type", "").upper())
+                             for d in storage.get("Disks", []))
+    clock_speed = info.get("ProcessorInfo", {}).get("SustainedClockSpeedInGhz")
+    return {
+        "InstanceType": info["InstanceType"],
+        "vCPU": str(info.get("VCpuInfo", {}).get("DefaultVCpus", "-")),
+        "Memory": "%g" % (info.get("MemoryInfo", {}).get("SizeInMiB", 0) / 1024.0),
+        "Storage": storage or "EBS Only",
+        "ClockSpeed": "%g" % clock_speed if clock_speed else "-",
+        "EBS_OPT": _yes_no(info.get("EbsInfo", {}).get("EbsOptimizedSupport")
+                           in ("default", "supported")),
+        "EnhancedNetworking": _yes_no(info.get("NetworkInfo", {}).get("EnaSupport")
+                                      in ("required", "supported")),
+        "NetworkingPerformance": info.get("NetworkInfo", {}).get("NetworkPerformance", "-"),
+    }
+
+
+class CatalogBuilder(object):
+    """Collect instance type specs and on-demand prices per region."""
+
+    def __init__(self):
+        self.catalogs = {}
+        self._skus = {}
+
+    def _entry(self, region_name, instance_type):
+        catalog = self.catalogs.setdefault(region_name, {})
+        if instance_type not in catalog:
+            catalog[instance_type] = dict.fromkeys(CATALOG_KEYS, "-")
+            catalog[instance_type]["InstanceType"] = instance_type
+        return catalog[instance_type]
+
+    def read_offer_file(self, fp, region_name=None):
+        """Read an EC2 price list offer file.
+
+        The region of a product is its regionCode or location, or
+        ``region_name`` for regional files of unknown locations. Prices are
+        joined to the products read before them, so "products" has to come
+        before "terms", as in the files AWS publishes; a file in the other
+        order is rejected rather than read without prices.
+        """
+        entered = set()
+
+        def on_product(sku, product):
+            if not _is_default_compute_product(product):
+                return
+            attributes = product["attributes"]
+            region = (attributes.get("regionCode") or
+                      LOCATIONS.get(attributes.get("location")) or region_name)
+            if region is None:
+                return
+            spec = _from_offer_attributes(attributes)
+            self._entry(region, spec["InstanceType"]).update(spec)
+            self._skus[sku] = (region, spec["InstanceType"])
+
+        def on_demand_term(sku, terms):
+            if ("products",) not in entered:
+                raise ValueError("Offer file lists terms before products")
+            target = self._skus.get(sku)
+            if target is None:
+                return
+            for term in terms.values():
+                for dimension in term.get("priceDimensions", {}).values():
+                    price = dimension.get("pricePerUnit", {}).get("USD")
+                    if price is not None and dimension.get("unit") == "Hrs":
+                        self._entry(*target)["OnDemandPrice"] = price
+
+        walk_documents(JsonStream(fp), {
+            ("products",): on_product,
+            ("terms", "OnDemand"): on_demand_term,
+        }, on_enter=entered.add)
+
+    def read_instance_types(self, fp, region_name):
+        """Read saved describe_instance_types output pages of a region."""
+        def on_instance_type(index, info):
+            spec = _from_instance_type_info(info)
+            self._entry(region_name, spec["InstanceType"]).update(spec)
+
+        walk_documents(JsonStream(fp), {("InstanceTypes",): on_instance_type})
+
+    def write(self, output_dir):
+        """Write one compact <region>.json catalog per region."""
+        paths = []
+        for region_name, catalog in sorted(self.catalogs.items()):
+            file_path = os.path.join(output_dir, "%s.json" % region_name)
+            with open(file_path, "w") as f:
+                json.dump(catalog, f, separators=(",", ":"), sort_keys=True)
+            LOG.debug("Write flavor catalog : %s (%d types)" % (file_path, len(catalog)))
+            paths.append(file_path)
+        return paths
@@ -0,0 +1,139 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Process-wide pool of boto3 clients.
+
+Building a boto3 client loads the service model, resolves endpoints and
+opens new connections, so clients are shared by every request of the
+process instead of being rebuilt per request. boto3 clients are thread
+safe; sessions and resources are not, so only clients are pooled.
+"""
+import collections
+import hashlib
+import logging
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from aws_dashboard.api.hybrid.utils import get_api_keys
+
+LOG = logging.getLogger(__name__)
+AWS_CLIENT_POOL_SIZE = getattr(settings, "AWS_CLIENT_POOL_SIZE", 64)
+AWS_MAX_POOL_CONNECTIONS = getattr(settings, "AWS_MAX_POOL_CONNECTIONS", 10)
+AWS_CLIENT_KEEPALIVE = getattr(settings, "AWS_CLIENT_KEEPALIVE", 300)
+
+
+def credentials_fingerprint(aws_access_key_id, aws_secret_access_key):
+    """Short digest identifying a key pair without keeping the secret."""
+    digest = hashlib.sha256()
+    digest.update(("%s:%s" % (aws_access_key_id, aws_secret_access_key)).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class ClientPool(object):
+    """Thread-safe LRU pool of boto3 clients.
+
+    Entries are keyed by (project_id, region, service, credentials
+    fingerprint, timeout). A client idle for longer than ``keepalive`` seconds is
+    rebuilt on next use, since its pooled connections are likely closed.
+    """
+
+    def __init__(self, max_size=AWS_CLIENT_POOL_SIZE,
+                 max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+                 keepalive=AWS_CLIENT_KEEPALIVE):
+        self.max_size = max_size
+        self.max_pool_connections = max_pool_connections
+        self.keepalive = keepalive
+        self._clients = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, project_id, service, region_name=None, timeout=None):
+        aws_access_key_id, aws_secret_access_key, default_region = get_api_keys(project_id)
+        region_name = region_name or default_region
+        fingerprint = credentials_fingerprint(aws_access_key_id, aws_secret_access_key)
+        key = (project_id, region_name, service, fingerprint, timeout)
+        now = time.time()
+
+        with self._lock:
+            entry = self._clients.pop(key, None)
+            if entry is not None and now - entry[1] <= self.keepalive:
+                self._clients[key] = (entry[0], now)
+                return entry[0]
+
+            client = self._create_client(service, aws_access_key_id,
+                                         aws_secret_access_key, region_name, timeout)
+            self._clients[key] = (client, now)
+            while len(self._clients) > self.max_size:
+                evicted, _ = self._clients.popitem(last=False)
+                LOG.debug("Evict AWS client : %s/%s/%s" % evicted[:3])
+            return client
+
+    def _create_client(self, service, aws_access_key_id, aws_secret_access_key, region_name,
+                       timeout=None):
+        LOG.debug("Create AWS client : %s (%s)" % (service, region_name))
+        session = boto3.session.Session(aws_access_key_id=aws_access_key_id,
+                                        aws_secret_access_key=aws_secret_access_key,
+                                        region_name=region_name)
+        kwargs = {}
+        if timeout is not None:
+            # No retry, a retried call would outlive the timeout.
+            kwargs = {"connect_timeout": timeout, "read_timeout": timeout,
+                      "retries": {"max_attempts": 0}}
+        config = Config(max_pool_connections=self.max_pool_connections, **kwargs)
+        return session.client(service, config=config)
+
+    def invalidate(self, project_id=None):
+        """Drop pooled clients of a project, or of every project."""
+        with self._lock:
+            for key in list(self._clients.keys()):
+                if project_id is None or key[0] == project_id:
+                    del self._clients[key]
+
+    def purge_rotated(self):
+        """Drop clients whose credentials no longer match AWS_API_KEY_DICT."""
+        keys_dict = getattr(settings, "AWS_API_KEY_DICT", {})
+        with self._lock:
+            for key in list(self._clients.keys()):
+                key_set = keys_dict.get(key[0]) or {}
+                fingerprint = credentials_fingerprint(key_set.get("AWS_ACCESS_KEY_ID"),
+                                                      key_set.get("AWS_SECRET_ACCESS_KEY"))
+                if fingerprint != key[3]:
+                    LOG.debug("Drop AWS client with rotated key : %s/%s/%s" % key[:3])
+                    del self._clients[key]
+
+    def __len__(self):
+        return len(self._clients)
+
+
+POOL = ClientPool()
+
+
+def get_client(project_id, service, region_name=None, timeout=None):
+    """Get a pooled boto3 client of the project.
+
+    :param timeout: connect and read timeout in seconds, and no retries;
+                    botocore defaults otherwise
+    """
+    return POOL.get(project_id, service, region_name, timeout)
+
+
+def _on_setting_changed(sender, setting, **kwargs):
+    if setting == "AWS_API_KEY_DICT":
+        POOL.purge_rotated()
+
+
+setting_changed.connect(_on_setting_changed)
@@ -0,0 +1,279 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Raw disk images to and from EBS snapshots.
+
+The EBS direct APIs take a snapshot block by block (StartSnapshot,
+PutSnapshotBlock, CompleteSnapshot), so an image can become an AMI with
+register_image without being staged in S3 nor waiting on import_image.
+Only the data extents of the raw file are read (SEEK_DATA/SEEK_HOLE), and
+blocks holding only zeros are not sent: a block never written reads as
+zeros from the snapshot.
+
+The other way, ListSnapshotBlocks gives the blocks of a snapshot holding
+data and GetSnapshotBlock fetches them into a sparse raw file, so an
+export transfers the used blocks only, not the whole disk.
+"""
+from concurrent import futures
+import base64
+import errno
+import hashlib
+import logging
+import os
+import uuid
+
+from django.conf import settings
+
+from aws_dashboard.api import client_pool
+from aws_dashboard.api import multipart
+
+LOG = logging.getLogger(__name__)
+# Concurrent PutSnapshotBlock/GetSnapshotBlock calls per snapshot
+AWS_EBS_CONCURRENCY = getattr(settings, "AWS_EBS_CONCURRENCY", 32)
+# Minutes without a block before EBS gives up on the snapshot
+AWS_EBS_SNAPSHOT_TIMEOUT = getattr(settings, "AWS_EBS_SNAPSHOT_TIMEOUT", 60)
+
+BLOCK_SIZE = 512 * 1024
+ZERO_BLOCK = b"\0" * BLOCK_SIZE
+GiB = 1024 * 1024 * 1024
+
+
+class EbsError(Exception):
+    pass
+
+
+def ebs_client(request):
+    return client_pool.get_client(request.user.tenant_id, "ebs")
+
+
+def volume_size_gb(size):
+    """Smallest volume size, in GiB, holding ``size`` bytes."""
+    return max(-(-size // GiB), 1)
+
+
+def data_extents(image_file, size):
+    """(start, end) ranges of the file holding data, holes left out.
+
+    Without SEEK_DATA support the whole file is one extent.
+    """
+    seek_data = getattr(os, "SEEK_DATA", None)
+    if seek_data is None:
+        yield 0, size
+        return
+    fd = image_file.fileno()
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, seek_data)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole up to the end of the file
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+        offset = end
+
+
+def iter_blocks(image_file, size):
+    """(index, data) of the non-zero blocks of the file, in order.
+
+    The last block is padded with zeros to BLOCK_SIZE.
+    """
+    last_index = -1
+    for start, end in data_extents(image_file, size):
+        for index in range(max(start // BLOCK_SIZE, last_index + 1), (end - 1) // BLOCK_SIZE + 1):
+            image_file.seek(index * BLOCK_SIZE)
+            data = image_file.read(BLOCK_SIZE)
+            last_index = index
+            if len(data) < BLOCK_SIZE:
+                data += b"\0" * (BLOCK_SIZE - len(data))
+            if data != ZERO_BLOCK:
+                yield index, data
+
+
+def _cancel(pending, budgets):
+    """Cancel the blocks not started yet, giving back their budget.
+
+    Blocks already running give it back themselves.
+    """
+    for future in pending:
+        if future.cancel():
+            multipart.BUDGET.release(budgets[future])
+
+
+class SnapshotWriter(object):
+    """Write the blocks of a raw image to a new EBS snapshot.
+
+    Blocks are sent by a pool of ``max_concurrency`` threads, each taking
+    its size from multipart.BUDGET while it is in flight.
+    """
+
+    def __init__(self, client, description, max_concurrency=AWS_EBS_CONCURRENCY,
+                 timeout=AWS_EBS_SNAPSHOT_TIMEOUT):
+        self.client = client
+        self.description = description
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.snapshot_id = None
+        self.blocks_sent = 0
+
+    def _put_block(self, index, data, budget):
+        try:
+            self.client.put_snapshot_block(
+                SnapshotId=self.snapshot_id, BlockIndex=index, BlockData=data,
+                DataLength=len(data),
+                Checksum=base64.b64encode(hashlib.sha256(data).digest()).decode("ascii"),
+                ChecksumAlgorithm="SHA256")
+        finally:
+            multipart.BUDGET.release(budget)
+
+    def write(self, file_path):
+        """Write the image and complete the snapshot.
+
+        :returns: dict of the snapshot_id, volume_size (GiB), blocks sent
+                  and blocks of the volume
+        """
+        size = os.path.getsize(file_path)
+        volume_size = volume_size_gb(size)
+        response = self.client.start_snapshot(VolumeSize=volume_size,
+                                              Description=self.description,
+                                              ClientToken=str(uuid.uuid4()),
+                                              Timeout=self.timeout)
+        self.snapshot_id = response["SnapshotId"]
+        if response.get("BlockSize", BLOCK_SIZE) != BLOCK_SIZE:
+            raise EbsError("Unexpected EBS block size %s" % response["BlockSize"])
+        LOG.debug("Start EBS Snapshot : %s (%s, %d GB)" % (self.snapshot_id, file_path, volume_size))
+
+        executor = futures.ThreadPoolExecutor(self.max_concurrency)
+        pending = set()
+        budgets = {}
+        try:
+            with open(file_path, "rb") as image_file:
+                for index, data in iter_blocks(image_file, size):
+                    budget = multipart.BUDGET.acquire(len(data))
+                    future = executor.submit(self._put_block, index, data, budget)
+                    budgets[future] = budget
+                    pending.add(future)
+                    self.blocks_sent += 1
+                    if len(pending) >= self.max_concurrency * 4:
+                        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                        for future in done:
+                            del budgets[future]
+                            future.result()
+            for future in pending:
+                future.result()
+        except Exception:
+            _cancel(pending, budgets)
+            raise
+        finally:
+            executor.shutdown()
+
+        self.client.complete_snapshot(SnapshotId=self.snapshot_id,
+                                      ChangedBlocksCount=self.blocks_sent)
+        volume_blocks = volume_size * GiB // BLOCK_SIZE
+        LOG.debug("Complete EBS Snapshot : %s (%d of %d blocks sent)"
+                  % (self.snapshot_id, self.blocks_sent, volume_blocks))
+        return {"snapshot_id": self.snapshot_id, "volume_size": volume_size,
+                "blocks_sent": self.blocks_sent, "volume_blocks": volume_blocks}
+
+
+class SnapshotReader(object):
+    """Read the blocks of an EBS snapshot into a sparse raw image.
+
+    Blocks are listed a page at a time, since their tokens expire, and
+    fetched by a pool of ``max_concurrency`` threads, each taking its size
+    from multipart.BUDGET while it is in flight.
+    """
+
+    def __init__(self, client, snapshot_id, max_concurrency=AWS_EBS_CONCURRENCY):
+        self.client = client
+        self.snapshot_id = snapshot_id
+        self.max_concurrency = max_concurrency
+        self.volume_size = None
+        self.blocks_read = 0
+
+    def _list_blocks(self):
+        """(index, token) of the blocks of the snapshot holding data."""
+        kwargs = {"SnapshotId": self.snapshot_id}
+        while True:
+            response = self.client.list_snapshot_blocks(**kwargs)
+            if response.get("BlockSize", BLOCK_SIZE) != BLOCK_SIZE:
+                raise EbsError("Unexpected EBS block size %s" % response["BlockSize"])
+            self.volume_size = response["VolumeSize"]
+            for block in response.get("Blocks", []):
+                yield block["BlockIndex"], block["BlockToken"]
+            if not response.get("NextToken"):
+                return
+            kwargs["NextToken"] = response["NextToken"]
+
+    def _get_block(self, file_path, index, token, budget):
+        try:
+            response = self.client.get_snapshot_block(SnapshotId=self.snapshot_id,
+                                                      BlockIndex=index, BlockToken=token)
+            data = response["BlockData"].read()
+            checksum = base64.b64encode(hashlib.sha256(data).digest()).decode("ascii")
+            if len(data) != response.get("DataLength", len(data)) or \
+                    checksum != response.get("Checksum", checksum):
+                raise EbsError("Block %d of %s does not match its checksum"
+                               % (index, self.snapshot_id))
+            # Zero blocks stay holes of the sparse file.
+            if data != ZERO_BLOCK:
+                with open(file_path, "r+b") as image_file:
+                    image_file.seek(index * BLOCK_SIZE)
+                    image_file.write(data)
+        finally:
+            multipart.BUDGET.release(budget)
+
+    def read(self, file_path):
+        """Write the snapshot to ``file_path`` as a sparse raw image.
+
+        :returns: dict of the volume_size (GiB), blocks read and blocks of
+                  the volume
+        """
+        open(file_path, "wb").close()
+        executor = futures.ThreadPoolExecutor(self.max_concurrency)
+        pending = set()
+        budgets = {}
+        try:
+            for index, token in self._list_blocks():
+                budget = multipart.BUDGET.acquire(BLOCK_SIZE)
+                future = executor.submit(self._get_block, file_path, index, token, budget)
+                budgets[future] = budget
+                pending.add(future)
+                self.blocks_read += 1
+                if len(pending) >= self.max_concurrency * 4:
+                    done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        del budgets[future]
+                        future.result()
+            for future in pending:
+                future.result()
+        except Exception:
+            _cancel(pending, budgets)
+            raise
+        finally:
+            executor.shutdown()
+
+        with open(file_path, "r+b") as image_file:
+            image_file.truncate(self.volume_size * GiB)
+        volume_blocks = self.volume_size * GiB // BLOCK_SIZE
+        LOG.debug("Read EBS Snapshot : %s (%d of %d blocks read)"
+                  % (self.snapshot_id, self.blocks_read, volume_blocks))
+        return {"volume_size": self.volume_size, "blocks_read": self.blocks_read,
+                "volume_blocks": volume_blocks}
+
+
+def read_snapshot(request, snapshot_id, file_path):
+    """Write an EBS snapshot of the project to a sparse raw image."""
+    return SnapshotReader(ebs_client(request), snapshot_id).read(file_path)
@@ -12,9 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import datetime
-import json
 import logging
-from os import path
 
 import boto3
 from botocore.exceptions import ClientError
@@ -24,10 +22,19 @@ from openstack_dashboard.api import base
 from openstack_dashboard.api import nova
 from openstack_dashboard.api import network
 
+from aws_dashboard.api import ami_catalog
+from aws_dashboard.api import cache
+from aws_dashboard.api import client_pool
+from aws_dashboard.api import flavor_catalog
+from aws_dashboard.api import regions
+from aws_dashboard.api.flavor_catalog import InstanceType  # noqa
 from aws_dashboard.api.hybrid.utils import get_api_keys
 from aws_dashboard.api.hybrid.utils import to_wrapping_list
 
 LOG = logging.getLogger(__name__)
+DESCRIBE_MAX_RESULTS = 1000
+# The maximum number of values in a single describe_* filter.
+FILTER_MAX_VALUES = 200
 
 logging.getLogger("boto3").setLevel(logging.CRITICAL)
 logging.getLogger("botocore").setLevel(logging.CRITICAL)
@@ -42,7 +49,7 @@ class Ec2Instance(base.APIDictWrapper):
               "ProductCodes", "VpcId", "KeyName", "SecurityGroups", "ClientToken",
               "SubnetId", "InstanceType", "NetworkInterfaces", "Placement",
               "Hypervisor", "BlockDeviceMappings", "RootDeviceName"
-              "StateTransitionReason", "ImageId", "Tags"]
+              "StateTransitionReason", "ImageId", "Tags", "region"]
 
     def __init__(self, apidict):
         apidict["id"] = apidict["InstanceId"]
@@ -55,6 +62,7 @@ class Ec2Instance(base.APIDictWrapper):
         if apidict.get("name") == "" or apidict.get("name") is None:
             apidict["name"] = apidict["InstanceId"]
         apidict["tenant_id"] = "aws_ec2"
+        apidict.setdefault("region", None)
         super(Ec2Instance, self).__init__(apidict)
 
 
@@ -63,7 +71,7 @@ class Image(base.APIDictWrapper):
               "VirtualizationType", "Hypervisor", "ImageOwnerAlias", "EnaSupport",
               "SriovNetSupport", "ImageId", "BlockDeviceMappings", "Architecture",
               "ImageLocation", "RootDeviceType", "OwnerId", "RootDeviceName",
-              "CreationDate", "ImageType", "Description"]
+              "CreationDate", "ImageType", "Description", "region"]
 
     def __init__(self, apidict):
         apidict["id"] = apidict["ImageId"]
@@ -78,31 +86,16 @@ class Image(base.APIDictWrapper):
         apidict["create_at"] = apidict["CreationDate"]
         apidict["platform"] = apidict.get("Platform")
         apidict["architecture"] = apidict.get("Architecture")
+        apidict.setdefault("region", None)
         super(Image, self).__init__(apidict)
 
 
-class InstanceType(base.APIDictWrapper):
-    _attrs = ["id", "InstanceType", "vCPU", "Memory", "Storage", "PhysicalProcessor",
-              "ClockSpeed", "EBS_OPT", "EnhancedNetworking",
-              "IntelAVX2", "IntelAVX", "IntelTurbo", "NetworkingPerformance"]
-
-    def __init__(self, apidict):
-        apidict["id"] = apidict["InstanceType"]
-        apidict["name"] = apidict["InstanceType"]
-        apidict["vcpus"] = apidict["vCPU"]
-        apidict["ram"] = apidict["Memory"]
-        apidict["storage"] = apidict["Storage"]
-        apidict["clock_speed"] = apidict["ClockSpeed"]
-        apidict["network_performance"] = apidict["NetworkingPerformance"]
-        super(InstanceType, self).__init__(apidict)
-
-
 class SecurityGroup(base.APIDictWrapper):
     _attrs = ["id", "name", "description", "ip_ranges",
               "security_group_rules", "ip_permissions_egress",
               "GroupName", "Description", "IpPermissions", "IpRanges",
               "IpPermissionsEgress", "Ipv6Ranges", "EnhancedNetworking",
-              "UserIdGroupPairs", "VpcId", "OwnerId", "GroupId", "Tags"]
+              "UserIdGroupPairs", "VpcId", "OwnerId", "GroupId", "Tags", "region"]
 
     def __init__(self, apidict):
         apidict["id"] = apidict["GroupId"]
@@ -111,6 +104,7 @@ class SecurityGroup(base.APIDictWrapper):
         apidict["ip_ranges"] = apidict.get("IpRanges")
         apidict["security_group_rules"] = apidict["IpPermissions"]
         apidict["ip_permissions_egress"] = apidict["IpPermissionsEgress"]
+        apidict.setdefault("region", None)
         super(SecurityGroup, self).__init__(apidict)
 
 
@@ -144,31 +138,48 @@ class AvailabilityZone(base.APIDictWrapper):
         super(AvailabilityZone, self).__init__(apidict)
 
 
-def _to_instances(reservations):
-    instances = []
+def _iter_instances(reservations):
     for reservation in reservations:
         for ec2_instance in reservation.get("Instances"):
-            instances.append(Ec2Instance(ec2_instance))
-    return instances
+            yield Ec2Instance(ec2_instance)
+
 
+def _to_instances(reservations):
+    return list(_iter_instances(reservations))
 
-def _to_instance_types(aws_instance_types):
-    instance_types = []
-    for k in aws_instance_types.keys():
-        instance_types.append(InstanceType(aws_instance_types.get(k)))
-    return instance_types
 
+def ec2_client(request, region_name=None):
+    return client_pool.get_client(request.user.tenant_id, "ec2", region_name)
 
-@memoized
-def ec2_client(request):
-    project_id = request.user.tenant_id
-    aws_access_key_id, aws_secret_access_key, region_name = get_api_keys(project_id)
-    session = boto3.session.Session(aws_access_key_id=aws_access_key_id,
-                                    aws_secret_access_key=aws_secret_access_key,
-                                    region_name=region_name)
-    return session.client("ec2")
+
+def get_region_name(request):
+    """Get the region configured for the project."""
+    return get_api_keys(request.user.tenant_id)[2]
 
 
+def all_regions(request, func, *args, **kwargs):
+    """Call a listing function in every region of the account in parallel.
+
+    ``func`` is called as ``func(request, *args, region_name=..., **kwargs)``
+    and each item of the merged result is tagged with its ``region``.
+    Returns a tuple of the items and a dict of error messages keyed by the
+    regions which failed or timed out.
+    """
+    region_names = [r.name for r in list_regions(request)]
+
+    def call(region_name):
+        return func(request, *args, region_name=region_name, **kwargs)
+
+    results, errors = regions.fan_out(call, region_names)
+    items = []
+    for region_name in region_names:
+        for item in results.get(region_name, []):
+            item._apidict["region"] = region_name
+            items.append(item)
+    return items, errors
+
+
+# boto3 resources are not thread safe, so they are not pooled.
 @memoized
 def ec2_resource(request):
     project_id = request.user.tenant_id
@@ -179,9 +190,39 @@ def ec2_resource(request):
     return session.resource("ec2")
 
 
-def list_instance(request):
-    reservations = ec2_client(request).describe_instances().get("Reservations")
-    return _to_instances(reservations)
+def iter_instances(request, page_size=None, region_name=None):
+    """Iterate over all instances, fetching one API page at a time."""
+    paginator = ec2_client(request, region_name).get_paginator("describe_instances")
+    pagination_config = {}
+    if page_size:
+        pagination_config["PageSize"] = _to_max_results(page_size)
+    for page in paginator.paginate(PaginationConfig=pagination_config):
+        for instance in _iter_instances(page.get("Reservations")):
+            yield instance
+
+
+@cache.cached(cache.INSTANCES)
+def list_instance(request, region_name=None):
+    return list(iter_instances(request, region_name=region_name))
+
+
+@cache.cached(cache.INSTANCES)
+def list_instance_page(request, next_token=None, page_size=None):
+    """Get one page of instances.
+
+    Returns a tuple of the instances and the token of the next page, which
+    is None on the last page.
+    """
+    kwargs = {"MaxResults": _to_max_results(page_size or DESCRIBE_MAX_RESULTS)}
+    if next_token:
+        kwargs["NextToken"] = next_token
+    response = ec2_client(request).describe_instances(**kwargs)
+    return _to_instances(response.get("Reservations")), response.get("NextToken")
+
+
+def _to_max_results(page_size):
+    # describe_instances accepts MaxResults between 5 and 1000.
+    return min(max(page_size, 5), 1000)
 
 
 def get_instance(request, instance_id):
@@ -191,13 +232,38 @@ def get_instance(request, instance_id):
     return _to_instances(reservations)[0]
 
 
+def _chunks(values, size=FILTER_MAX_VALUES):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def get_instances(request, instance_ids):
+    """Get several instances with one describe call per 200 ids.
+
+    Unknown ids are left out of the result instead of failing the call.
+    """
+    instances = []
+    for ids in _chunks(list(instance_ids)):
+        paginator = ec2_client(request).get_paginator("describe_instances")
+        for page in paginator.paginate(Filters=[{"Name": "instance-id", "Values": ids}]):
+            instances.extend(_iter_instances(page.get("Reservations")))
+    return instances
+
+
+@cache.invalidates(cache.INSTANCES)
 def delete_instance(request, instance_id):
     LOG.debug('Delete EC2 Instance : %s' % instance_id)
     return ec2_client(request).terminate_instances(InstanceIds=[instance_id])
 
 
+@cache.invalidates(cache.INSTANCES)
 def create_instance(request, name, image_id, flavor, key_name,
-                    security_groups, availability_zone, instance_count=1):
+                    security_groups, availability_zone, instance_count=1, client_token=None):
+    """Launch instances and return the id of the first one.
+
+    Calls with the same ``client_token`` launch the instances only once.
+    """
+    kwargs = {"ClientToken": client_token} if client_token else {}
     instance = ec2_resource(request).create_instances(
         ImageId=image_id,
         MinCount=instance_count,
@@ -218,31 +284,39 @@ def create_instance(request, name, image_id, flavor, key_name,
         ],
         Placement={
             "AvailabilityZone": availability_zone,
-        }
+        },
+        **kwargs
     )
     return instance[0].id
 
 
-def list_image(request, params=[]):
-    # TODO Need a more detailed implementation of list lookup
+def list_image(request, params=[], region_name=None):
+    """Get the list of images.
+
+    Without filters, public images come from the local AMI catalog and
+    only the project's own images are fetched live.
+    """
     if len(params):
-        filters = params
-    else:
-        filters = [
-            {
-                "Name": "name",
-                "Values": [
-                    "RHEL-7*",
-                    "suse-sles-12-*",
-                    "ubuntu/images/hvm-ssd/ubuntu-xenial-16.04-amd64-server-*",
-                    "amzn-ami-hvm-*",
-                    "Windows_Server-2016*",
-                    "import*",
-                    "export*",
-                ]
-            },
-        ]
-    response = ec2_client(request).describe_images(Filters=filters)
+        response = ec2_client(request, region_name).describe_images(Filters=params)
+        return to_wrapping_list(response, "Images", Image)
+    return (search_image(request, region_name=region_name) +
+            list_owned_image(request, region_name=region_name))
+
+
+def search_image(request, region_name=None, **filters):
+    """Search public images in the local AMI catalog.
+
+    :param filters: prefix, name, owner and architecture, see
+                    ami_catalog.ImageIndex.search
+    """
+    images = ami_catalog.search(request.user.tenant_id, region_name, **filters)
+    return [Image(dict(i)) for i in images]
+
+
+@cache.cached(cache.IMAGES)
+def list_owned_image(request, region_name=None):
+    """Get the list of images owned by the project's account."""
+    response = ec2_client(request, region_name).describe_images(Owners=["self"])
     return to_wrapping_list(response, "Images", Image)
 
 
@@ -257,22 +331,35 @@ def get_image(request, image_id):
     return to_wrapping_list(response, "Images", Image)[0]
 
 
+def get_images(request, image_ids):
+    """Get several images with one describe call per 200 ids."""
+    images = []
+    for ids in _chunks(list(image_ids)):
+        response = ec2_client(request).describe_images(
+            Filters=[{"Name": "image-id", "Values": ids}])
+        images.extend(to_wrapping_list(response, "Images", Image))
+    return images
+
+
+@cache.invalidates(cache.IMAGES)
 def delete_image(request, image_id):
     ec2_client(request).deregister_image(ImageId=image_id)
 
 
-def list_flavor(request):
-    """Get the list of available instance type (flavors)."""
-    # TODO(Dennis) : Instance type API is too heavy to call directly.(per region 7MB..) Needs Improvement. T.T
+def list_flavor(request, **filters):
+    """Get the list of available instance type (flavors).
+
+    :param filters: min_vcpus, min_ram, family, ebs_optimized and
+                    enhanced_networking, see flavor_catalog.FlavorCatalog.query
+    """
+    # The price list API is too heavy to call directly (per region 7MB..),
+    # region catalogs are built offline by "manage.py build_flavor_catalog".
     # DOC : https://aws.amazon.com/blogs/aws/new-aws-price-list-api/
-    # API : https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/20170605233259/ap-northeast-2/index.json
-    with open(path.join(path.dirname(path.realpath(__file__)), "instanceType.json"), "r") as r:
-        rd = json.load(r)
-        instance_types = rd
-        r.close()
-    return _to_instance_types(instance_types)
+    catalog = flavor_catalog.get_catalog(get_region_name(request))
+    return [r.flavor for r in catalog.query(**filters)]
 
 
+@cache.invalidates(cache.SECURITY_GROUPS)
 def import_openstack_sg(request, openstack_sg_id):
     """Import security group from OpenStack."""
     openstack_sg = network.security_group_get(request, openstack_sg_id)
@@ -315,9 +402,10 @@ def import_openstack_sg(request, openstack_sg_id):
                       .format(e, rule))
 
 
-def list_security_groups(request):
+@cache.cached(cache.SECURITY_GROUPS)
+def list_security_groups(request, region_name=None):
     """Get the list of available security groups."""
-    response = ec2_client(request).describe_security_groups()
+    response = ec2_client(request, region_name).describe_security_groups()
     return to_wrapping_list(response, "SecurityGroups", SecurityGroup)
 
 
@@ -333,23 +421,27 @@ def get_security_group(request, sg_name):
     return to_wrapping_list(response, "SecurityGroups", SecurityGroup)[0]
 
 
+@cache.invalidates(cache.SECURITY_GROUPS)
 def create_security_group(request, name, desc):
     """Create security group."""
     response = ec2_client(request).create_security_group(GroupName=name, Description=desc)
     return SecurityGroup(response)
 
 
+@cache.invalidates(cache.SECURITY_GROUPS)
 def delete_security_group(request, sg_id):
     """Delete Security Group."""
     ec2_client(request).delete_security_group(GroupId=sg_id)
 
 
+@cache.invalidates(cache.SECURITY_GROUPS)
 def create_security_group_rule(request, *arg, **kwargs):
     """Create security group rule."""
     response = ec2_client(request).create_security_group_rule(*arg, **kwargs)
     return SecurityGroup(response)
 
 
+@cache.invalidates(cache.SECURITY_GROUPS)
 def update_security_group(request, group_id, name, desc):
     """Update security group."""
     response = ec2_client(request).update_security_group(
@@ -360,6 +452,7 @@ def update_security_group(request, group_id, name, desc):
     return SecurityGroup(response)
 
 
+@cache.cached(cache.KEYPAIRS)
 def list_keypairs(request):
     """Get the list of ssh key."""
     response = ec2_client(request).describe_key_pairs()
@@ -372,18 +465,21 @@ def get_keypair(request, key_name):
     return to_wrapping_list(response, "KeyPairs", KeyPair)[0]
 
 
+@cache.invalidates(cache.KEYPAIRS)
 def create_keypair(request, key_name):
     """create ssh key."""
     response = ec2_client(request).create_key_pair(KeyName=key_name)
     return KeyPair(response)
 
 
+@cache.invalidates(cache.KEYPAIRS)
 def delete_keypair(request, key_name):
     """delete ssh key."""
     response = ec2_client(request).delete_key_pair(KeyName=key_name)
     return response
 
 
+@cache.invalidates(cache.KEYPAIRS)
 def import_keypair(request, key_name, public_key):
     """import ssh key."""
     response = ec2_client(request).import_key_pair(
@@ -403,30 +499,36 @@ def import_openstack_keypair(request, os_key_name):
     )
 
 
+@cache.invalidates(cache.INSTANCES)
 def start_instance(request, instance_id):
     ec2_client(request).start_instances(InstanceIds=[instance_id, ])
 
 
+@cache.invalidates(cache.INSTANCES)
 def stop_instance(request, instance_id):
     ec2_client(request).stop_instances(InstanceIds=[instance_id, ])
 
 
+@cache.invalidates(cache.INSTANCES)
 def reboot_instance(request, instance_id):
     ec2_client(request).reboot_instances(InstanceIds=[instance_id, ])
 
 
+@cache.cached(cache.REGIONS)
 def list_regions(request):
     """Get the list of region."""
     response = ec2_client(request).describe_regions()
     return to_wrapping_list(response, "Regions", Region)
 
 
+@cache.cached(cache.AVAILABILITY_ZONES)
 def list_availability_zones(request):
     """Get the list of availability zone."""
     response = ec2_client(request).describe_availability_zones()
     return to_wrapping_list(response, "AvailabilityZones", AvailabilityZone)
 
 
+@cache.invalidates(cache.IMAGES)
 def import_image_from_s3(request, image_format, bucket_name, object_name, upload_size):
     """Import Instance Image"""
     now = datetime.datetime.now()
@@ -458,15 +560,88 @@ def import_image_from_s3(request, image_format, bucket_name, object_name, upload
     return response.get("ImportTaskId")
 
 
-def export_instance_to_s3(request, instance_id, bucket_name, instance_name=""):
+def export_instance_to_s3(request, instance_id, bucket_name, instance_name="",
+                          disk_image_format="vmdk", target_environment="vmware"):
     """Export Instance To OpenStack"""
     task = ec2_client(request).create_instance_export_task(
         Description=instance_name,
         ExportToS3Task={
-            "DiskImageFormat": "vmdk",
+            "DiskImageFormat": disk_image_format,
             "S3Bucket": bucket_name
         },
         InstanceId=instance_id,
-        TargetEnvironment="vmware"
+        TargetEnvironment=target_environment
     )
     return task.get("ExportTask").get("ExportTaskId")
+
+
+def get_snapshots(request, snapshot_ids):
+    """Describe EBS snapshots, as dicts, with one call per 200 ids."""
+    snapshots = []
+    for ids in _chunks(list(snapshot_ids)):
+        response = ec2_client(request).describe_snapshots(
+            Filters=[{"Name": "snapshot-id", "Values": ids}])
+        snapshots.extend(response.get("Snapshots", []))
+    return snapshots
+
+
+def get_root_volume_id(request, instance_id):
+    """Id of the EBS volume the instance boots from, or None."""
+    reservations = ec2_client(request).describe_instances(
+        InstanceIds=[instance_id]
+    ).get("Reservations")
+    instance = reservations[0]["Instances"][0]
+    for mapping in instance.get("BlockDeviceMappings", []):
+        if mapping.get("DeviceName") == instance.get("RootDeviceName") and "Ebs" in mapping:
+            return mapping["Ebs"]["VolumeId"]
+    return None
+
+
+def create_volume_snapshot(request, volume_id, description):
+    """Start a snapshot of an EBS volume and return its id."""
+    response = ec2_client(request).create_snapshot(VolumeId=volume_id, Description=description)
+    LOG.debug("Create EBS Snapshot : %s (%s)" % (response.get("SnapshotId"), volume_id))
+    return response.get("SnapshotId")
+
+
+def delete_snapshot(request, snapshot_id):
+    LOG.debug("Delete EBS Snapshot : %s" % snapshot_id)
+    return ec2_client(request).delete_snapshot(SnapshotId=snapshot_id)
+
+
+@cache.invalidates(cache.IMAGES)
+def register_image_from_snapshot(request, name, snapshot_id, architecture="x86_64",
+                                boot_mode=None, ena_support=False,
+                                root_device_name="/dev/sda1"):
+    """Register an HVM AMI booting from an EBS snapshot and return its id.
+
+    :param boot_mode: "legacy-bios" or "uefi", None for the EC2 default of
+                      the architecture
+    :param ena_support: whether the guest has the ENA driver, which Nitro
+                        instance types need
+    """
+    kwargs = {}
+    if boot_mode:
+        kwargs["BootMode"] = boot_mode
+    if ena_support:
+        kwargs["EnaSupport"] = True
+    response = ec2_client(request).register_image(
+        Name=name,
+        Description=name,
+        Architecture=architecture,
+        VirtualizationType="hvm",
+        RootDeviceName=root_device_name,
+        BlockDeviceMappings=[
+            {
+                "DeviceName": root_device_name,
+                "Ebs": {
+                    "SnapshotId": snapshot_id,
+                    "DeleteOnTermination": True,
+                    "VolumeType": "gp2",
+                },
+            },
+        ],
+        **kwargs
+    )
+    LOG.debug("Register Image : %s (%s)" % (response.get("ImageId"), snapshot_id))
+    return response.get("ImageId")
@@ -17,11 +17,16 @@ from openstack_dashboard.api.rest import urls
 from openstack_dashboard.api.rest import utils as rest_utils
 
 from aws_dashboard.api import ec2
+from aws_dashboard.api.hybrid import jobs
 from aws_dashboard.api.hybrid import taskflow
 
 LOGICAL_NAME_PATTERN = "[a-zA-Z0-9-._~]+"
 
 
+def _to_bool(value):
+    return value.lower() in ("true", "1", "yes")
+
+
 @urls.register
 class Instances(generic.View):
     """API for EC2 Instances."""
@@ -89,12 +94,15 @@ class ImportInstances(generic.View):
 
     @rest_utils.ajax(data_required=True)
     def post(self, request):
-        """Import an EC2 instance from OpenStack
+        """Queue the import of an OpenStack instance to EC2
         :param request: HTTP request
+
+        Returns the queued job, see Job, or runs the import in the request
+        when jobs are not enabled.
         """
         try:
-            taskflow.run_import_instance_tasks(
-                request,
+            job_name = request.DATA.get("name") or request.DATA["source_id"]
+            kw = dict(
                 source_type=request.DATA.get("source_type", {}).get("type"),
                 source_id=request.DATA.get("source_id"),
                 flavor=request.DATA.get("flavor_id"),
@@ -108,7 +116,16 @@ class ImportInstances(generic.View):
         except KeyError as e:
             raise rest_utils.AjaxError(400, "missing required parameter "
                                             "'%s'" % e.args[0])
-        return rest_utils.CreatedResponse("aws/ec2/instances", {})
+        if not jobs.enabled():
+            taskflow.run_import_instance_tasks(request, **kw)
+            return rest_utils.CreatedResponse("aws/ec2/instances", {})
+
+        job_id = jobs.submit(request, "import_instance", job_name=job_name,
+                             stage_names=taskflow.IMPORT_STAGES, **kw)
+        return rest_utils.CreatedResponse(
+            "/api/aws/jobs/%s/" % job_id,
+            jobs.get_job(request, job_id).to_dict()
+        )
 
 
 @urls.register
@@ -124,45 +141,111 @@ class ExportInstances(generic.View):
 
     @rest_utils.ajax(data_required=True)
     def post(self, request):
-        """Export an EC2 instance to OpenStack
+        """Queue the export of an EC2 instance to OpenStack
         :param request: HTTP request
+
+        Returns the queued job, see Job, or runs the export in the request
+        when jobs are not enabled.
         """
         try:
-            args = (
-                request,
-                request.DATA['name'],
-                request.DATA['source_id'],
-                request.DATA['flavor_id'],
-                request.DATA['key_name'],
-                request.DATA['user_data'],
-                request.DATA['security_groups'],
-                request.DATA.get('leave_original_instance'),
-                request.DATA.get('leave_instance_snapshot')
+            kw = dict(
+                name=request.DATA['name'],
+                source_id=request.DATA['source_id'],
+                flavor=request.DATA['flavor_id'],
+                key_name=request.DATA['key_name'],
+                user_data=request.DATA['user_data'],
+                security_groups=request.DATA['security_groups'],
+                leave_original_instance=request.DATA.get('leave_original_instance'),
+                leave_instance_snapshot=request.DATA.get('leave_instance_snapshot')
             )
         except KeyError as e:
             raise rest_utils.AjaxError(400, 'missing required parameter '
                                             "'%s'" % e.args[0])
-        kw = {}
         for name in self._optional_create:
             if name in request.DATA:
                 kw[name] = request.DATA[name]
 
-        new = taskflow.run_export_instance_tasks(*args, **kw)
+        if not jobs.enabled():
+            instance_id = taskflow.run_export_instance_tasks(request, **kw)
+            return rest_utils.CreatedResponse(
+                '/api/nova/servers/%s' % utils_http.urlquote(instance_id),
+                {"id": instance_id}
+            )
+
+        job_id = jobs.submit(request, "export_instance", job_name=kw["name"],
+                             stage_names=taskflow.EXPORT_STAGES, **kw)
         return rest_utils.CreatedResponse(
-            '/api/nova/servers/%s' % utils_http.urlquote(new.id),
-            new.to_dict()
+            '/api/aws/jobs/%s/' % job_id,
+            jobs.get_job(request, job_id).to_dict()
         )
 
 
+@urls.register
+class Jobs(generic.View):
+    """API for background import/export jobs."""
+    url_regex = r"aws/jobs/$"
+
+    @rest_utils.ajax()
+    def get(self, request):
+        """Get the recent jobs of the project
+        :param request: HTTP request
+        """
+        return {"items": [j.to_dict() for j in jobs.list_jobs(request)]}
+
+
+@urls.register
+class Job(generic.View):
+    """API for a background import/export job."""
+    url_regex = r"aws/jobs/(?P<job_id>[0-9a-f]+)/$"
+
+    @rest_utils.ajax()
+    def get(self, request, job_id):
+        """Get the status of a job and of each of its stages
+        :param request: HTTP request
+        :param job_id: Job ID
+        """
+        job = jobs.get_job(request, job_id)
+        if job is None:
+            raise rest_utils.AjaxError(404, "job '%s' not found" % job_id)
+        return job.to_dict()
+
+    @rest_utils.ajax()
+    def post(self, request, job_id):
+        """Resume a failed job at its first incomplete stage
+        :param request: HTTP request
+        :param job_id: Job ID
+        """
+        if not jobs.enabled():
+            raise rest_utils.AjaxError(503, "jobs are not enabled")
+        if not jobs.resume_job(request, job_id):
+            raise rest_utils.AjaxError(409, "job '%s' is not failed" % job_id)
+        return jobs.get_job(request, job_id).to_dict()
+
+
 @urls.register
 class Images(generic.View):
     """API for EC2 Images."""
     url_regex = r"aws/ec2/images/$"
 
+    _search_filters = ("prefix", "name", "owner", "architecture")
+
     @rest_utils.ajax()
     def get(self, request):
-        """Get EC2 image list"""
-        images = ec2.list_image(request)
+        """Get EC2 image list
+
+        The following GET parameters search the public image catalog:
+
+        :param prefix: image name prefix
+        :param name: substring of the image name
+        :param owner: owner id or alias of the image
+        :param architecture: image architecture, e.g. x86_64
+        """
+        filters = dict((k, request.GET[k]) for k in self._search_filters
+                       if request.GET.get(k))
+        if filters:
+            images = ec2.search_image(request, **filters)
+        else:
+            images = ec2.list_image(request)
         return {
             "items": [i.to_dict() for i in images],
             "has_more_data": False,
@@ -177,8 +260,26 @@ class Flavors(generic.View):
 
     @rest_utils.ajax()
     def get(self, request):
-        """Get a list of flavors."""
-        flavors = ec2.list_flavor(request)
+        """Get a list of flavors.
+
+        The following GET parameters filter the list:
+
+        :param min_vcpus: minimum number of vCPUs
+        :param min_ram: minimum memory in GiB
+        :param family: instance family, e.g. "m4"
+        :param ebs_optimized: "true" or "false"
+        :param enhanced_networking: "true" or "false"
+        """
+        filters = {}
+        for name, parse in (("min_vcpus", int), ("min_ram", float), ("family", str),
+                            ("ebs_optimized", _to_bool),
+                            ("enhanced_networking", _to_bool)):
+            if request.GET.get(name):
+                try:
+                    filters[name] = parse(request.GET[name])
+                except ValueError:
+                    raise rest_utils.AjaxError(400, "invalid parameter '%s'" % name)
+        flavors = ec2.list_flavor(request, **filters)
         return {"items": [f.to_dict() for f in flavors]}
 
 
@@ -0,0 +1,172 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-memory EC2 instance type (flavor) catalog.
+
+The catalog file is parsed once per process into immutable records with
+numeric vCPU, memory and clock columns. Queries on minimum vCPU and memory
+are answered by bisect on the sorted columns.
+
+A region catalog built by the ``build_flavor_catalog`` management command
+(``<FLAVOR_CATALOG_DIR>/<region>.json``) is used when present, otherwise
+the bundled ``instanceType.json``.
+"""
+import bisect
+import collections
+import json
+import logging
+from os import path
+import re
+import threading
+
+from django.conf import settings
+from openstack_dashboard.api import base
+
+LOG = logging.getLogger(__name__)
+CATALOG_FILE = path.join(path.dirname(path.realpath(__file__)), "instanceType.json")
+FLAVOR_CATALOG_DIR = getattr(settings, "FLAVOR_CATALOG_DIR",
+                             path.join(path.dirname(path.realpath(__file__)), "catalog"))
+
+InstanceTypeRecord = collections.namedtuple("InstanceTypeRecord", [
+    "name", "family", "vcpus", "ram", "clock_speed", "price",
+    "ebs_optimized", "enhanced_networking", "flavor"
+])
+
+
+class InstanceType(base.APIDictWrapper):
+    _attrs = ["id", "InstanceType", "vCPU", "Memory", "Storage", "PhysicalProcessor",
+              "ClockSpeed", "EBS_OPT", "EnhancedNetworking",
+              "IntelAVX2", "IntelAVX", "IntelTurbo", "NetworkingPerformance",
+              "OnDemandPrice"]
+
+    def __init__(self, apidict):
+        apidict["id"] = apidict["InstanceType"]
+        apidict["name"] = apidict["InstanceType"]
+        apidict["vcpus"] = apidict["vCPU"]
+        apidict["ram"] = apidict["Memory"]
+        apidict["storage"] = apidict["Storage"]
+        apidict["clock_speed"] = apidict["ClockSpeed"]
+        apidict["network_performance"] = apidict["NetworkingPerformance"]
+        apidict["price"] = apidict.get("OnDemandPrice")
+        super(InstanceType, self).__init__(apidict)
+
+
+def _to_number(value):
+    """Parse values such as "36 ", "15.25", "Up to 3.0" or "-"."""
+    match = re.search(r"\d+(\.\d+)?", str(value).replace(",", ""))
+    return float(match.group()) if match else None
+
+
+def _to_record(instance_type):
+    name = instance_type["InstanceType"]
+    vcpus = _to_number(instance_type.get("vCPU"))
+    return InstanceTypeRecord(
+        name=name,
+        family=name.split(".")[0],
+        vcpus=int(vcpus) if vcpus is not None else 0,
+        ram=_to_number(instance_type.get("Memory")) or 0.0,
+        clock_speed=_to_number(instance_type.get("ClockSpeed")),
+        price=_to_number(instance_type.get("OnDemandPrice")),
+        ebs_optimized=instance_type.get("EBS_OPT") == "Yes",
+        enhanced_networking=instance_type.get("EnhancedNetworking") == "Yes",
+        flavor=InstanceType(dict(instance_type)),
+    )
+
+
+class FlavorCatalog(object):
+    """Immutable set of instance types with sorted numeric indexes.
+
+    The InstanceType wrappers are shared by every caller and must not be
+    modified.
+    """
+
+    def __init__(self, instance_types):
+        self.records = tuple(sorted((_to_record(t) for t in instance_types),
+                                    key=lambda r: r.name))
+        self._by_name = dict((r.name, r) for r in self.records)
+        self._vcpus_index = sorted((r.vcpus, i) for i, r in enumerate(self.records))
+        self._vcpus = [v for v, _ in self._vcpus_index]
+        self._ram_index = sorted((r.ram, i) for i, r in enumerate(self.records))
+        self._ram = [v for v, _ in self._ram_index]
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def query(self, min_vcpus=None, min_ram=None, family=None,
+              ebs_optimized=None, enhanced_networking=None):
+        """Find instance types matching every given condition.
+
+        :param min_vcpus: minimum number of vCPUs
+        :param min_ram: minimum memory in GiB
+        :param family: instance family, e.g. "m4"
+        :param ebs_optimized: True or False to filter on EBS optimization
+        :param enhanced_networking: True or False to filter on enhanced
+                                    networking
+        """
+        matched = None
+        if min_vcpus is not None:
+            start = bisect.bisect_left(self._vcpus, min_vcpus)
+            matched = set(i for _, i in self._vcpus_index[start:])
+        if min_ram is not None:
+            start = bisect.bisect_left(self._ram, min_ram)
+            ram_matched = set(i for _, i in self._ram_index[start:])
+            matched = ram_matched if matched is None else matched & ram_matched
+        indexes = sorted(matched) if matched is not None else range(len(self.records))
+
+        result = []
+        for i in indexes:
+            record = self.records[i]
+            if family is not None and record.family != family:
+                continue
+            if ebs_optimized is not None and record.ebs_optimized != ebs_optimized:
+                continue
+            if (enhanced_networking is not None and
+                    record.enhanced_networking != enhanced_networking):
+                continue
+            result.append(record)
+        return result
+
+
+_catalogs = {}
+_lock = threading.Lock()
+
+
+def load(file_path=CATALOG_FILE):
+    with open(file_path, "r") as f:
+        instance_types = json.load(f)
+    return FlavorCatalog(instance_types.values())
+
+
+def catalog_file(region_name=None):
+    """Path of the region catalog, or of the bundled default catalog."""
+    if region_name:
+        file_path = path.join(FLAVOR_CATALOG_DIR, "%s.json" % region_name)
+        if path.exists(file_path):
+            return file_path
+    return CATALOG_FILE
+
+
+def get_catalog(region_name=None):
+    """Get the catalog of the region, parsing it on first use."""
+    file_path = catalog_file(region_name)
+    catalog = _catalogs.get(file_path)
+    if catalog is None:
+        with _lock:
+            catalog = _catalogs.get(file_path)
+            if catalog is None:
+                catalog = _catalogs[file_path] = load(file_path)
+                LOG.debug("Load flavor catalog : %s (%d types)" % (file_path, len(catalog)))
+    return catalog
@@ -0,0 +1,158 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""qemu-img image conversion.
+
+Conversion is the CPU hot spot of a migration host, so its qemu-img
+options are set per deployment with the AWS_QEMU_IMG_OPTIONS dict:
+
+- ``coroutines``: parallel coroutines (``-m``, 1 to 16)
+- ``out_of_order``: allow out-of-order writes (``-W``)
+- ``sparse_size``: minimum run of zeros left unallocated (``-S``), or
+  0 for a fully allocated output
+- ``compression``: qcow2 output compression, "zlib", "zstd" (qemu 5.1
+  and later) or None
+- ``timeout``: seconds before the conversion is killed, or None
+"""
+import json
+import logging
+import re
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+
+LOG = logging.getLogger(__name__)
+DEFAULT_OPTIONS = {
+    "coroutines": 8,
+    "out_of_order": False,
+    "sparse_size": "4k",
+    "compression": "zlib",
+    "timeout": None,
+}
+AWS_QEMU_IMG_OPTIONS = dict(DEFAULT_OPTIONS, **getattr(settings, "AWS_QEMU_IMG_OPTIONS", {}))
+PROGRESS_PATTERN = re.compile(r"\((\d+(?:\.\d+)?)/100%\)")
+
+
+class ConversionError(Exception):
+    pass
+
+
+def image_info(file_path):
+    """``qemu-img info`` of an image, as a dict."""
+    output = subprocess.check_output(["qemu-img", "info", "--output=json", file_path])
+    return json.loads(output.decode("utf-8"))
+
+
+def allocated_size(file_path):
+    """Bytes of the virtual disk holding data, according to ``qemu-img map``."""
+    output = subprocess.check_output(["qemu-img", "map", "--output=json", file_path])
+    return sum(extent["length"] for extent in json.loads(output.decode("utf-8"))
+               if extent.get("data") and not extent.get("zero"))
+
+
+def build_command(source_path, target_path, output_format, options=None,
+                  create_options=None, **overrides):
+    """qemu-img convert command line, with progress output.
+
+    :param options: dict of the options above, AWS_QEMU_IMG_OPTIONS by default
+    :param create_options: output format options, e.g. ["subformat=streamOptimized"]
+    :param overrides: options overriding those of ``options``
+    """
+    options = dict(options or AWS_QEMU_IMG_OPTIONS, **overrides)
+    create_options = list(create_options or [])
+    cmd = ["qemu-img", "convert", "-p", "-O", output_format,
+           "-m", str(options["coroutines"]), "-S", str(options["sparse_size"])]
+    if options["out_of_order"]:
+        cmd.append("-W")
+    if output_format == "qcow2" and options["compression"]:
+        cmd.append("-c")
+        if options["compression"] != "zlib":
+            create_options.append("compression_type=%s" % options["compression"])
+    if create_options:
+        cmd.extend(["-o", ",".join(create_options)])
+    return cmd + [source_path, target_path]
+
+
+class ProgressReader(threading.Thread):
+    """Parse the ``-p`` output of qemu-img.
+
+    ``percent`` follows the progress; other lines are kept in ``output``
+    for error messages.
+    """
+
+    def __init__(self, stream, callback=None):
+        super(ProgressReader, self).__init__(name="qemu-img-progress")
+        self.daemon = True
+        self.stream = stream
+        self.callback = callback
+        self.percent = 0.0
+        self.output = []
+
+    def run(self):
+        buf = b""
+        while True:
+            char = self.stream.read(1)
+            if not char:
+                break
+            if char not in (b"\r", b"\n"):
+                buf += char
+                continue
+            line = buf.decode("utf-8", "replace").strip()
+            buf = b""
+            match = PROGRESS_PATTERN.search(line)
+            if match:
+                self.percent = float(match.group(1))
+                if self.callback is not None:
+                    self.callback(self.percent)
+            elif line:
+                self.output.append(line)
+
+
+def convert(source_path, target_path, output_format, progress=None, options=None,
+            create_options=None):
+    """Convert an image and wait for qemu-img to finish.
+
+    :param progress: called with the percentage done
+    :raises ConversionError: on timeout or non-zero exit
+    """
+    options = dict(options or AWS_QEMU_IMG_OPTIONS)
+    cmd = build_command(source_path, target_path, output_format, options, create_options)
+    LOG.debug("Start Convert Image : %s" % " ".join(cmd))
+    start_time = time.time()
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    reader = ProgressReader(process.stdout, progress)
+    reader.start()
+    timer = None
+    timed_out = []
+    if options["timeout"]:
+        def kill():
+            timed_out.append(True)
+            process.kill()
+        timer = threading.Timer(options["timeout"], kill)
+        timer.start()
+    try:
+        returncode = process.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    reader.join(5)
+    if timed_out:
+        raise ConversionError("qemu-img convert of %s timed out after %d seconds at %.0f%%"
+                              % (source_path, options["timeout"], reader.percent))
+    if returncode != 0:
+        raise ConversionError("qemu-img convert of %s failed (%d) : %s"
+                              % (source_path, returncode, " ".join(reader.output)))
+    LOG.debug("Finish Convert Image : %s (%.1f sec)" % (target_path, time.time() - start_time))
+    return target_path
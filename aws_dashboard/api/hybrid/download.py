@@ -0,0 +1,85 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Write a downloaded image to a local file.
+
+The chunks are written in binary mode through a large buffer into a file
+preallocated to the expected size, and hashed on the way, so a truncated
+or corrupted download fails right away instead of in a later stage.
+"""
+import hashlib
+import logging
+import os
+import time
+
+from django.conf import settings
+
+LOG = logging.getLogger(__name__)
+AWS_DOWNLOAD_BUFFER_SIZE = getattr(settings, "AWS_DOWNLOAD_BUFFER_SIZE", 8 * 1024 * 1024)
+PROGRESS_INTERVAL = 10
+
+
+class DownloadError(Exception):
+    pass
+
+
+def preallocate(fd, size):
+    """Reserve the disk blocks of the file, where the OS supports it."""
+    fallocate = getattr(os, "posix_fallocate", None)
+    if fallocate is None or not size:
+        return
+    try:
+        fallocate(fd, 0, size)
+    except OSError as e:
+        LOG.debug("Preallocation not supported : %s" % e)
+
+
+def download_to_file(chunks, file_path, size=None, checksum=None, progress=None,
+                     buffer_size=AWS_DOWNLOAD_BUFFER_SIZE):
+    """Write an iterable of chunks to ``file_path``.
+
+    :param size: expected size in bytes, checked when given
+    :param checksum: expected MD5 hex digest, e.g. the Glance image checksum
+    :param progress: called with the bytes written and the bytes/s so far,
+                     every PROGRESS_INTERVAL seconds and at the end
+    :returns: dict of the size, MD5 digest, duration and bytes/s
+    """
+    md5 = hashlib.md5()
+    written = 0
+    start_time = last_report = time.time()
+    with open(file_path, "wb", buffer_size) as image_file:
+        preallocate(image_file.fileno(), size)
+        for chunk in chunks:
+            image_file.write(chunk)
+            md5.update(chunk)
+            written += len(chunk)
+            if size and written > size:
+                raise DownloadError("%s is larger than the expected %d bytes" % (file_path, size))
+            now = time.time()
+            if progress is not None and now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                progress(written, written / (now - start_time))
+        image_file.truncate(written)
+
+    duration = max(time.time() - start_time, 0.001)
+    rate = written / duration
+    if size and written != size:
+        raise DownloadError("%s is truncated : %d of %d bytes" % (file_path, written, size))
+    digest = md5.hexdigest()
+    if checksum and digest != checksum:
+        raise DownloadError("%s checksum mismatch : %s, expected %s" % (file_path, digest, checksum))
+    if progress is not None:
+        progress(written, rate)
+    LOG.debug("Download Complete : %s (%d MB, %.1f MB/s)"
+              % (file_path, written // (1024 * 1024), rate / 1024 / 1024))
+    return {"size": written, "md5": digest, "duration": duration, "rate": rate}
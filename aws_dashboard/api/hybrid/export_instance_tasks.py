@@ -13,22 +13,22 @@
 # limitations under the License.
 import logging
 import os
-from time import sleep
 
 from openstack_dashboard.api import nova
 from openstack_dashboard.api import glance
 
+from aws_dashboard.api import ebs
 from aws_dashboard.api import ec2
 from aws_dashboard.api import s3
-from aws_dashboard.api import transport
+from aws_dashboard.api.hybrid import formats
+from aws_dashboard.api.hybrid import poller
 from aws_dashboard.api.hybrid import utils
 
 LOG = logging.getLogger(__name__)
 
 
-# TODO : https://wiki.openstack.org/wiki/TaskFlow should be applied
-def export_instance(request, instance_id, instance_name, status_check_interval):
-    """Export instance image to S3"""
+def start_export_instance(request, instance_id, instance_name, disk_image_format="vmdk"):
+    """Start the export of the instance to S3 and return the export task id."""
     project_id = request.user.tenant_id
     aws_access_key_id, aws_secret_access_key, region_name = utils.get_api_keys(project_id)
 
@@ -37,44 +37,72 @@ def export_instance(request, instance_id, instance_name, status_check_interval):
         s3.create_bucket(request, project_id, region_name)
         s3.grant_bucket_acl(request, project_id)
 
-    task_id = ec2.export_instance_to_s3(request, instance_id, project_id, instance_name)
-    # TODO : from oslo_service.loopingcall import FixedIntervalLoopingCall should be applied
-    while True:
-        task = transport.get_export_task(request, task_id)
-        task_state = task.get("State")
-        if task_state is None:
-            raise KeyError("export instance task state is None")
-        LOG.debug("Export Task State : {}".format(task_state))
-        sleep(status_check_interval)
-        if task_state == "completed":
-            LOG.debug("VM export ready!!")
-            break
+    return ec2.export_instance_to_s3(request, instance_id, project_id, instance_name,
+                                     disk_image_format,
+                                     formats.EC2_EXPORT_FORMATS[disk_image_format])
+
+
+def wait_export_task(request, task_id, status_check_interval):
+    """Wait for the export task to complete."""
+    task = poller.wait_for(poller.EXPORT_TASK, request, task_id, status_check_interval)
+    LOG.debug("VM export ready!!")
     return task
 
 
-def download_image_from_s3(request, target_obj, download_path):
+def start_root_volume_snapshot(request, instance_id, instance_name):
+    """Start an EBS snapshot of the root volume of the instance and return its id."""
+    volume_id = ec2.get_root_volume_id(request, instance_id)
+    if volume_id is None:
+        raise ValueError("Instance %s has no EBS root volume" % instance_id)
+    return ec2.create_volume_snapshot(request, volume_id, instance_name or instance_id)
+
+
+def wait_ebs_snapshot(request, snapshot_id, status_check_interval):
+    """Wait for the EBS snapshot to complete."""
+    return poller.wait_for(poller.EBS_SNAPSHOT, request, snapshot_id, status_check_interval)
+
+
+def read_ebs_snapshot(request, snapshot_id, download_path, image_name):
+    """Fetch the blocks of the EBS snapshot into a sparse raw image.
+
+    Returns the path of the image and the dict of ebs.SnapshotReader.read.
+    """
+    file_path = "%s/%s" % (download_path, image_name)
+    try:
+        return file_path, ebs.read_snapshot(request, snapshot_id, file_path)
+    except Exception:
+        if os.path.exists(file_path):
+            delete_file(file_path)
+        raise
+
+
+def delete_ebs_snapshot(request, snapshot_id):
+    return ec2.delete_snapshot(request, snapshot_id)
+
+
+def download_image_from_s3(request, target_obj, download_path, report=None):
     """Download instance image file from s3"""
-    return s3.download_object(request, target_obj, download_path)
+    return s3.download_object(request, target_obj, download_path, report)
 
 
-def convert_image_format(target_file_path, convert_format, delete_origin=True):
+def convert_image_format(target_file_path, convert_format, delete_origin=True, progress=None):
     """Convert Image Format"""
-    return utils.convert_image_format(target_file_path, convert_format, delete_origin)
-
-
-def upload_image_to_glance(request, image_name, image_file_path, image_format, interval):
-    image = glance.image_create(request,
-                                name=image_name,
-                                is_public="False",
-                                disk_format=image_format,
-                                data=open(image_file_path, 'rb'),
-                                container_format="bare")
-    while True:
-        image = glance.image_get(request, image.id)
-        LOG.debug("Image Upload Status : {}".format(image.status))
-        if image.status == "active":
-            break
-        sleep(interval)
+    return utils.convert_image_format(target_file_path, convert_format, delete_origin, progress)
+
+
+def create_glance_image(request, image_name, image_file_path, image_format):
+    """Create the Glance image with the data of the file."""
+    return glance.image_create(request,
+                               name=image_name,
+                               is_public="False",
+                               disk_format=image_format,
+                               data=open(image_file_path, 'rb'),
+                               container_format="bare")
+
+
+def wait_glance_image_active(request, image_id, interval):
+    """Wait for the Glance image to be active."""
+    image = poller.wait_for(poller.GLANCE_IMAGE, request, image_id, interval)
     LOG.debug("Image Upload Complete")
     return image
 
@@ -119,11 +147,6 @@ def delete_glance_image(request, image_id):
 
 def wait_instance_active(request, instance_id, interval):
     """Wait Instance Active"""
-    while True:
-        instance = nova.server_get(request, instance_id)
-        LOG.debug("Instance Status : {}".format(instance.status))
-        if instance.status == "ACTIVE":
-            break
-        sleep(interval)
+    instance = poller.wait_for(poller.NOVA_SERVER, request, instance_id, interval)
     LOG.debug("Instance Create Complete")
     return instance
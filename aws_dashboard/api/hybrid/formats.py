@@ -0,0 +1,114 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Disk formats exchanged with EC2 VM Import/Export.
+
+A raw upload is as large as the virtual disk, however little of it holds
+data, while a stream-optimized VMDK only carries the allocated data,
+compressed. With CONVERT_IMAGE_FORMAT = "auto" the import picks the VMDK
+when the disk is sparse enough to make it worth compressing, raw
+otherwise. Setting CONVERT_IMAGE_FORMAT to "raw" or "vmdk" forces it.
+
+Exports ask EC2 for the first of OPENSTACK_ACCEPTED_IMAGE_FORMATS it can
+produce, and the artifact goes to Glance as it is. Only when the cloud
+accepts none of them is the VMDK export converted to
+OPENSTACK_IMAGE_FORMAT.
+"""
+import logging
+
+from django.conf import settings
+
+from aws_dashboard.api.hybrid import convert
+
+LOG = logging.getLogger(__name__)
+AUTO = "auto"
+CONVERT_IMAGE_FORMAT = getattr(settings, "CONVERT_IMAGE_FORMAT", AUTO)
+# Import as VMDK when at most this share of the virtual disk holds data.
+AWS_IMPORT_VMDK_MAX_ALLOCATED = getattr(settings, "AWS_IMPORT_VMDK_MAX_ALLOCATED", 0.7)
+OPENSTACK_IMAGE_FORMAT = getattr(settings, "OPENSTACK_IMAGE_FORMAT", "qcow2")
+# Disk formats Glance and Nova of the cloud run, by order of preference
+OPENSTACK_ACCEPTED_IMAGE_FORMATS = getattr(settings, "OPENSTACK_ACCEPTED_IMAGE_FORMATS",
+                                           [OPENSTACK_IMAGE_FORMAT])
+
+EC2_IMPORT_FORMATS = ("raw", "vmdk")
+# qemu-img create options of the EC2 import formats
+IMPORT_CREATE_OPTIONS = {
+    # The only VMDK flavour EC2 imports: sparse and compressed.
+    "vmdk": ["subformat=streamOptimized"],
+}
+# EC2 export DiskImageFormat: TargetEnvironment
+EC2_EXPORT_FORMATS = {
+    "vmdk": "vmware",
+    "raw": "vmware",
+    "vhd": "microsoft",
+}
+DEFAULT_EXPORT_FORMAT = "vmdk"
+
+
+def forced_import_format():
+    """The import format set by the deployment, or None when negotiated."""
+    return None if CONVERT_IMAGE_FORMAT == AUTO else CONVERT_IMAGE_FORMAT
+
+
+def is_import_ready(file_path, import_format):
+    """Whether the image can be imported in ``import_format`` as it is."""
+    info = convert.image_info(file_path)
+    if info.get("format") != import_format:
+        return False
+    if import_format == "vmdk":
+        create_type = info.get("format-specific", {}).get("data", {}).get("create-type")
+        return create_type == "streamOptimized"
+    return True
+
+
+def is_glance_import_ready(image, import_format):
+    """Whether the Glance image can be imported in ``import_format`` as it is.
+
+    Going by the image metadata only, this holds for raw images and for
+    vmdk ones Glance knows to be streamOptimized.
+    """
+    if import_format is None or image.disk_format != import_format:
+        return False
+    if import_format == "vmdk":
+        properties = getattr(image, "properties", None) or {}
+        return properties.get("vmware_disktype") == "streamOptimized"
+    return import_format == "raw"
+
+
+def negotiate_import_format(file_path):
+    """Pick the EC2 import format of the image making the smallest upload."""
+    forced = forced_import_format()
+    if forced is not None:
+        return forced
+    virtual_size = convert.image_info(file_path)["virtual-size"]
+    allocated = convert.allocated_size(file_path)
+    import_format = "raw"
+    if virtual_size and allocated <= virtual_size * AWS_IMPORT_VMDK_MAX_ALLOCATED:
+        import_format = "vmdk"
+    LOG.debug("Import Format Of %s : %s (%d of %d MB allocated)"
+              % (file_path, import_format, allocated // (1024 * 1024),
+                 virtual_size // (1024 * 1024)))
+    return import_format
+
+
+def negotiate_export_format():
+    """The EC2 export format the cloud runs as it is, or the default one."""
+    for disk_format in OPENSTACK_ACCEPTED_IMAGE_FORMATS:
+        if disk_format in EC2_EXPORT_FORMATS:
+            return disk_format
+    return DEFAULT_EXPORT_FORMAT
+
+
+def is_openstack_ready(disk_format):
+    """Whether Glance and Nova of the cloud run images of ``disk_format``."""
+    return disk_format in OPENSTACK_ACCEPTED_IMAGE_FORMATS
@@ -13,69 +13,78 @@
 # limitations under the License.
 import logging
 import os
-from time import sleep
+import time
 
 from openstack_dashboard.api import glance
 from openstack_dashboard.api import nova
 from openstack_dashboard.api.glance import glanceclient
 
+from aws_dashboard.api import ebs
 from aws_dashboard.api import ec2
 from aws_dashboard.api import s3
-from aws_dashboard.api import transport
+from aws_dashboard.api.hybrid import download
+from aws_dashboard.api.hybrid import formats
+from aws_dashboard.api.hybrid import pipeline
+from aws_dashboard.api.hybrid import poller
 from aws_dashboard.api.hybrid import utils
 
 LOG = logging.getLogger(__name__)
-
-
-# TODO : https://wiki.openstack.org/wiki/TaskFlow should be applied
-def create_snapshot(request, instance_id, status_check_interval):
-    """Create Snapshot"""
+# Glance "architecture" property values and their EC2 architecture
+EC2_ARCHITECTURES = {
+    "x86_64": "x86_64",
+    "amd64": "x86_64",
+    "i386": "i386",
+    "i686": "i386",
+    "aarch64": "arm64",
+    "arm64": "arm64",
+}
+# Glance "hw_firmware_type" property values and their EC2 boot mode
+EC2_BOOT_MODES = {
+    "bios": "legacy-bios",
+    "uefi": "uefi",
+}
+
+
+def start_snapshot(request, instance_id):
+    """Request the snapshot of an instance and return its image id."""
     instance = nova.server_get(request, instance_id)
     snapshot_id = nova.snapshot_create(request, instance.id, instance.name)
     LOG.debug("Target instance name : {} ({})".format(instance.name, instance.id))
     LOG.debug("Snapshot id : {}".format(snapshot_id))
-    image = glance.image_get(request, snapshot_id)
-    LOG.debug("Snapshot Image : {}".format(image))
-    # TODO : from oslo_service.loopingcall import FixedIntervalLoopingCall should be applied
-    while True:
-        image = glance.image_get(request, snapshot_id)
-        if (image or image.status) is None:
-            LOG.error("Instance Snapshot Fail")
-            break
-        LOG.debug("Instance Snapshot Status : {}".format(image.status))
-        sleep(status_check_interval)
-        if image.status == "active":
-            LOG.debug("Instance Snapshot Complete : {}".format(image))
-            break
+    return snapshot_id
+
+
+def wait_snapshot(request, snapshot_id, status_check_interval):
+    """Wait for the snapshot image to be active."""
+    image = poller.wait_for(poller.GLANCE_IMAGE, request, snapshot_id, status_check_interval)
+    LOG.debug("Instance Snapshot Complete : {}".format(image))
     return image
 
 
-def download_image(request, image, download_path):
-    """ download_image """
+def download_image(request, image, download_path, progress=None):
+    """Download the image data, checked against the Glance checksum.
+
+    :param progress: called with the bytes written and the bytes/s so far
+    """
     file_path = "%s/%s.%s" % (download_path, image.name, image.disk_format)
     utils.validate_image_format(file_path)
     LOG.debug("download image file path : {}".format(file_path))
 
-    image_file = open(file_path, "w+")
     image_data_iterable = glanceclient(request).images.data(image.id)
-    try:
-        LOG.debug("Start Image Download")
-        for chunk in image_data_iterable:
-            image_file.write(chunk)
-        LOG.debug("Complete Image Download")
-    finally:
-        image_file.close()
-
+    LOG.debug("Start Image Download")
+    download.download_to_file(image_data_iterable, file_path, size=image.size,
+                              checksum=image.checksum, progress=progress)
     return file_path
 
 
-def convert_image_format(target_file_path, convert_format, delete_origin=True):
+def convert_image_format(target_file_path, convert_format, delete_origin=True, progress=None):
     """ convert_image_format """
-    return utils.convert_image_format(target_file_path, convert_format, delete_origin)
+    return utils.convert_image_format(target_file_path, convert_format, delete_origin, progress,
+                                      formats.IMPORT_CREATE_OPTIONS.get(convert_format))
 
 
-def upload_to_s3(request, target_file, object_name):
-    """ Upload to s3. Create the container if it does not exist."""
+def prepare_bucket(request):
+    """Create the project bucket if it does not exist."""
     project_id = request.user.tenant_id
     aws_access_key_id, aws_secret_access_key, region_name = utils.get_api_keys(project_id)
 
@@ -84,34 +93,109 @@ def upload_to_s3(request, target_file, object_name):
         s3.create_bucket(request, project_id, region_name)
         s3.grant_bucket_acl(request, project_id)
 
-    return s3.upload_object(request, target_file, object_name)
 
+def upload_to_s3(request, target_file, object_name, report=None):
+    """ Upload to s3. Create the container if it does not exist."""
+    prepare_bucket(request)
+    return s3.upload_object(request, target_file, object_name, report)
+
+
+def stream_image_to_s3(request, image, object_name, report=None):
+    """Copy the Glance image data to s3 without a local file.
 
-def import_image(request, object_name, object_size_gb, image_format, status_check_interval):
-    """Import the image and wait for finish."""
+    Returns the size of the object in GB.
+    :param report: called with the measures and digest, see s3.report_upload
+    """
+    prepare_bucket(request)
+    image_data_iterable = glanceclient(request).images.data(image.id)
+    size = s3.upload_stream(request, image_data_iterable, object_name, image.size, report)
+    return round(size / 1024.0 / 1024 / 1024, 1)
+
+
+def convert_and_upload_to_s3(request, target_file, object_name, delete_origin=True,
+                             report=None):
+    """Convert the image to raw while uploading it to s3.
+
+    Returns the size of the object in GB.
+    :param report: called with the measures and digest, see s3.report_upload
+    """
+    prepare_bucket(request)
+    output_path = os.path.splitext(target_file)[0] + ".converted.raw"
+    virtual_size = pipeline.get_virtual_size(target_file)
+    uploader = s3.multipart_uploader(request, object_name, virtual_size)
+    start_time = time.time()
+    size = pipeline.ConvertUploadPipeline(target_file, output_path, uploader,
+                                          virtual_size).run()
+    s3.report_upload(uploader, start_time, report)
+    if delete_origin:
+        delete_file(target_file)
+    return round(size / 1024.0 / 1024 / 1024, 1)
+
+
+def start_import_image(request, object_name, object_size_gb, image_format):
+    """Start the import of the S3 object and return the import task id."""
     bucket_name = request.user.tenant_id
-    task_id = ec2.import_image_from_s3(request, image_format, bucket_name, object_name, object_size_gb)
-
-    while True:
-        import_image_task = transport.get_import_image_task(request, task_id)
-        if import_image_task == {} or None:
-            LOG.debug("Import ImageTask Fail")
-            break
-        LOG.debug("Import ImageTask Status : %s (%s)"
-                  % (import_image_task.get("StatusMessage"), import_image_task.get("Progress")))
-        sleep(status_check_interval)
-        if import_image_task.get("Progress") is None:
-            LOG.debug("Complete Import Image Tasks : %s" % import_image_task)
-            break
+    return ec2.import_image_from_s3(request, image_format, bucket_name, object_name, object_size_gb)
+
+
+def wait_import_image(request, task_id, status_check_interval):
+    """Wait for the import image task to finish."""
+    import_image_task = poller.wait_for(poller.IMPORT_IMAGE_TASK, request, task_id,
+                                        status_check_interval)
+    LOG.debug("Complete Import Image Tasks : %s" % import_image_task)
     return import_image_task
 
 
+def write_to_ebs_snapshot(request, target_file, description):
+    """Write the raw image to a new EBS snapshot, deleted on failure.
+
+    Returns the dict of ebs.SnapshotWriter.write.
+    """
+    writer = ebs.SnapshotWriter(ebs.ebs_client(request), description)
+    try:
+        return writer.write(target_file)
+    except Exception:
+        if writer.snapshot_id is not None:
+            ec2.delete_snapshot(request, writer.snapshot_id)
+        raise
+
+
+def ami_boot_options(image):
+    """Architecture, boot mode and ENA support of an AMI of the Glance image.
+
+    They come from the image properties: ``architecture`` (x86_64 when
+    unset), ``hw_firmware_type`` and ``ena_support``, which the image has
+    to declare for the AMI to run on Nitro instance types.
+    """
+    properties = getattr(image, "properties", None) or {}
+    architecture = properties.get("architecture") or "x86_64"
+    if architecture not in EC2_ARCHITECTURES:
+        raise ValueError("Image architecture %s is not supported by EC2" % architecture)
+    firmware = properties.get("hw_firmware_type")
+    if firmware and firmware not in EC2_BOOT_MODES:
+        raise ValueError("Image firmware type %s is not supported by EC2" % firmware)
+    ena_support = str(properties.get("ena_support", "")).lower() in ("true", "yes", "1")
+    return {"architecture": EC2_ARCHITECTURES[architecture],
+            "boot_mode": EC2_BOOT_MODES.get(firmware),
+            "ena_support": ena_support}
+
+
+def register_ebs_image(request, name, snapshot_id, status_check_interval, boot_options=None):
+    """Wait for the EBS snapshot to complete and register an AMI of it.
+
+    :param boot_options: dict of ami_boot_options
+    """
+    poller.wait_for(poller.EBS_SNAPSHOT, request, snapshot_id, status_check_interval)
+    return ec2.register_image_from_snapshot(request, name, snapshot_id, **(boot_options or {}))
+
+
 def create_instance(request, name, image_id, flavor, key_name,
-                    security_groups, availability_zone, instance_count):
+                    security_groups, availability_zone, instance_count, client_token=None):
     """Create EC2 Instance using imported image"""
     LOG.debug("Create Instance : {} From Imported EC2 Image : {}".format(name, image_id))
     return ec2.create_instance(request, name, image_id, flavor, key_name,
-                               security_groups, availability_zone, instance_count)
+                               security_groups, availability_zone, instance_count,
+                               client_token)
 
 
 def delete_s3_object(request, object_name):
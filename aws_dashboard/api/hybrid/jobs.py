@@ -0,0 +1,531 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Background jobs of the import/export task flows.
+
+A migration runs for an hour or more, far longer than a web request may
+hold a WSGI worker. The REST API only records the job in a SQLite store
+and returns its id; ``manage.py aws_job_worker`` processes, running outside
+the web server, claim queued jobs and run their task flow, reporting the
+status of each stage back to the store.
+
+Each stage saves its outputs (snapshot id, local file, S3 key, import
+task id, AMI id...) when it completes, and long stages checkpoint the id
+of what they wait for as soon as they have it. A job which failed, or whose
+worker died, resumes at its first incomplete stage instead of starting
+over.
+
+Workers never see the token of the submitting user. A job records the
+user, project and region, and a Keystone trust from the user to the
+AWS_JOB_SERVICE_AUTH service user; the worker authenticates as that user
+scoped to the trust, and so acts for the submitter with its roles on the
+project. The store is created in a directory private to the Horizon user,
+readable by it only.
+"""
+import contextlib
+import datetime
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from keystoneauth1.identity import v3
+from keystoneauth1 import session as ks_session
+from openstack_auth import user as auth_user
+from openstack_dashboard.api import base
+from openstack_dashboard.api import keystone
+
+LOG = logging.getLogger(__name__)
+AWS_JOB_DB_PATH = getattr(settings, "AWS_JOB_DB_PATH",
+                          os.path.join(getattr(settings, "IMAGE_TASK_WORKING_PATH", "/tmp"),
+                                       "aws_dashboard_jobs", "jobs.sqlite3"))
+# keystoneauth1 v3.Password arguments of the user the workers act as
+AWS_JOB_SERVICE_AUTH = getattr(settings, "AWS_JOB_SERVICE_AUTH", None)
+# Days a job may be run or resumed after it is submitted
+AWS_JOB_TRUST_LIFETIME = getattr(settings, "AWS_JOB_TRUST_LIFETIME", 7)
+AWS_JOB_MAX_ATTEMPTS = getattr(settings, "AWS_JOB_MAX_ATTEMPTS", 3)
+AWS_JOB_RETRY_DELAY = getattr(settings, "AWS_JOB_RETRY_DELAY", 60)
+AWS_JOB_HEARTBEAT_INTERVAL = getattr(settings, "AWS_JOB_HEARTBEAT_INTERVAL", 60)
+AWS_JOB_STALE_TIMEOUT = getattr(settings, "AWS_JOB_STALE_TIMEOUT", 600)
+
+QUEUED = "queued"
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# Task flow run for each job type, called as func(request, job=job, **kwargs).
+JOB_TYPES = {
+    "import_instance": "aws_dashboard.api.hybrid.taskflow.run_import_instance_tasks",
+    "export_instance": "aws_dashboard.api.hybrid.taskflow.run_export_instance_tasks",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    job_type TEXT NOT NULL,
+    project_id TEXT NOT NULL,
+    name TEXT,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_project ON jobs (project_id, created_at);
+CREATE TABLE IF NOT EXISTS stages (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    message TEXT,
+    outputs TEXT,
+    started_at REAL,
+    finished_at REAL,
+    PRIMARY KEY (job_id, name)
+);
+"""
+
+
+class JobError(Exception):
+    pass
+
+
+class Job(base.APIDictWrapper):
+    _attrs = ["id", "job_type", "project_id", "name", "status", "result", "error",
+              "worker", "attempts", "created_at", "updated_at", "stages"]
+
+    @property
+    def current_stage(self):
+        for stage in self.stages:
+            if stage["status"] != COMPLETED:
+                return stage
+        return None
+
+
+class JobStore(object):
+    """Jobs and stages in a SQLite database shared by web and workers."""
+
+    def __init__(self, path=AWS_JOB_DB_PATH):
+        self.path = path
+        self._initialized = False
+
+    @contextlib.contextmanager
+    def _connect(self, immediate=False):
+        # One connection per call: sqlite3 connections are not shared
+        # between threads.
+        if not self._initialized:
+            self._prepare_path()
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            if not self._initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SCHEMA)
+                self._initialized = True
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def _prepare_path(self):
+        """Create the database, readable by this user only, in a private directory."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        stat = os.stat(directory)
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+            raise JobError("Job store directory %s must be owned by this user and "
+                           "not writable by others" % directory)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+
+    def create(self, job_type, project_id, name, payload, stage_names):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT INTO jobs (id, job_type, project_id, name, status, payload, "
+                         "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (job_id, job_type, project_id, name, QUEUED, json.dumps(payload),
+                          now, now))
+            conn.executemany("INSERT INTO stages (job_id, position, name, status) "
+                             "VALUES (?, ?, ?, ?)",
+                             [(job_id, i, s, PENDING) for i, s in enumerate(stage_names)])
+        return job_id
+
+    def _to_job(self, conn, row):
+        job = dict((k, row[k]) for k in row.keys() if k != "payload")
+        job["stages"] = []
+        for stage in conn.execute("SELECT name, status, message, outputs, started_at, "
+                                  "finished_at FROM stages WHERE job_id = ? "
+                                  "ORDER BY position", (row["id"],)):
+            stage = dict(stage)
+            stage["outputs"] = json.loads(stage["outputs"] or "{}")
+            job["stages"].append(stage)
+        return Job(job)
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return self._to_job(conn, row) if row else None
+
+    def list(self, project_id, limit=100):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM jobs WHERE project_id = ? "
+                                "ORDER BY created_at DESC LIMIT ?", (project_id, limit))
+            return [self._to_job(conn, row) for row in rows.fetchall()]
+
+    def claim(self, worker, stale_timeout=AWS_JOB_STALE_TIMEOUT):
+        """Mark the oldest runnable job as running by the worker.
+
+        Runnable are the queued jobs due to run, and the running jobs
+        without heartbeat for ``stale_timeout`` seconds, whose worker died.
+        Returns a tuple of the job and its payload, or None.
+        """
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE (status = ? AND run_after <= ?) "
+                               "OR (status = ? AND updated_at < ?) "
+                               "ORDER BY created_at LIMIT 1",
+                               (QUEUED, now, RUNNING, now - stale_timeout)).fetchone()
+            if row is None:
+                return None
+            if row["status"] == RUNNING:
+                LOG.warning("Resume Stale Job : %s (worker %s)" % (row["id"], row["worker"]))
+            conn.execute("UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, "
+                         "updated_at = ? WHERE id = ?", (RUNNING, worker, now, row["id"]))
+            job = self._to_job(conn, conn.execute("SELECT * FROM jobs WHERE id = ?",
+                                                  (row["id"],)).fetchone())
+        return job, json.loads(row["payload"])
+
+    def update_stage(self, job_id, name, status, message=None):
+        now = time.time()
+        with self._connect() as conn:
+            if status == RUNNING:
+                conn.execute("UPDATE stages SET status = ?, message = ?, started_at = ? "
+                             "WHERE job_id = ? AND name = ?",
+                             (status, message, now, job_id, name))
+            else:
+                conn.execute("UPDATE stages SET status = ?, message = ?, finished_at = ? "
+                             "WHERE job_id = ? AND name = ?",
+                             (status, message, now, job_id, name))
+            conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (now, job_id))
+
+    def save_outputs(self, job_id, name, outputs):
+        """Merge ``outputs`` into the saved outputs of a stage."""
+        with self._connect(immediate=True) as conn:
+            row = conn.execute("SELECT outputs FROM stages WHERE job_id = ? AND name = ?",
+                               (job_id, name)).fetchone()
+            saved = json.loads(row["outputs"] or "{}") if row else {}
+            saved.update(outputs)
+            conn.execute("UPDATE stages SET outputs = ? WHERE job_id = ? AND name = ?",
+                         (json.dumps(saved), job_id, name))
+
+    def heartbeat(self, job_id):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def finish(self, job_id, status, result=None, error=None):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? "
+                         "WHERE id = ?", (status, result, error, time.time(), job_id))
+
+    def retry(self, job_id, error, delay):
+        """Queue a failed job again to resume after ``delay`` seconds."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, run_after = ?, updated_at = ? "
+                         "WHERE id = ?", (QUEUED, error, now + delay, now, job_id))
+
+    def resume(self, job_id, user, trust_id):
+        """Queue a failed job again with a fresh set of attempts, run as ``user``."""
+        with self._connect(immediate=True) as conn:
+            row = conn.execute("SELECT payload FROM jobs WHERE id = ? AND status = ?",
+                               (job_id, FAILED)).fetchone()
+            if row is None:
+                return False
+            payload = json.loads(row["payload"])
+            payload.update(user=user, trust_id=trust_id)
+            conn.execute("UPDATE jobs SET status = ?, error = NULL, attempts = 0, "
+                         "run_after = 0, payload = ?, updated_at = ? WHERE id = ?",
+                         (QUEUED, json.dumps(payload), time.time(), job_id))
+            return True
+
+
+STORE = JobStore()
+
+
+def enabled():
+    """Whether jobs can be run, i.e. AWS_JOB_SERVICE_AUTH is set.
+
+    Without it, import/export flows run inside the request.
+    """
+    return bool(AWS_JOB_SERVICE_AUTH)
+
+
+def _keystone_session():
+    insecure = getattr(settings, "OPENSTACK_SSL_NO_VERIFY", False)
+    cacert = getattr(settings, "OPENSTACK_SSL_CACERT", None)
+    return ks_session.Session(verify=not insecure and (cacert or True))
+
+
+def _service_auth(**kwargs):
+    if not AWS_JOB_SERVICE_AUTH:
+        raise JobError("AWS_JOB_SERVICE_AUTH is not set, jobs cannot be run")
+    auth_kwargs = dict(AWS_JOB_SERVICE_AUTH)
+    auth_kwargs.update(kwargs)
+    return v3.Password(**auth_kwargs)
+
+
+_trustee = {}
+
+
+def _trustee_id():
+    """Id of the AWS_JOB_SERVICE_AUTH user."""
+    if "id" not in _trustee:
+        _trustee["id"] = _keystone_session().get_user_id(auth=_service_auth())
+    return _trustee["id"]
+
+
+def create_trust(request):
+    """Trust of the request's user to the service user, on its project and roles."""
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(days=AWS_JOB_TRUST_LIFETIME)
+    trust = keystone.keystoneclient(request).trusts.create(
+        trustee_user=_trustee_id(), trustor_user=request.user.id,
+        project=request.user.tenant_id,
+        role_names=[role["name"] for role in request.user.roles],
+        impersonation=True, expires_at=expires_at)
+    return trust.id
+
+
+def authenticate(payload):
+    """User of a job, authenticated as the service user through its trust."""
+    auth = _service_auth(trust_id=payload["trust_id"])
+    auth_ref = auth.get_auth_ref(_keystone_session())
+    user = payload["user"]
+    if auth_ref.project_id != user["project_id"] or auth_ref.user_id != user["id"]:
+        raise JobError("Trust of job does not match its user and project")
+    return auth_user.create_user_from_token(None, auth_user.Token(auth_ref),
+                                            AWS_JOB_SERVICE_AUTH["auth_url"],
+                                            services_region=user["region"])
+
+
+def _job_user(request):
+    return {"id": request.user.id, "project_id": request.user.tenant_id,
+            "region": request.user.services_region}
+
+
+class JobRequest(object):
+    """Stand-in of the submitting request inside a worker.
+
+    The OpenStack and AWS API helpers only use the user (token, project and
+    service catalog) and the submitted data of a request. The user is the
+    one of authenticate, not the submitting session.
+    """
+
+    def __init__(self, user, data):
+        self.user = user
+        self.DATA = data
+        self.session = {}
+        self.META = {}
+
+
+class BaseJob(object):
+    """Stage bookkeeping of a task flow run.
+
+    ``id`` is the same on every attempt of the run, for idempotency tokens.
+    """
+
+    def _get_stage(self, name):
+        raise NotImplementedError
+
+    def _update_stage(self, name, status, message=None):
+        raise NotImplementedError
+
+    def checkpoint(self, name, **outputs):
+        """Save outputs of a stage before it completes.
+
+        A resumed stage finds them in its state, e.g. the id of the AWS
+        task it was waiting for.
+        """
+        raise NotImplementedError
+
+    def run_stages(self, request, flow, state):
+        """Run the ``(name, func)`` stages of ``flow`` in order.
+
+        ``func(request, job, state)`` returns the outputs of the stage,
+        which are saved and merged into ``state`` for the next stages.
+        Completed stages are skipped, with their saved outputs.
+        """
+        for name, func in flow:
+            stage = self._get_stage(name) or {}
+            state.update(stage.get("outputs", {}))
+            if stage.get("status") == COMPLETED:
+                LOG.debug("Skip Completed Stage : %s" % name)
+                continue
+            self._update_stage(name, RUNNING)
+            try:
+                outputs = func(request, self, state) or {}
+                self.checkpoint(name, **outputs)
+            except Exception as e:
+                self._update_stage(name, FAILED, str(e))
+                raise
+            state.update(outputs)
+            self._update_stage(name, COMPLETED)
+        return state
+
+
+class InlineJob(BaseJob):
+    """Stages of a task flow run inside the calling process."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.stages = {}
+
+    def _get_stage(self, name):
+        return self.stages.get(name)
+
+    def _update_stage(self, name, status, message=None):
+        self.stages.setdefault(name, {"outputs": {}}).update(status=status, message=message)
+
+    def checkpoint(self, name, **outputs):
+        self.stages.setdefault(name, {"outputs": {}})["outputs"].update(outputs)
+
+
+class RunningJob(BaseJob):
+    """Stages of a job run by a worker, saved in the job store."""
+
+    def __init__(self, job, store=STORE):
+        self.id = job.id
+        self.store = store
+        self.stages = dict((s["name"], s) for s in job.stages)
+
+    def _get_stage(self, name):
+        return self.stages.get(name)
+
+    def _update_stage(self, name, status, message=None):
+        self.store.update_stage(self.id, name, status, message)
+
+    def checkpoint(self, name, **outputs):
+        self.store.save_outputs(self.id, name, outputs)
+
+
+class Heartbeat(threading.Thread):
+    """Keep a running job from looking stale to the other workers."""
+
+    def __init__(self, job_id, store=STORE, interval=AWS_JOB_HEARTBEAT_INTERVAL):
+        super(Heartbeat, self).__init__(name="job-heartbeat-%s" % job_id)
+        self.daemon = True
+        self.job_id = job_id
+        self.store = store
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.store.heartbeat(self.job_id)
+            except Exception as e:
+                LOG.warning("Job heartbeat failed : %s (%s)" % (self.job_id, e))
+
+    def stop(self):
+        self.stopped.set()
+
+
+def submit(request, job_type, job_name, stage_names, **kwargs):
+    """Queue a job for the workers and return its id.
+
+    ``kwargs`` are the arguments of the JOB_TYPES task flow. Only ids of
+    the user are stored, along with a trust for the workers, see
+    authenticate.
+    """
+    payload = {"user": _job_user(request), "trust_id": create_trust(request),
+               "data": request.DATA, "kwargs": kwargs}
+    job_id = STORE.create(job_type, request.user.tenant_id, job_name, payload, stage_names)
+    LOG.debug("Submit Job : %s %s (%s)" % (job_type, job_id, job_name))
+    return job_id
+
+
+def get_job(request, job_id):
+    """Get a job of the request's project, or None."""
+    job = STORE.get(job_id)
+    if job is None or job.project_id != request.user.tenant_id:
+        return None
+    return job
+
+
+def list_jobs(request, limit=100):
+    return STORE.list(request.user.tenant_id, limit)
+
+
+def worker_name():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def resume_job(request, job_id):
+    """Queue a failed job of the request's project to resume.
+
+    The job is run as the resuming user, with a new trust: the first one
+    may have expired.
+    """
+    job = get_job(request, job_id)
+    return job is not None and STORE.resume(job_id, _job_user(request),
+                                            create_trust(request))
+
+
+def run(job, payload, store=STORE):
+    """Run a claimed job and record the outcome.
+
+    A failed job is queued again to resume after AWS_JOB_RETRY_DELAY
+    seconds per attempt, up to AWS_JOB_MAX_ATTEMPTS attempts.
+    """
+    start_time = time.time()
+    LOG.debug("Start Job : %s %s (attempt %d)" % (job.job_type, job.id, job.attempts))
+    heartbeat = Heartbeat(job.id, store)
+    heartbeat.start()
+    try:
+        func = import_string(JOB_TYPES[job.job_type])
+        request = JobRequest(authenticate(payload), payload["data"])
+        result = func(request, job=RunningJob(job, store), **payload["kwargs"])
+    except Exception as e:
+        LOG.exception("Job Fail : %s" % job.id)
+        if job.attempts < AWS_JOB_MAX_ATTEMPTS:
+            store.retry(job.id, str(e), AWS_JOB_RETRY_DELAY * job.attempts)
+        else:
+            store.finish(job.id, FAILED, error=str(e))
+        return False
+    finally:
+        heartbeat.stop()
+    store.finish(job.id, COMPLETED, result=str(getattr(result, "id", result)))
+    LOG.debug("Complete Job : %s. Duration : %.1f min."
+              % (job.id, (time.time() - start_time) / 60))
+    return True
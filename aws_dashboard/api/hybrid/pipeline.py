@@ -0,0 +1,225 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Convert an image to raw and upload it to S3 at the same time.
+
+qemu-img creates the raw output at its full (sparse) size and writes it in
+order, leaving holes where the image holds zeros. Its progress counts the
+sectors processed, not an offset of the output, so the watermark is taken
+from the output itself: the end of its last data extent (SEEK_DATA and
+SEEK_HOLE), less a margin for the writes in flight. Everything below it is
+final, data or hole. The pipeline reads the output up to that watermark in
+parts and feeds them to a multipart upload while qemu-img goes on, which
+makes the stage take about as long as the slower of the conversion and the
+upload instead of both. Where the file system does not report holes, see
+holes_supported, the caller converts then uploads.
+
+When the upload falls more than AWS_PIPELINE_MAX_LEAD bytes behind,
+qemu-img is paused (SIGSTOP) until the upload catches up, and uploaded
+ranges are punched out of the output file, so the scratch space used stays
+bounded whatever the speed of the link.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import signal
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+
+from aws_dashboard.api.hybrid import convert
+
+LOG = logging.getLogger(__name__)
+AWS_PIPELINE_MAX_LEAD = getattr(settings, "AWS_PIPELINE_MAX_LEAD", 2 * 1024 * 1024 * 1024)
+# Data qemu-img may still have in flight below the end of its last write.
+PROGRESS_MARGIN = 64 * 1024 * 1024
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+ConversionError = convert.ConversionError
+
+
+def get_virtual_size(file_path):
+    return convert.image_info(file_path)["virtual-size"]
+
+
+def holes_supported(directory):
+    """Whether files of ``directory`` report their holes to SEEK_DATA.
+
+    Elsewhere a sparse file reads as data all along, and the watermark
+    would run ahead of qemu-img.
+    """
+    if getattr(os, "SEEK_DATA", None) is None:
+        return False
+    try:
+        with tempfile.TemporaryFile(dir=directory) as probe:
+            probe.truncate(1024 * 1024)
+            os.lseek(probe.fileno(), 0, os.SEEK_DATA)
+    except (IOError, OSError) as e:
+        # ENXIO : no data at all, the file is a hole.
+        return e.errno == errno.ENXIO
+    return False
+
+
+def data_end(fd, offset, size):
+    """End of the last data extent of the file at or after ``offset``.
+
+    Returns ``offset`` when only holes follow it.
+    """
+    end = offset
+    while end < size:
+        try:
+            start = os.lseek(fd, end, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+    return end
+
+
+def _load_fallocate():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    return fallocate
+
+
+_fallocate = _load_fallocate()
+
+
+def punch_hole(fd, offset, length):
+    """Free the disk blocks of a range of the file, if the OS supports it."""
+    if _fallocate is None:
+        return
+    if _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        LOG.debug("Punch hole not supported : errno %d" % ctypes.get_errno())
+
+
+class ConvertUploadPipeline(object):
+    """Convert ``source_path`` to raw and upload it with a MultipartUploader."""
+
+    def __init__(self, source_path, output_path, uploader, virtual_size=None,
+                 max_lead=AWS_PIPELINE_MAX_LEAD):
+        self.source_path = source_path
+        self.output_path = output_path
+        self.uploader = uploader
+        # Paused below the margin, qemu-img would never be resumed.
+        self.max_lead = max(max_lead, 2 * (PROGRESS_MARGIN + 2 * uploader.part_size))
+        self.virtual_size = virtual_size
+        self.paused = False
+        # End of the data qemu-img has written so far
+        self.converted = 0
+        self._process = None
+        self._reader = None
+
+    def run(self):
+        """Run the pipeline and return the number of bytes uploaded."""
+        start_time = time.time()
+        if self.virtual_size is None:
+            self.virtual_size = get_virtual_size(self.source_path)
+        LOG.debug("Start Convert And Upload : %s (%d MB)"
+                  % (self.source_path, self.virtual_size // (1024 * 1024)))
+        # The watermark needs the output written in order.
+        cmd = convert.build_command(self.source_path, self.output_path, "raw",
+                                    out_of_order=False)
+        self._process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._reader = convert.ProgressReader(self._process.stdout)
+        self._reader.start()
+        try:
+            self.uploader.start()
+            self._upload()
+            self.uploader.complete()
+        except Exception:
+            self._kill()
+            self.uploader.abort()
+            raise
+        finally:
+            self._reader.join(5)
+            if os.path.exists(self.output_path):
+                os.remove(self.output_path)
+        LOG.debug("Complete Convert And Upload : %s (%.1f sec)"
+                  % (self.source_path, time.time() - start_time))
+        return self.uploader.bytes_sent
+
+    def _watermark(self, output):
+        returncode = self._process.poll()
+        if returncode is None:
+            # Uploaded ranges are punched out, scan on from the last end seen.
+            self.converted = data_end(output.fileno(), self.converted, self.virtual_size)
+            return max(self.converted - PROGRESS_MARGIN, 0)
+        self._check_exit()
+        return self.virtual_size
+
+    def _check_exit(self):
+        returncode = self._process.poll()
+        if returncode:
+            raise ConversionError("qemu-img convert failed (%d) : %s"
+                                  % (returncode, " ".join(self._reader.output)))
+
+    def _throttle(self, uploaded):
+        lead = self.converted - uploaded
+        if not self.paused and lead > self.max_lead:
+            LOG.debug("Pause Conversion : %d MB ahead of upload" % (lead // (1024 * 1024)))
+            self._signal(signal.SIGSTOP)
+            self.paused = True
+        elif self.paused and lead < self.max_lead // 2:
+            self._signal(signal.SIGCONT)
+            self.paused = False
+
+    def _signal(self, signum):
+        if self._process.poll() is None:
+            self._process.send_signal(signum)
+
+    def _upload(self):
+        part_size = self.uploader.part_size
+        offset = 0
+        while not os.path.exists(self.output_path):
+            if self._process.poll() is not None:
+                self._check_exit()
+            time.sleep(0.1)
+        # Writable, to punch out the uploaded ranges.
+        with open(self.output_path, "r+b") as output:
+            while offset < self.virtual_size:
+                watermark = self._watermark(output)
+                self._throttle(offset)
+                length = min(part_size, self.virtual_size - offset)
+                if watermark - offset < length:
+                    time.sleep(0.2)
+                    continue
+                output.seek(offset)
+                data = output.read(length)
+                if len(data) != length:
+                    raise ConversionError("Short read of %s at %d" % (self.output_path, offset))
+                self.uploader.write(data)
+                punch_hole(output.fileno(), offset, length)
+                offset += length
+        if self.paused:
+            self._signal(signal.SIGCONT)
+        self._process.wait()
+        self._check_exit()
+
+    def _kill(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.send_signal(signal.SIGCONT)
+            self._process.kill()
+            self._process.wait()
@@ -0,0 +1,267 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shared status poller of the resources import/export jobs wait on.
+
+Instead of a sleep loop per job, a wait registers the resource id with the
+process-wide poller and blocks on a future. The poller thread checks the
+due waits of each resource type, project and user with one batched call
+(e.g. ``describe_import_image_tasks`` with every pending ImportTaskId),
+resolves the futures of the finished ones and backs the others off
+exponentially, with jitter so that waits started together do not stay in
+lockstep. When a wait is due, the batch also takes the waits of its group
+which are past half of their delay.
+"""
+from concurrent import futures
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from openstack_dashboard.api import glance
+from openstack_dashboard.api import nova
+
+from aws_dashboard.api import ec2
+from aws_dashboard.api import transport
+
+LOG = logging.getLogger(__name__)
+AWS_POLLER_BACKOFF = getattr(settings, "AWS_POLLER_BACKOFF", 2)
+AWS_POLLER_MAX_INTERVAL = getattr(settings, "AWS_POLLER_MAX_INTERVAL", 120)
+# Checks a resource may be missing from before its wait fails, since new
+# ones show up late in listings
+AWS_POLLER_MAX_MISSES = getattr(settings, "AWS_POLLER_MAX_MISSES", 3)
+
+IMPORT_IMAGE_TASK = "import_image_task"
+EXPORT_TASK = "export_task"
+GLANCE_IMAGE = "glance_image"
+EBS_SNAPSHOT = "ebs_snapshot"
+NOVA_SERVER = "nova_server"
+
+
+class WaitFailed(Exception):
+    pass
+
+
+class WaitTimeout(WaitFailed):
+    """The resource may still be on its way, unlike the other WaitFailed."""
+
+
+def _fetch_import_image_tasks(request, ids):
+    return dict((t.id, t) for t in transport.get_import_image_tasks(request, ids))
+
+
+def _fetch_export_tasks(request, ids):
+    return dict((t.id, t) for t in transport.get_export_tasks(request, ids))
+
+
+def _fetch_ebs_snapshots(request, ids):
+    return dict((s["SnapshotId"], s) for s in ec2.get_snapshots(request, ids))
+
+
+def _fetch_glance_images(request, ids):
+    images = glance.image_list_detailed(request, filters={"id": "in:%s" % ",".join(ids)})[0]
+    return dict((i.id, i) for i in images)
+
+
+def _fetch_nova_servers(request, ids):
+    # Nova has no filter on several ids: one listing of the project instead,
+    # and a lookup of the ids missing from it, e.g. past its page size.
+    servers = dict((s.id, s) for s in nova.server_list(request)[0] if s.id in ids)
+    for server_id in set(ids) - set(servers):
+        try:
+            servers[server_id] = nova.server_get(request, server_id)
+        except Exception as e:
+            if getattr(e, "code", None) != 404:
+                raise
+    return servers
+
+
+# resource: (fetch, state of an object, done states, failed states)
+RESOURCES = {
+    IMPORT_IMAGE_TASK: (_fetch_import_image_tasks, lambda t: t.state,
+                        ("completed",), ("deleting", "deleted")),
+    EXPORT_TASK: (_fetch_export_tasks, lambda t: t.state,
+                  ("completed",), ("cancelling", "cancelled")),
+    EBS_SNAPSHOT: (_fetch_ebs_snapshots, lambda s: s["State"],
+                   ("completed",), ("error",)),
+    GLANCE_IMAGE: (_fetch_glance_images, lambda i: i.status,
+                   ("active",), ("killed", "deleted", "pending_delete")),
+    NOVA_SERVER: (_fetch_nova_servers, lambda s: s.status,
+                  ("ACTIVE",), ("ERROR",)),
+}
+
+
+class _Wait(object):
+
+    def __init__(self, resource, request, resource_id, interval, timeout):
+        self.resource = resource
+        self.request = request
+        self.resource_id = resource_id
+        self.delay = interval
+        # Checked at ``due``, or with a batch from ``ready`` on.
+        self.due = self.ready = time.time()
+        self.deadline = time.time() + timeout if timeout else None
+        self.misses = 0
+        self.future = futures.Future()
+
+    @property
+    def group(self):
+        # Waits of a group are fetched with the credentials of one of them:
+        # only those of the same user and project.
+        user = self.request.user
+        return self.resource, user.tenant_id, user.id
+
+
+class Poller(threading.Thread):
+    """Poll the waits of the process in batches."""
+
+    def __init__(self, backoff=AWS_POLLER_BACKOFF, max_interval=AWS_POLLER_MAX_INTERVAL,
+                 max_misses=AWS_POLLER_MAX_MISSES):
+        super(Poller, self).__init__(name="aws-status-poller")
+        self.daemon = True
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.max_misses = max_misses
+        self._waits = []
+        self._cond = threading.Condition()
+        # Ids which failed their batch, fetched one by one from then on.
+        self._isolated = set()
+
+    def submit(self, resource, request, resource_id, interval, timeout=None):
+        """Register a wait and return the future of the resource.
+
+        The future gets the resource object once it reaches a done state,
+        or a WaitFailed exception.
+        """
+        wait = _Wait(resource, request, resource_id, interval, timeout)
+        with self._cond:
+            self._waits.append(wait)
+            self._cond.notify()
+        return wait.future
+
+    def wait(self, resource, request, resource_id, interval, timeout=None):
+        return self.submit(resource, request, resource_id, interval, timeout).result()
+
+    def run(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                groups = set(w.group for w in self._waits if w.due <= now)
+                due = [w for w in self._waits if w.group in groups and w.ready <= now]
+                if not due:
+                    if self._waits:
+                        self._cond.wait(min(w.due for w in self._waits) - now)
+                    else:
+                        self._cond.wait()
+                    continue
+            try:
+                self.poll(due)
+            except Exception:
+                LOG.exception("Status poller failed")
+
+    def poll(self, due):
+        groups = {}
+        for wait in due:
+            groups.setdefault(wait.group, []).append(wait)
+        for (resource, project_id, user_id), waits in groups.items():
+            found, errors = self._fetch(resource, waits)
+            with self._cond:
+                for wait in waits:
+                    self._check(wait, found, errors)
+
+    def _fetch(self, resource, waits):
+        """Get the objects of the waits, by id, and the fetch errors."""
+        fetch = RESOURCES[resource][0]
+        request = waits[-1].request
+        ids = set(w.resource_id for w in waits)
+        batch = sorted(ids - self._isolated)
+        found = {}
+        errors = {}
+        if batch:
+            try:
+                found.update(fetch(request, batch))
+            except Exception as e:
+                if len(batch) == 1:
+                    errors[batch[0]] = e
+                else:
+                    # One bad id fails the whole batch: find it.
+                    self._isolated.update(batch)
+        for resource_id in sorted(ids & self._isolated):
+            try:
+                found.update(fetch(request, [resource_id]))
+                self._isolated.discard(resource_id)
+            except Exception as e:
+                errors[resource_id] = e
+        return found, errors
+
+    def _check(self, wait, found, errors):
+        fetch, get_state, done, failed = RESOURCES[wait.resource]
+        now = time.time()
+        obj = found.get(wait.resource_id)
+        error = errors.get(wait.resource_id)
+        if obj is not None:
+            wait.misses = 0
+            state = get_state(obj)
+            LOG.debug("Poll %s %s : %s" % (wait.resource, wait.resource_id, state))
+            if state in done:
+                return self._resolve(wait, result=obj)
+            if state in failed:
+                return self._resolve(wait, error=WaitFailed(
+                    "%s %s is %s" % (wait.resource, wait.resource_id, state)))
+        elif error is None:
+            wait.misses += 1
+            if wait.misses >= self.max_misses:
+                return self._resolve(wait, error=WaitFailed(
+                    "%s %s not found" % (wait.resource, wait.resource_id)))
+            LOG.debug("Poll %s %s : not found yet" % (wait.resource, wait.resource_id))
+        else:
+            LOG.warning("Poll %s %s failed : %s" % (wait.resource, wait.resource_id, error))
+
+        if wait.deadline is not None and now > wait.deadline:
+            return self._resolve(wait, error=WaitTimeout(
+                "%s %s timed out" % (wait.resource, wait.resource_id)))
+        wait.delay = min(wait.delay * self.backoff, self.max_interval)
+        wait.ready = now + wait.delay / 2.0
+        wait.due = now + random.uniform(wait.delay / 2.0, wait.delay)
+
+    def _resolve(self, wait, result=None, error=None):
+        self._waits.remove(wait)
+        self._isolated.discard(wait.resource_id)
+        if error is not None:
+            wait.future.set_exception(error)
+        else:
+            wait.future.set_result(result)
+
+
+_poller = None
+_lock = threading.Lock()
+
+
+def get_poller():
+    global _poller
+    if _poller is None:
+        with _lock:
+            if _poller is None:
+                _poller = Poller()
+                _poller.start()
+    return _poller
+
+
+def wait_for(resource, request, resource_id, interval, timeout=None):
+    """Block until the resource is done and return it.
+
+    :param resource: IMPORT_IMAGE_TASK, EXPORT_TASK, GLANCE_IMAGE or NOVA_SERVER
+    :param interval: seconds before the second check, growing on each check
+    """
+    return get_poller().wait(resource, request, resource_id, interval, timeout)
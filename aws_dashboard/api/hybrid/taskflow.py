@@ -11,59 +11,425 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+"""Import and export instance task flows.
+
+A flow is a list of ``(name, func)`` stages run by jobs.BaseJob.run_stages.
+A stage reads what it needs from the flow state, the flow arguments and
+the outputs of the previous stages, and returns its own outputs: plain
+ids and paths, so a resumed job can pick up from the saved state. Stages
+waiting on a snapshot, an AWS task or a Glance upload checkpoint its id
+first, and wait on the same one when resumed, unless it failed.
+
+Imports go through S3 and EC2 import_image by default. With
+AWS_IMPORT_ENGINE = "ebs" the raw image is written straight into an EBS
+snapshot with the EBS direct APIs and registered as an AMI instead. No
+driver is installed in the guest then, as import_image would: it has to
+be ready for Nitro instances, see import_task.ami_boot_options.
+Likewise, AWS_EXPORT_ENGINE = "ebs" exports a snapshot of the root volume
+read with the EBS direct APIs instead of an EC2 export task through S3.
+"""
+import contextlib
 import logging
+import os
 import time
 
 from django.conf import settings
+from openstack_dashboard.api import glance
 
+from aws_dashboard.api.hybrid import formats
+from aws_dashboard.api.hybrid import jobs
+from aws_dashboard.api.hybrid import pipeline
+from aws_dashboard.api.hybrid import poller
 from aws_dashboard.api.hybrid import utils
 import aws_dashboard.api.hybrid.import_instance_tasks as import_task
 import aws_dashboard.api.hybrid.export_instance_tasks as export_task
 
 LOG = logging.getLogger(__name__)
 OPENSTACK_IMAGE_FORMAT = getattr(settings, "OPENSTACK_IMAGE_FORMAT", "qcow2")
-CONVERT_IMAGE_FORMAT = getattr(settings, "CONVERT_IMAGE_FORMAT", "raw")
 IMAGE_TASK_WORKING_PATH = getattr(settings, "IMAGE_TASK_WORKING_PATH", "/tmp")
 STATUS_CHECK_INTERVAL = getattr(settings, "STATUS_CHECK_INTERVAL", 10)
+AWS_PIPELINE_CONVERT_UPLOAD = getattr(settings, "AWS_PIPELINE_CONVERT_UPLOAD", True)
+S3_ENGINE = "s3"
+EBS_ENGINE = "ebs"
+AWS_IMPORT_ENGINE = getattr(settings, "AWS_IMPORT_ENGINE", S3_ENGINE)
+AWS_EXPORT_ENGINE = getattr(settings, "AWS_EXPORT_ENGINE", S3_ENGINE)
 
 
-def run_import_instance_tasks(request, source_type, source_id, flavor, key_name,
-                              security_groups, availability_zone, instance_count,
-                              leave_original_instance, leave_instance_snapshot):
-    """Import instance task flow"""
-    start_time = time.time()
-    LOG.debug("Start Import Instance. Receive Data : {}".format(request.DATA))
+def _convert_progress(job, name):
+    """Progress callback saving the conversion percentage, every 5%."""
+    saved = [None]
+
+    def progress(percent):
+        percent = int(percent) // 5 * 5
+        if percent != saved[0]:
+            saved[0] = percent
+            job.checkpoint(name, convert_percent=percent)
+    return progress
+
+
+def _transfer_report(job, name, key):
+    """Report callback saving the S3 transfer plan and measures as ``key``."""
+    def report(result):
+        job.checkpoint(name, **{key: result})
+    return report
+
+
+@contextlib.contextmanager
+def _restart_if_failed(job, name, key):
+    """Clear the checkpointed id ``key`` of a stage if what it names failed.
+
+    The next attempt then starts a new snapshot or task instead of waiting
+    on the failed one again.
+    """
+    try:
+        yield
+    except poller.WaitTimeout:
+        raise
+    except poller.WaitFailed:
+        job.checkpoint(name, **{key: None})
+        raise
+
+
+# Import stages
+
+
+def _create_snapshot(request, job, state):
+    snapshot_id = state.get("snapshot_id")
+    if snapshot_id is None:
+        snapshot_id = import_task.start_snapshot(request, state["source_id"])
+        job.checkpoint("create_snapshot", snapshot_id=snapshot_id)
+    with _restart_if_failed(job, "create_snapshot", "snapshot_id"):
+        image = import_task.wait_snapshot(request, snapshot_id, STATUS_CHECK_INTERVAL)
+    return {"snapshot_id": image.id, "image_name": image.name}
+
+
+def _download_snapshot(request, job, state):
+    image = glance.image_get(request, state["snapshot_id"])
+    if formats.is_glance_import_ready(image, formats.forced_import_format()):
+        # Nothing to convert: stream the image from Glance to S3.
+        size = import_task.stream_image_to_s3(
+            request, image, state["image_name"],
+            _transfer_report(job, "download_image", "s3_upload"))
+        return {"uploaded": True, "size_gb": size, "import_format": image.disk_format}
+    return _download_image_file(request, job, image)
+
+
+def _download_image_file(request, job, image):
+    def progress(downloaded, rate):
+        job.checkpoint("download_image", downloaded_bytes=downloaded,
+                       download_bytes_per_sec=int(rate))
+
+    return {"file_path": import_task.download_image(request, image, IMAGE_TASK_WORKING_PATH,
+                                                    progress)}
+
+
+def _convert_to_import_format(request, job, state):
+    if state.get("uploaded"):
+        return
+    file_path = state["file_path"]
+    import_format = state.get("import_format")
+    if import_format is None:
+        import_format = formats.negotiate_import_format(file_path)
+        job.checkpoint("convert_image", import_format=import_format)
+    if formats.is_import_ready(file_path, import_format):
+        return {"converted_path": file_path, "import_format": import_format}
+    if AWS_PIPELINE_CONVERT_UPLOAD and import_format == "raw" and \
+            pipeline.holes_supported(IMAGE_TASK_WORKING_PATH):
+        # Upload the raw output while qemu-img writes it.
+        size = import_task.convert_and_upload_to_s3(
+            request, file_path, state["image_name"],
+            report=_transfer_report(job, "convert_image", "s3_upload"))
+        return {"uploaded": True, "size_gb": size, "import_format": import_format}
+    return {"converted_path": import_task.convert_image_format(
+        file_path, import_format, progress=_convert_progress(job, "convert_image")),
+        "import_format": import_format}
+
+
+def _upload_to_s3(request, job, state):
+    if state.get("uploaded"):
+        size = state["size_gb"]
+    else:
+        converted_path = state["converted_path"]
+        import_task.upload_to_s3(request, converted_path, state["image_name"],
+                                 _transfer_report(job, "upload_to_s3", "s3_upload"))
+        size = utils.get_file_size_gb(converted_path)
+    # The local image and the snapshot go in the cleanup stage, once the
+    # upload is saved: a retry may still need them.
+    return {"s3_key": state["image_name"], "size_gb": size}
+
+
+def _import_image(request, job, state):
+    task_id = state.get("import_task_id")
+    if task_id is None:
+        task_id = import_task.start_import_image(request, state["s3_key"], state["size_gb"],
+                                                 state.get("import_format", "raw"))
+        job.checkpoint("import_image", import_task_id=task_id)
+    with _restart_if_failed(job, "import_image", "import_task_id"):
+        task = import_task.wait_import_image(request, task_id, STATUS_CHECK_INTERVAL)
+    return {"import_task_id": task_id,
+            "ami_id": task.get("ImageId"),
+            "ami_name": task.get("Description")}
+
+
+def _create_ec2_instance(request, job, state):
+    # Same token on every attempt: a retry gets the instances of the first
+    # run_instances call instead of launching more.
+    instance_id = import_task.create_instance(request=request,
+                                              name=state["ami_name"],
+                                              image_id=state["ami_id"],
+                                              flavor=state["flavor"],
+                                              key_name=state["key_name"],
+                                              security_groups=state["security_groups"],
+                                              availability_zone=state["availability_zone"],
+                                              instance_count=state["instance_count"],
+                                              client_token="%s-instance" % job.id)
+    return {"instance_id": instance_id}
+
+
+def _delete_import_sources(request, job, state):
+    """Delete the local image and the instance snapshot, once each."""
+    converted_path = state.get("converted_path")
+    if converted_path and os.path.exists(converted_path):
+        import_task.delete_file(converted_path)
+    if state["source_type"] == "instance" and not state["leave_instance_snapshot"] and \
+            not state.get("snapshot_deleted"):
+        import_task.delete_original_snapshot(request, glance.image_get(request,
+                                                                       state["snapshot_id"]))
+        job.checkpoint("cleanup", snapshot_deleted=True)
+
+
+def _import_cleanup(request, job, state):
+    _delete_import_sources(request, job, state)
+    import_task.delete_s3_object(request, state["s3_key"])
+
+    if state["source_type"] == "instance" and not state["leave_original_instance"]:
+        import_task.delete_original_instance(request, state["source_id"])
+
+
+S3_IMPORT_FLOW = [
+    ("create_snapshot", _create_snapshot),
+    ("download_image", _download_snapshot),
+    ("convert_image", _convert_to_import_format),
+    ("upload_to_s3", _upload_to_s3),
+    ("import_image", _import_image),
+    ("create_instance", _create_ec2_instance),
+    ("cleanup", _import_cleanup),
+]
+
+
+# EBS import stages
+
+
+def _download_snapshot_file(request, job, state):
+    image = glance.image_get(request, state["snapshot_id"])
+    # Checked before the download, the AMI is registered from them.
+    boot_options = import_task.ami_boot_options(image)
+    outputs = _download_image_file(request, job, image)
+    outputs["ami_boot_options"] = boot_options
+    return outputs
+
+
+def _convert_to_raw(request, job, state):
+    file_path = state["file_path"]
+    if formats.is_import_ready(file_path, "raw"):
+        return {"converted_path": file_path}
+    return {"converted_path": import_task.convert_image_format(
+        file_path, "raw", progress=_convert_progress(job, "convert_image"))}
+
+
+def _write_ebs_snapshot(request, job, state):
+    if state.get("ebs_snapshot_id") is not None:
+        return
+    written = import_task.write_to_ebs_snapshot(request, state["converted_path"],
+                                                state["image_name"])
+    # Saved at once, the local image and the snapshot go in the cleanup stage.
+    outputs = {"ebs_snapshot_id": written["snapshot_id"], "size_gb": written["volume_size"],
+               "ebs_write": written}
+    job.checkpoint("write_ebs_snapshot", **outputs)
+    return outputs
+
+
+def _register_ebs_image(request, job, state):
+    ami_id = import_task.register_ebs_image(request, state["image_name"],
+                                            state["ebs_snapshot_id"], STATUS_CHECK_INTERVAL,
+                                            state.get("ami_boot_options"))
+    return {"ami_id": ami_id, "ami_name": state["image_name"]}
 
-    image = import_task.create_snapshot(request, source_id, STATUS_CHECK_INTERVAL)
 
-    file_path = import_task.download_image(request, image, IMAGE_TASK_WORKING_PATH)
-    new_file_path = import_task.convert_image_format(file_path, CONVERT_IMAGE_FORMAT)
-    import_task.upload_to_s3(request, new_file_path, image.name)
-    size = utils.get_file_size_gb(new_file_path)
-    import_task.delete_file(new_file_path)
+def _ebs_import_cleanup(request, job, state):
+    _delete_import_sources(request, job, state)
+    if state["source_type"] == "instance" and not state["leave_original_instance"]:
+        import_task.delete_original_instance(request, state["source_id"])
 
-    if source_type == "instance" and not leave_instance_snapshot:
-        import_task.delete_original_snapshot(request, image)
 
-    import_image = import_task.import_image(request, image.name, size,
-                                            CONVERT_IMAGE_FORMAT, STATUS_CHECK_INTERVAL)
-    new_instance = import_task.create_instance(request=request,
-                                               name=import_image.get("Description"),
-                                               image_id=import_image.get("ImageId"),
-                                               flavor=flavor,
-                                               key_name=key_name,
-                                               security_groups=security_groups,
-                                               availability_zone=availability_zone,
-                                               instance_count=instance_count)
-    import_task.delete_s3_object(request, image.name)
+EBS_IMPORT_FLOW = [
+    ("create_snapshot", _create_snapshot),
+    ("download_image", _download_snapshot_file),
+    ("convert_image", _convert_to_raw),
+    ("write_ebs_snapshot", _write_ebs_snapshot),
+    ("register_image", _register_ebs_image),
+    ("create_instance", _create_ec2_instance),
+    ("cleanup", _ebs_import_cleanup),
+]
 
-    if source_type == "instance" and not leave_original_instance:
-        import_task.delete_original_instance(request, source_id)
+IMPORT_FLOW = EBS_IMPORT_FLOW if AWS_IMPORT_ENGINE == EBS_ENGINE else S3_IMPORT_FLOW
+IMPORT_STAGES = tuple(name for name, func in IMPORT_FLOW)
+
+
+# Export stages
+
+
+def _export_instance(request, job, state):
+    task_id = state.get("export_task_id")
+    export_format = state.get("export_format", formats.DEFAULT_EXPORT_FORMAT)
+    if task_id is None:
+        export_format = formats.negotiate_export_format()
+        task_id = export_task.start_export_instance(request, state["source_id"], state["name"],
+                                                    export_format)
+        job.checkpoint("export_instance", export_task_id=task_id, export_format=export_format)
+    with _restart_if_failed(job, "export_instance", "export_task_id"):
+        task = export_task.wait_export_task(request, task_id, STATUS_CHECK_INTERVAL)
+    return {"export_task_id": task_id,
+            "export_format": export_format,
+            "s3_key": task.get("ExportToS3Task").get("S3Key")}
+
+
+def _download_from_s3(request, job, state):
+    return {"download_path": export_task.download_image_from_s3(
+        request, state["s3_key"], IMAGE_TASK_WORKING_PATH,
+        _transfer_report(job, "download_from_s3", "s3_download"))}
+
+
+def _convert_to_openstack_format(request, job, state):
+    export_format = state.get("export_format", formats.DEFAULT_EXPORT_FORMAT)
+    if formats.is_openstack_ready(export_format):
+        return {"converted_path": state["download_path"], "glance_format": export_format}
+    return {"converted_path": export_task.convert_image_format(
+        state["download_path"], OPENSTACK_IMAGE_FORMAT,
+        progress=_convert_progress(job, "convert_image")),
+        "glance_format": OPENSTACK_IMAGE_FORMAT}
+
+
+def _upload_to_glance(request, job, state):
+    image_id = state.get("glance_image_id")
+    if image_id is None:
+        image = export_task.create_glance_image(
+            request, state.get("image_name") or state["s3_key"], state["converted_path"],
+            state.get("glance_format", OPENSTACK_IMAGE_FORMAT))
+        image_id = image.id
+        job.checkpoint("upload_to_glance", glance_image_id=image_id)
+    with _restart_if_failed(job, "upload_to_glance", "glance_image_id"):
+        export_task.wait_glance_image_active(request, image_id, STATUS_CHECK_INTERVAL)
+    export_task.delete_file(state["converted_path"])
+    return {"glance_image_id": image_id}
+
+
+def _create_openstack_instance(request, job, state):
+    image = glance.image_get(request, state["glance_image_id"])
+    new_instance = export_task.create_instance(
+        request, state["name"], image, state["flavor"], state["key_name"],
+        state["user_data"], state["security_groups"],
+        block_device_mapping=state["block_device_mapping"],
+        block_device_mapping_v2=state["block_device_mapping_v2"], nics=state["nics"],
+        availability_zone=state["availability_zone"],
+        instance_count=state["instance_count"],
+        admin_pass=state["admin_pass"], disk_config=state["disk_config"],
+        config_drive=state["config_drive"], meta=state["meta"],
+        scheduler_hints=state["scheduler_hints"]
+    )
+    return {"instance_id": new_instance.id}
+
+
+def _wait_instance_active(request, job, state):
+    export_task.wait_instance_active(request, state["instance_id"], STATUS_CHECK_INTERVAL)
+
+
+def _export_cleanup(request, job, state):
+    export_task.delete_s3_object(request, state["s3_key"])
+    if not state["leave_original_instance"]:
+        export_task.delete_instance(request, state["source_id"])
+    if not state["leave_instance_snapshot"]:
+        export_task.delete_glance_image(request, state["glance_image_id"])
+
+
+S3_EXPORT_FLOW = [
+    ("export_instance", _export_instance),
+    ("download_image", _download_from_s3),
+    ("convert_image", _convert_to_openstack_format),
+    ("upload_to_glance", _upload_to_glance),
+    ("create_instance", _create_openstack_instance),
+    ("wait_instance_active", _wait_instance_active),
+    ("cleanup", _export_cleanup),
+]
+
+
+# EBS export stages
+
+
+def _snapshot_root_volume(request, job, state):
+    snapshot_id = state.get("ebs_snapshot_id")
+    if snapshot_id is None:
+        snapshot_id = export_task.start_root_volume_snapshot(request, state["source_id"],
+                                                             state["name"])
+        job.checkpoint("snapshot_volume", ebs_snapshot_id=snapshot_id)
+    with _restart_if_failed(job, "snapshot_volume", "ebs_snapshot_id"):
+        export_task.wait_ebs_snapshot(request, snapshot_id, STATUS_CHECK_INTERVAL)
+    return {"ebs_snapshot_id": snapshot_id}
+
+
+def _read_ebs_snapshot(request, job, state):
+    image_name = "export-%s.raw" % state["source_id"]
+    file_path, read = export_task.read_ebs_snapshot(request, state["ebs_snapshot_id"],
+                                                    IMAGE_TASK_WORKING_PATH, image_name)
+    return {"download_path": file_path, "image_name": image_name, "export_format": "raw",
+            "ebs_read": read}
+
+
+def _ebs_export_cleanup(request, job, state):
+    export_task.delete_ebs_snapshot(request, state["ebs_snapshot_id"])
+    if not state["leave_original_instance"]:
+        export_task.delete_instance(request, state["source_id"])
+    if not state["leave_instance_snapshot"]:
+        export_task.delete_glance_image(request, state["glance_image_id"])
+
+
+EBS_EXPORT_FLOW = [
+    ("snapshot_volume", _snapshot_root_volume),
+    ("download_image", _read_ebs_snapshot),
+    ("convert_image", _convert_to_openstack_format),
+    ("upload_to_glance", _upload_to_glance),
+    ("create_instance", _create_openstack_instance),
+    ("wait_instance_active", _wait_instance_active),
+    ("cleanup", _ebs_export_cleanup),
+]
+
+EXPORT_FLOW = EBS_EXPORT_FLOW if AWS_EXPORT_ENGINE == EBS_ENGINE else S3_EXPORT_FLOW
+EXPORT_STAGES = tuple(name for name, func in EXPORT_FLOW)
+
+
+def run_import_instance_tasks(request, source_type, source_id, flavor, key_name,
+                              security_groups, availability_zone, instance_count,
+                              leave_original_instance, leave_instance_snapshot,
+                              job=None):
+    """Import instance task flow
+
+    ``job`` is the jobs.RunningJob saving the IMPORT_FLOW stages when the
+    flow runs in a background worker; its completed stages are skipped.
+    Returns the id of the new EC2 instance.
+    """
+    start_time = time.time()
+    LOG.debug("Start Import Instance. Receive Data : {}".format(request.DATA))
+    state = dict(source_type=source_type, source_id=source_id, flavor=flavor,
+                 key_name=key_name, security_groups=security_groups,
+                 availability_zone=availability_zone, instance_count=instance_count,
+                 leave_original_instance=leave_original_instance,
+                 leave_instance_snapshot=leave_instance_snapshot)
+    state = (job or jobs.InlineJob()).run_stages(request, IMPORT_FLOW, state)
 
     duration = round((time.time() - start_time) / 60, 1)
     LOG.debug("Complete Import Instance. Duration : {} min.".format(duration))
 
-    return new_instance
+    return state["instance_id"]
 
 
 def run_export_instance_tasks(request, name, source_id, flavor, key_name, user_data,
@@ -72,38 +438,26 @@ def run_export_instance_tasks(request, name, source_id, flavor, key_name, user_d
                               block_device_mapping_v2=None, nics=None,
                               availability_zone=None, instance_count=1, admin_pass=None,
                               disk_config=None, config_drive=None, meta=None,
-                              scheduler_hints=None):
-    """Export instance task flow"""
+                              scheduler_hints=None, job=None):
+    """Export instance task flow
+
+    ``job`` is the jobs.RunningJob saving the EXPORT_FLOW stages when the
+    flow runs in a background worker; its completed stages are skipped.
+    Returns the id of the new OpenStack instance.
+    """
     start_time = time.time()
     LOG.debug("Start Export Instance. Receive Data : {}".format(request.DATA))
-    task = export_task.export_instance(request, source_id, name, STATUS_CHECK_INTERVAL)
-    obj_name = task.get("ExportToS3Task").get("S3Key")
-
-    download_path = export_task.download_image_from_s3(request, obj_name, IMAGE_TASK_WORKING_PATH)
-    new_file_path = export_task.convert_image_format(download_path, OPENSTACK_IMAGE_FORMAT)
-    image = export_task.upload_image_to_glance(request, obj_name, new_file_path,
-                                               OPENSTACK_IMAGE_FORMAT, STATUS_CHECK_INTERVAL)
-    export_task.delete_file(new_file_path)
-
-    new_instance = export_task.create_instance(
-        request, name, image, flavor, key_name, user_data, security_groups,
-        block_device_mapping=block_device_mapping,
-        block_device_mapping_v2=block_device_mapping_v2, nics=nics,
-        availability_zone=availability_zone,
-        instance_count=instance_count,
-        admin_pass=admin_pass, disk_config=disk_config,
-        config_drive=config_drive, meta=meta,
-        scheduler_hints=scheduler_hints
-    )
-
-    export_task.wait_instance_active(request, new_instance.id, STATUS_CHECK_INTERVAL)
-
-    export_task.delete_s3_object(request, obj_name)
-    if not leave_original_instance:
-        export_task.delete_instance(request, source_id)
-    if not leave_instance_snapshot:
-        export_task.delete_glance_image(request, image.id)
+    state = dict(name=name, source_id=source_id, flavor=flavor, key_name=key_name,
+                 user_data=user_data, security_groups=security_groups,
+                 leave_original_instance=leave_original_instance,
+                 leave_instance_snapshot=leave_instance_snapshot,
+                 block_device_mapping=block_device_mapping,
+                 block_device_mapping_v2=block_device_mapping_v2, nics=nics,
+                 availability_zone=availability_zone, instance_count=instance_count,
+                 admin_pass=admin_pass, disk_config=disk_config, config_drive=config_drive,
+                 meta=meta, scheduler_hints=scheduler_hints)
+    state = (job or jobs.InlineJob()).run_stages(request, EXPORT_FLOW, state)
     duration = round((time.time() - start_time) / 60, 1)
-    LOG.debug("Complete Import Instance. Duration : {} min.".format(duration))
+    LOG.debug("Complete Export Instance. Duration : {} min.".format(duration))
 
-    return new_instance
+    return state["instance_id"]
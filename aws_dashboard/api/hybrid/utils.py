@@ -13,18 +13,16 @@
 # limitations under the License.
 import os
 import logging
-import subprocess
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
-from horizon.utils.memoized import memoized  # noqa
+from aws_dashboard.api.hybrid import convert
 
 LOG = logging.getLogger(__name__)
-SUPPORT_IMAGE_FORMATS = ["qcow2", "vmdk", "raw"]
+SUPPORT_IMAGE_FORMATS = ["qcow2", "vmdk", "raw", "vhd"]
 
 
-@memoized
 def get_api_keys(project_id):
     """Get AWS API key set in local settings"""
     keys_dict = getattr(settings, "AWS_API_KEY_DICT", {})
@@ -78,19 +76,16 @@ def to_wrapping_list(aws_list, key, wrapper_cls):
     return openstack_list
 
 
-def convert_image_format(target_file_path, convert_format, delete_origin=True):
+def convert_image_format(target_file_path, convert_format, delete_origin=True, progress=None,
+                         create_options=None):
     """ Convert Image Format """
     validate_image_format(target_file_path)
     file_name, file_extension = os.path.splitext(target_file_path)
     new_file_path = file_name + "." + convert_format
-    LOG.debug("Start Convert Image : %s" % target_file_path)
-    cmd = ["qemu-img", "convert", "-O", convert_format, target_file_path, new_file_path]
-
-    if convert_format == "qcow2":
-        cmd = ["qemu-img", "convert", "-O", convert_format, "-c", target_file_path, new_file_path]
-
-    subprocess.call(cmd)
-    LOG.debug("Finish Convert Image : %s" % new_file_path)
+    if new_file_path == target_file_path:
+        new_file_path = file_name + ".converted." + convert_format
+    convert.convert(target_file_path, new_file_path, convert_format, progress,
+                    create_options=create_options)
 
     if delete_origin:
         os.remove(target_file_path)
@@ -0,0 +1,549 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""S3 multipart uploads.
+
+MultipartUploader takes data of unknown length, e.g. the chunks of a
+Glance image download, and sends it as parts while it arrives, so an image
+can be copied to S3 without being staged on the local disk.
+
+ResumableUpload uploads a local file and keeps the upload id, part size
+and uploaded parts in a state file next to it. When the upload fails, e.g.
+the worker dies at 90% of a large image, the next attempt asks S3 for the
+parts it has and only sends the missing ones. Uploads nobody resumes are
+aborted by abort_orphaned_uploads after AWS_MULTIPART_ORPHAN_AGE seconds.
+Its parts are sent as PartReader views of an mmap of the file, not copies.
+
+Both compute the MD5 of each part in their upload threads, have S3 check
+it (Content-MD5) and compare the ETag S3 gives the completed object with
+the one computed locally, so a corrupt upload fails here and not in the
+EC2 import that reads it. With AWS_UPLOAD_SHA256 they also compute a
+SHA-256 tree hash (SHA-256 of the part SHA-256s) kept with the job.
+
+Every part of every upload of the process first takes its size from
+BUDGET, so the part data held at once stays under
+AWS_TRANSFER_MEMORY_BUDGET bytes however large the images and however
+many jobs run.
+"""
+from concurrent import futures
+import base64
+import binascii
+import datetime
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+LOG = logging.getLogger(__name__)
+AWS_MULTIPART_PART_SIZE = getattr(settings, "AWS_MULTIPART_PART_SIZE", 16 * 1024 * 1024)
+AWS_MULTIPART_CONCURRENCY = getattr(settings, "AWS_MULTIPART_CONCURRENCY", 4)
+AWS_MULTIPART_ORPHAN_AGE = getattr(settings, "AWS_MULTIPART_ORPHAN_AGE", 2 * 24 * 60 * 60)
+AWS_TRANSFER_MEMORY_BUDGET = getattr(settings, "AWS_TRANSFER_MEMORY_BUDGET", 1024 * 1024 * 1024)
+AWS_UPLOAD_SHA256 = getattr(settings, "AWS_UPLOAD_SHA256", False)
+
+# S3 limits
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+
+def part_size_for(size, part_size=AWS_MULTIPART_PART_SIZE, max_parts=MAX_PARTS):
+    """Part size uploading ``size`` bytes in at most ``max_parts`` parts."""
+    part_size = max(part_size, MIN_PART_SIZE)
+    if size:
+        mb = 1024 * 1024
+        part_size = max(part_size, (size // max_parts + mb) // mb * mb)
+    return part_size
+
+
+class UploadVerifyError(Exception):
+    pass
+
+
+def _strip_etag(etag):
+    return (etag or "").strip('"')
+
+
+class PartDigests(object):
+    """Digests of the parts of a multipart upload and of the whole object."""
+
+    def __init__(self, sha256=AWS_UPLOAD_SHA256):
+        self._md5 = {}
+        self._sha256 = {} if sha256 else None
+        self._lock = threading.Lock()
+
+    def add(self, part_number, data):
+        """Hash a part and return its MD5 digest."""
+        md5 = hashlib.md5(data).digest()
+        sha256 = hashlib.sha256(data).digest() if self._sha256 is not None else None
+        with self._lock:
+            self._md5[part_number] = md5
+            if sha256 is not None:
+                self._sha256[part_number] = sha256
+        return md5
+
+    @staticmethod
+    def content_md5(md5):
+        return base64.b64encode(md5).decode("ascii")
+
+    @staticmethod
+    def matches(etag, md5):
+        return _strip_etag(etag) == binascii.hexlify(md5).decode("ascii")
+
+    def _tree(self, digests, hash_func):
+        combined = hash_func(b"".join(digests[n] for n in sorted(digests)))
+        return "%s-%d" % (combined.hexdigest(), len(digests))
+
+    @property
+    def etag(self):
+        """The ETag S3 gives the object made of these parts."""
+        return self._tree(self._md5, hashlib.md5)
+
+    @property
+    def sha256(self):
+        if self._sha256 is None:
+            return None
+        return self._tree(self._sha256, hashlib.sha256)
+
+    def verify(self, bucket, key, etag):
+        """Raise UploadVerifyError when ``etag`` is not the computed one."""
+        if _strip_etag(etag) != self.etag:
+            raise UploadVerifyError("%s/%s ETag %s does not match the uploaded data (%s)"
+                                    % (bucket, key, _strip_etag(etag), self.etag))
+
+    def as_dict(self):
+        return {"etag": self.etag, "sha256": self.sha256, "parts": len(self._md5)}
+
+
+class MemoryBudget(object):
+    """Bytes of part data the transfers of the process may hold at once."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.available = capacity
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        """Wait for ``size`` bytes of budget and return the amount taken."""
+        # A part larger than the whole budget runs alone.
+        size = min(size, self.capacity)
+        with self._condition:
+            while self.available < size:
+                self._condition.wait()
+            self.available -= size
+        return size
+
+    def release(self, size):
+        with self._condition:
+            self.available += size
+            self._condition.notify_all()
+
+
+BUDGET = MemoryBudget(AWS_TRANSFER_MEMORY_BUDGET)
+
+
+class PartReader(object):
+    """Read-only, seekable file object over a memoryview.
+
+    botocore reads the body in blocks to hash and send it, so a part served
+    from an mmap is never copied whole into a byte string.
+    """
+
+    def __init__(self, view):
+        self._view = view
+        self._position = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else self._position + size
+        data = self._view[self._position:end].tobytes()
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        self._position = max(offset, 0)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+class MultipartUploader(object):
+    """Upload the data written to it as an S3 object, part by part.
+
+    Data is buffered up to ``part_size`` bytes, then sent as a part by a
+    pool of ``max_concurrency`` threads. ``write`` blocks while that many
+    parts are in flight, so memory stays under (max_concurrency + 1)
+    parts whatever the speed of the source and of the link. The budget of
+    a part is taken before any of its data is buffered, and the buffer is
+    handed to the upload thread as is, not copied.
+
+    Used as a context manager, the upload is completed on exit, or aborted
+    when the block raises.
+    """
+
+    def __init__(self, client, bucket, key, part_size=AWS_MULTIPART_PART_SIZE,
+                 max_concurrency=AWS_MULTIPART_CONCURRENCY):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_concurrency = max_concurrency
+        self.upload_id = None
+        self.bytes_sent = 0
+        self.digests = PartDigests()
+        self._buffer = bytearray()
+        # Budget taken for the part being buffered
+        self._buffer_budget = 0
+        self._parts = {}
+        self._pending = []
+        self._slots = threading.Semaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._start_time = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.complete()
+        else:
+            self.abort()
+
+    def start(self):
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+        self.upload_id = response["UploadId"]
+        self._executor = futures.ThreadPoolExecutor(self.max_concurrency)
+        self._start_time = time.time()
+        LOG.debug("Start Multipart Upload : %s/%s (%s)" % (self.bucket, self.key, self.upload_id))
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view):
+            if not self._buffer:
+                self._buffer_budget = BUDGET.acquire(self.part_size)
+            room = self.part_size - len(self._buffer)
+            self._buffer.extend(view[:room])
+            view = view[room:]
+            if len(self._buffer) == self.part_size:
+                self._submit_buffer()
+
+    def upload_stream(self, chunks):
+        """Upload an iterable of chunks and complete the upload."""
+        try:
+            for chunk in chunks:
+                self.write(chunk)
+        except Exception:
+            self.abort()
+            raise
+        return self.complete()
+
+    def _submit_buffer(self):
+        """Send the buffer as a part, with its budget, and start a new one."""
+        body, budget = self._buffer, self._buffer_budget
+        self._buffer, self._buffer_budget = bytearray(), 0
+        self._slots.acquire()
+        try:
+            self._raise_failed()
+            part_number = len(self._pending) + 1
+            if part_number > MAX_PARTS:
+                raise ValueError("%s/%s needs more than %d parts of %d bytes"
+                                 % (self.bucket, self.key, MAX_PARTS, self.part_size))
+        except Exception:
+            self._slots.release()
+            BUDGET.release(budget)
+            raise
+        self._pending.append(self._executor.submit(self._upload_part, part_number, body, budget))
+
+    def _upload_part(self, part_number, body, budget):
+        try:
+            md5 = self.digests.add(part_number, body)
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.key,
+                                               UploadId=self.upload_id,
+                                               PartNumber=part_number, Body=body,
+                                               ContentMD5=PartDigests.content_md5(md5))
+            if not PartDigests.matches(response["ETag"], md5):
+                raise UploadVerifyError("%s/%s part %d ETag %s does not match its MD5"
+                                        % (self.bucket, self.key, part_number, response["ETag"]))
+            with self._lock:
+                self._parts[part_number] = response["ETag"]
+                self.bytes_sent += len(body)
+            LOG.debug("Uploaded Part %d : %s/%s (%d MB)"
+                      % (part_number, self.bucket, self.key, self.bytes_sent // (1024 * 1024)))
+        finally:
+            BUDGET.release(budget)
+            self._slots.release()
+
+    def _raise_failed(self):
+        for future in self._pending:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def complete(self):
+        """Send the buffered data, wait for every part and complete the object."""
+        try:
+            if self._buffer or not self._pending:
+                self._submit_buffer()
+            for future in self._pending:
+                future.result()
+            response = self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": [{"PartNumber": n, "ETag": self._parts[n]}
+                                           for n in sorted(self._parts)]})
+            self.digests.verify(self.bucket, self.key, response.get("ETag"))
+        except Exception:
+            self.abort()
+            raise
+        self._executor.shutdown()
+        duration = max(time.time() - self._start_time, 0.001)
+        LOG.debug("Multipart Upload Complete : %s/%s (%d MB, %.1f MB/s)"
+                  % (self.bucket, self.key, self.bytes_sent // (1024 * 1024),
+                     self.bytes_sent / duration / 1024 / 1024))
+        return response
+
+    def abort(self):
+        BUDGET.release(self._buffer_budget)
+        self._buffer_budget = 0
+        if self.upload_id is None:
+            return
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown()
+        LOG.warning("Abort Multipart Upload : %s/%s (%s)" % (self.bucket, self.key, self.upload_id))
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                               UploadId=self.upload_id)
+        except Exception as e:
+            LOG.warning("Abort Multipart Upload Fail : %s (%s)" % (self.upload_id, e))
+        self.upload_id = None
+
+
+class ResumableUpload(object):
+    """Upload a file as an S3 object, resuming an earlier failed attempt.
+
+    The state file holds the upload id, the part size and the ETag of each
+    uploaded part, and is saved after every part. It is removed when the
+    upload completes; a failed upload is left to be resumed. Parts found
+    in S3 are hashed again from the file and sent again when their ETag
+    does not match.
+    """
+
+    def __init__(self, client, bucket, key, file_path, part_size=AWS_MULTIPART_PART_SIZE,
+                 max_concurrency=AWS_MULTIPART_CONCURRENCY, state_path=None, progress=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.file_path = file_path
+        self.state_path = state_path or "%s.upload.json" % file_path
+        self.size = os.path.getsize(file_path)
+        self.part_size = part_size_for(self.size, part_size)
+        self.max_concurrency = max_concurrency
+        self.progress = progress
+        self.upload_id = None
+        self.bytes_sent = 0
+        self.digests = PartDigests()
+        self._parts = {}
+        self._lock = threading.Lock()
+
+    @property
+    def part_count(self):
+        return max(-(-self.size // self.part_size), 1)
+
+    def _identity(self):
+        return {"bucket": self.bucket, "key": self.key, "size": self.size,
+                "mtime": int(os.path.getmtime(self.file_path))}
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if state.get("file") != self._identity():
+            LOG.debug("Ignore Upload State Of Another File : %s" % self.state_path)
+            return None
+        return state
+
+    def _save_state(self):
+        state = {"file": self._identity(), "upload_id": self.upload_id,
+                 "part_size": self.part_size,
+                 "parts": dict((str(n), etag) for n, etag in self._parts.items())}
+        tmp_path = "%s.tmp" % self.state_path
+        with open(tmp_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.rename(tmp_path, self.state_path)
+
+    def _list_parts(self):
+        """ETags of the parts S3 holds, or None when the upload is gone."""
+        parts = {}
+        marker = 0
+        try:
+            while True:
+                response = self.client.list_parts(Bucket=self.bucket, Key=self.key,
+                                                  UploadId=self.upload_id,
+                                                  PartNumberMarker=marker)
+                for part in response.get("Parts", []):
+                    parts[part["PartNumber"]] = part["ETag"]
+                if not response.get("IsTruncated"):
+                    return parts
+                marker = response["NextPartNumberMarker"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "NoSuchUpload":
+                return None
+            raise
+
+    def _resume(self):
+        state = self._load_state()
+        if state is None:
+            return False
+        self.upload_id = state["upload_id"]
+        self.part_size = state["part_size"]
+        parts = self._list_parts()
+        if parts is None:
+            LOG.debug("Upload To Resume Is Gone : %s/%s (%s)"
+                      % (self.bucket, self.key, self.upload_id))
+            return False
+        self._parts = dict((n, etag) for n, etag in parts.items() if n <= self.part_count)
+        LOG.debug("Resume Multipart Upload : %s/%s (%s, %d of %d parts)"
+                  % (self.bucket, self.key, self.upload_id, len(self._parts), self.part_count))
+        return True
+
+    def _start(self):
+        self.part_size = part_size_for(self.size, self.part_size)
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+        self.upload_id = response["UploadId"]
+        self._parts = {}
+        self._save_state()
+        LOG.debug("Start Multipart Upload : %s/%s (%s)" % (self.bucket, self.key, self.upload_id))
+
+    def _part_length(self, part_number):
+        return min(self.part_size, self.size - (part_number - 1) * self.part_size)
+
+    def _upload_part(self, mapped, part_number):
+        length = self._part_length(part_number)
+        start = (part_number - 1) * self.part_size
+        budget = BUDGET.acquire(length)
+        view = _part_view(mapped, start, length)
+        try:
+            md5 = self.digests.add(part_number, view)
+            if PartDigests.matches(self._parts.get(part_number), md5):
+                return
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.key,
+                                               UploadId=self.upload_id,
+                                               PartNumber=part_number, Body=PartReader(view),
+                                               ContentMD5=PartDigests.content_md5(md5))
+        finally:
+            _release_view(view)
+            _drop_pages(mapped, start, length)
+            BUDGET.release(budget)
+        if not PartDigests.matches(response["ETag"], md5):
+            raise UploadVerifyError("%s/%s part %d ETag %s does not match its MD5"
+                                    % (self.bucket, self.key, part_number, response["ETag"]))
+        with self._lock:
+            self._parts[part_number] = response["ETag"]
+            self.bytes_sent += length
+            self._save_state()
+        if self.progress is not None:
+            self.progress(length)
+
+    def run(self):
+        """Upload the missing parts and complete the object."""
+        if not self._resume():
+            self._start()
+        resumed = len(self._parts)
+        with open(self.file_path, "rb") as source:
+            # An empty file cannot be mapped, its only part is empty anyway.
+            mapped = (mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+                      if self.size else b"")
+            executor = futures.ThreadPoolExecutor(self.max_concurrency)
+            pending = [executor.submit(self._upload_part, mapped, n)
+                       for n in range(1, self.part_count + 1)]
+            try:
+                for future in futures.as_completed(pending):
+                    future.result()
+            except Exception:
+                # Fail now rather than after every queued part was tried.
+                for future in pending:
+                    future.cancel()
+                raise
+            finally:
+                executor.shutdown()
+                if self.size:
+                    mapped.close()
+        response = self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": n, "ETag": self._parts[n]}
+                                       for n in sorted(self._parts)]})
+        os.remove(self.state_path)
+        self.digests.verify(self.bucket, self.key, response.get("ETag"))
+        LOG.debug("Multipart Upload Complete : %s/%s (%d parts, %d resumed, ETag %s)"
+                  % (self.bucket, self.key, self.part_count, resumed, self.digests.etag))
+        return response
+
+
+def _part_view(mapped, start, length):
+    if not length:
+        return memoryview(b"")
+    try:
+        return memoryview(mapped)[start:start + length]
+    except TypeError:
+        # Python 2 mmaps only export the old buffer interface: copy the part.
+        return memoryview(mapped[start:start + length])
+
+
+def _release_view(view):
+    # Python 2 memoryviews have no release(), nor keep the mmap open.
+    release = getattr(view, "release", None)
+    if release is not None:
+        release()
+
+
+def _drop_pages(mapped, start, length):
+    """Let the kernel reclaim the pages of a part sent, where supported."""
+    madvise = getattr(mapped, "madvise", None)
+    if (madvise is not None and length and hasattr(mmap, "MADV_DONTNEED") and
+            start % mmap.PAGESIZE == 0):
+        madvise(mmap.MADV_DONTNEED, start, length)
+
+
+def abort_orphaned_uploads(client, bucket, max_age=AWS_MULTIPART_ORPHAN_AGE):
+    """Abort the multipart uploads of a bucket started over ``max_age`` seconds ago.
+
+    :returns: list of the (key, upload id) aborted
+    """
+    aborted = []
+    for page in client.get_paginator("list_multipart_uploads").paginate(Bucket=bucket):
+        for upload in page.get("Uploads", []):
+            initiated = upload["Initiated"]
+            age = datetime.datetime.now(initiated.tzinfo) - initiated
+            if age.total_seconds() < max_age:
+                continue
+            LOG.warning("Abort Orphaned Multipart Upload : %s/%s (%s, started %s)"
+                        % (bucket, upload["Key"], upload["UploadId"], initiated))
+            client.abort_multipart_upload(Bucket=bucket, Key=upload["Key"],
+                                          UploadId=upload["UploadId"])
+            aborted.append((upload["Key"], upload["UploadId"]))
+    return aborted
@@ -0,0 +1,193 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Inventory summary of every account in AWS_API_KEY_DICT.
+
+Accounts are summarized in parallel on a dedicated thread pool, each with
+its own deadline from the time it starts, enforced on its future, and
+clients with connect and read timeouts so a stuck call frees its thread.
+Every summary is cached for the "overview" TTL of
+the shared cache, so reloading the page does not call every account again.
+"""
+import collections
+from concurrent import futures
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from aws_dashboard.api import cache
+from aws_dashboard.api import client_pool
+from aws_dashboard.api import flavor_catalog
+from aws_dashboard.api.hybrid.utils import get_api_keys
+
+LOG = logging.getLogger(__name__)
+AWS_OVERVIEW_WORKERS = getattr(settings, "AWS_OVERVIEW_WORKERS", 8)
+AWS_OVERVIEW_ACCOUNT_TIMEOUT = getattr(settings, "AWS_OVERVIEW_ACCOUNT_TIMEOUT", 15)
+AWS_OVERVIEW_TIMEOUT = getattr(settings, "AWS_OVERVIEW_TIMEOUT", 60)
+
+EXPORT_TASK_ACTIVE_STATES = ("active", "cancelling")
+IMPORT_TASK_ACTIVE_STATES = ("active",)
+
+_executor = None
+_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = futures.ThreadPoolExecutor(AWS_OVERVIEW_WORKERS)
+    return _executor
+
+
+def _check_deadline(deadline):
+    if time.time() > deadline:
+        raise DeadlineExceeded("Timed out after %d seconds" % AWS_OVERVIEW_ACCOUNT_TIMEOUT)
+
+
+def _instance_vcpus(instance, catalog):
+    record = catalog.get(instance["InstanceType"])
+    if record is not None and record.vcpus:
+        return record.vcpus
+    cpu_options = instance.get("CpuOptions", {})
+    return cpu_options.get("CoreCount", 0) * cpu_options.get("ThreadsPerCore", 1)
+
+
+def summarize_account(project_id):
+    """Count the instances and in-flight transport tasks of an account.
+
+    Raises DeadlineExceeded when the account takes longer than
+    AWS_OVERVIEW_ACCOUNT_TIMEOUT seconds.
+    """
+    deadline = time.time() + AWS_OVERVIEW_ACCOUNT_TIMEOUT
+    region_name = get_api_keys(project_id)[2]
+    client = client_pool.get_client(project_id, "ec2", timeout=AWS_OVERVIEW_ACCOUNT_TIMEOUT)
+    catalog = flavor_catalog.get_catalog(region_name)
+
+    states = collections.Counter()
+    instance_types = collections.Counter()
+    running_vcpus = 0
+    paginator = client.get_paginator("describe_instances")
+    for page in paginator.paginate(PaginationConfig={"PageSize": 1000}):
+        for reservation in page.get("Reservations", []):
+            for instance in reservation.get("Instances", []):
+                state = instance["State"]["Name"]
+                states[state] += 1
+                instance_types[instance["InstanceType"]] += 1
+                if state == "running":
+                    running_vcpus += _instance_vcpus(instance, catalog)
+        _check_deadline(deadline)
+
+    export_tasks = client.describe_export_tasks().get("ExportTasks", [])
+    _check_deadline(deadline)
+    import_tasks = client.describe_import_image_tasks().get("ImportImageTasks", [])
+    transport_tasks = (
+        sum(1 for t in export_tasks if t.get("State") in EXPORT_TASK_ACTIVE_STATES) +
+        sum(1 for t in import_tasks if t.get("Status") in IMPORT_TASK_ACTIVE_STATES))
+
+    return {
+        "project_id": project_id,
+        "region": region_name,
+        "instances": sum(states.values()),
+        "states": dict(states),
+        "instance_types": dict(instance_types),
+        "running_vcpus": running_vcpus,
+        "transport_tasks": transport_tasks,
+    }
+
+
+def get_account_summary(project_id):
+    return cache.get_or_call(project_id, cache.OVERVIEW, "summarize_account",
+                             summarize_account, project_id)
+
+
+def _summarize(project_id, started):
+    started[project_id] = time.time()
+    return get_account_summary(project_id)
+
+
+def _wait_account(future, project_id, started, deadline):
+    """Result of the summary of an account, within its own and the overall deadline.
+
+    An account waiting for a thread of the pool has no deadline of its own
+    yet, it is checked again every second.
+    """
+    while True:
+        start = started.get(project_id)
+        timeout = AWS_OVERVIEW_TIMEOUT
+        end = deadline
+        if start is not None and start + AWS_OVERVIEW_ACCOUNT_TIMEOUT < deadline:
+            timeout = AWS_OVERVIEW_ACCOUNT_TIMEOUT
+            end = start + AWS_OVERVIEW_ACCOUNT_TIMEOUT
+        remaining = max(end - time.time(), 0)
+        try:
+            return future.result(timeout=remaining if start is not None else min(remaining, 1))
+        except futures.TimeoutError:
+            if time.time() >= end:
+                future.cancel()
+                raise DeadlineExceeded("Timed out after %d seconds" % timeout)
+
+
+def list_account_summaries(project_ids=None):
+    """Summarize the accounts, all of AWS_API_KEY_DICT by default.
+
+    Returns a tuple of the summaries sorted by project id and a dict of
+    error messages keyed by the project ids which failed.
+    """
+    if project_ids is None:
+        project_ids = getattr(settings, "AWS_API_KEY_DICT", {}).keys()
+    start_time = time.time()
+    deadline = start_time + AWS_OVERVIEW_TIMEOUT
+    started = {}
+    executor = _get_executor()
+    pending = [(p, executor.submit(_summarize, p, started)) for p in sorted(project_ids)]
+    results = {}
+    errors = {}
+    for project_id, future in pending:
+        try:
+            results[project_id] = _wait_account(future, project_id, started, deadline)
+        except Exception as e:
+            LOG.warning("Summarize Account Fail : %s (%s)" % (project_id, e))
+            errors[project_id] = str(e)
+    LOG.debug("Summarize %d Accounts in %.2f sec, %d failed"
+              % (len(pending), time.time() - start_time, len(errors)))
+    return [results[p] for p in sorted(results)], errors
+
+
+def aggregate(summaries):
+    """Total the account summaries.
+
+    Returns a dict of Counters by state, instance type and region, plus
+    the running vCPU and in-flight transport task totals.
+    """
+    totals = {
+        "states": collections.Counter(),
+        "instance_types": collections.Counter(),
+        "regions": collections.Counter(),
+        "running_vcpus": 0,
+        "transport_tasks": 0,
+    }
+    for summary in summaries:
+        totals["states"].update(summary["states"])
+        totals["instance_types"].update(summary["instance_types"])
+        totals["regions"][summary["region"]] += summary["instances"]
+        totals["running_vcpus"] += summary["running_vcpus"]
+        totals["transport_tasks"] += summary["transport_tasks"]
+    return totals
@@ -0,0 +1,179 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Resumable S3 download by concurrent byte ranges.
+
+The object is fetched in ranges of ``part_size`` bytes, each written at
+its offset in a file preallocated to the object size. A bitmap of the
+ranges written is saved in a state file next to it, so a download that
+fails, e.g. on a connection dropped late in a large export, only fetches
+the missing ranges on the next attempt.
+
+Every range is requested with the ETag of the object (If-Match) and its
+length checked, so ranges of an object replaced in between are never
+mixed in the file.
+"""
+from concurrent import futures
+import binascii
+import json
+import logging
+import os
+import threading
+
+from botocore.exceptions import ClientError
+
+from aws_dashboard.api.hybrid import download
+
+LOG = logging.getLogger(__name__)
+READ_SIZE = 1024 * 1024
+
+
+class ObjectChanged(download.DownloadError):
+    pass
+
+
+class RangedDownload(object):
+    """Download an S3 object into ``file_path``, resuming an earlier attempt."""
+
+    def __init__(self, client, bucket, key, file_path, part_size, max_concurrency,
+                 state_path=None, progress=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.file_path = file_path
+        self.state_path = state_path or "%s.download.json" % file_path
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.progress = progress
+        self.size = None
+        self.etag = None
+        self.resumed_bytes = 0
+        self._done = None
+        self._lock = threading.Lock()
+
+    @property
+    def part_count(self):
+        return max(-(-self.size // self.part_size), 1)
+
+    def _is_done(self, index):
+        return bool(self._done[index // 8] & (1 << index % 8))
+
+    def _set_done(self, index):
+        self._done[index // 8] |= 1 << index % 8
+
+    def _part_range(self, index):
+        start = index * self.part_size
+        return start, min(start + self.part_size, self.size) - 1
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            return False
+        if (state.get("etag") != self.etag or state.get("size") != self.size or
+                not os.path.exists(self.file_path) or
+                os.path.getsize(self.file_path) != self.size):
+            LOG.debug("Ignore Download State Of Another Object : %s" % self.state_path)
+            return False
+        self.part_size = state["part_size"]
+        self._done = bytearray(binascii.unhexlify(state["done"]))
+        return True
+
+    def _save_state(self):
+        state = {"etag": self.etag, "size": self.size, "part_size": self.part_size,
+                 "done": binascii.hexlify(bytes(self._done)).decode("ascii")}
+        tmp_path = "%s.tmp" % self.state_path
+        with open(tmp_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.rename(tmp_path, self.state_path)
+
+    def _prepare(self):
+        if self._load_state():
+            self.resumed_bytes = sum(self._part_range(i)[1] - self._part_range(i)[0] + 1
+                                     for i in range(self.part_count) if self._is_done(i))
+            LOG.debug("Resume Ranged Download : %s/%s (%d MB done)"
+                      % (self.bucket, self.key, self.resumed_bytes // (1024 * 1024)))
+            return
+        with open(self.file_path, "wb") as target:
+            download.preallocate(target.fileno(), self.size)
+            target.truncate(self.size)
+        self._done = bytearray((self.part_count + 7) // 8)
+        self._save_state()
+
+    def _get_range(self, index):
+        start, end = self._part_range(index)
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                              Range="bytes=%d-%d" % (start, end),
+                                              IfMatch=self.etag)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("PreconditionFailed", "412"):
+                raise ObjectChanged("%s/%s changed during the download"
+                                    % (self.bucket, self.key))
+            raise
+        if response.get("ETag") != self.etag:
+            raise ObjectChanged("%s/%s changed during the download" % (self.bucket, self.key))
+        if response.get("ContentLength") != end - start + 1:
+            raise download.DownloadError("%s/%s range %d-%d does not match the object"
+                                         % (self.bucket, self.key, start, end))
+        body = response["Body"]
+        written = 0
+        with open(self.file_path, "r+b") as target:
+            target.seek(start)
+            while True:
+                data = body.read(READ_SIZE)
+                if not data:
+                    break
+                target.write(data)
+                written += len(data)
+            target.flush()
+            os.fsync(target.fileno())
+        if written != end - start + 1:
+            raise download.DownloadError("%s/%s range %d-%d is truncated : %d bytes"
+                                         % (self.bucket, self.key, start, end, written))
+        with self._lock:
+            self._set_done(index)
+            self._save_state()
+        if self.progress is not None:
+            self.progress(written)
+
+    def run(self):
+        """Fetch the missing ranges and return the number of bytes fetched."""
+        head = self.client.head_object(Bucket=self.bucket, Key=self.key)
+        self.size = head["ContentLength"]
+        self.etag = head["ETag"]
+        self._prepare()
+        missing = [i for i in range(self.part_count) if not self._is_done(i)]
+        if self.size:
+            try:
+                executor = futures.ThreadPoolExecutor(self.max_concurrency)
+                pending = [executor.submit(self._get_range, i) for i in missing]
+                try:
+                    for future in futures.as_completed(pending):
+                        future.result()
+                except Exception:
+                    # Fail now rather than after every queued range was tried.
+                    for future in pending:
+                        future.cancel()
+                    raise
+                finally:
+                    executor.shutdown()
+            except ObjectChanged:
+                # The ranges written belong to another version, start over next time.
+                os.remove(self.state_path)
+                raise
+        os.remove(self.state_path)
+        LOG.debug("Ranged Download Complete : %s/%s (%d of %d ranges fetched)"
+                  % (self.bucket, self.key, len(missing), self.part_count))
+        return self.size - self.resumed_bytes
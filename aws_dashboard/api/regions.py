@@ -0,0 +1,70 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Run a call in several regions at once.
+
+Calls run on a bounded, process-wide thread pool, so listing N regions
+takes about as long as the slowest region. A region that fails or misses
+the deadline is reported next to the results of the others.
+"""
+from concurrent import futures
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+LOG = logging.getLogger(__name__)
+AWS_REGION_FANOUT_WORKERS = getattr(settings, "AWS_REGION_FANOUT_WORKERS", 16)
+AWS_REGION_FANOUT_TIMEOUT = getattr(settings, "AWS_REGION_FANOUT_TIMEOUT", 20)
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = futures.ThreadPoolExecutor(AWS_REGION_FANOUT_WORKERS)
+    return _executor
+
+
+def fan_out(call, keys, timeout=AWS_REGION_FANOUT_TIMEOUT, executor=None):
+    """Run ``call(key)`` for every key, e.g. region names, in parallel.
+
+    Returns a tuple of a dict of the results and a dict of the error
+    messages, both keyed by key. A call still running after ``timeout``
+    seconds is reported as an error and left to end in the background.
+    """
+    start_time = time.time()
+    executor = executor or get_executor()
+    pending = dict((executor.submit(call, key), key) for key in keys)
+    done, not_done = futures.wait(pending, timeout=timeout)
+
+    results = {}
+    errors = {}
+    for future in done:
+        key = pending[future]
+        try:
+            results[key] = future.result()
+        except Exception as e:
+            LOG.warning("Fan out call failed : %s (%s)" % (key, e))
+            errors[key] = str(e)
+    for future in not_done:
+        future.cancel()
+        errors[pending[future]] = "Timed out after %d seconds" % timeout
+    LOG.debug("Fan out to %d calls in %.2f sec, %d failed"
+              % (len(pending), time.time() - start_time, len(errors)))
+    return results, errors
@@ -11,35 +11,25 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import hashlib
 import logging
 import os
 import threading
+import time
 
-import boto3
 from boto3.s3.transfer import S3Transfer
-from horizon.utils.memoized import memoized  # noqa
 
-from aws_dashboard.api.hybrid import utils
+from aws_dashboard.api import client_pool
+from aws_dashboard.api import multipart
+from aws_dashboard.api import ranged_download
+from aws_dashboard.api import transfer_tuning
 
 LOG = logging.getLogger(__name__)
 logging.getLogger("s3transfer").setLevel(logging.CRITICAL)
-s3_config = boto3.s3.transfer.TransferConfig(
-    multipart_threshold=64 * 1024 * 1024,
-    max_concurrency=10,
-    num_download_attempts=10,
-    multipart_chunksize=16 * 1024 * 1024,
-    max_io_queue=10000
-)
 
 
-@memoized
 def s3_client(request):
-    project_id = request.user.tenant_id
-    aws_access_key_id, aws_secret_access_key, region_name = utils.get_api_keys(project_id)
-    session = boto3.session.Session(aws_access_key_id=aws_access_key_id,
-                                    aws_secret_access_key=aws_secret_access_key,
-                                    region_name=region_name)
-    return session.client("s3")
+    return client_pool.get_client(request.user.tenant_id, "s3")
 
 
 def list_buckets(request):
@@ -47,24 +37,137 @@ def list_buckets(request):
     return [bucket["Name"] for bucket in response["Buckets"]]
 
 
-def upload_object(request, file_path, object_name=None):
+def _record_transfer(direction, transfer_plan, size, start_time, report, digest=None):
+    duration = max(time.time() - start_time, 0.001)
+    transfer_tuning.history.record(direction, transfer_plan, size, duration)
+    result = dict(transfer_plan, size=size, duration=duration, rate=size / duration)
+    if digest is not None:
+        result["digest"] = digest
+    LOG.debug("S3 %s : %d MB in %d MB parts, %d threads (%.1f MB/s)"
+              % (direction, size // (1024 * 1024), transfer_plan["part_size"] // (1024 * 1024),
+                 transfer_plan["concurrency"], result["rate"] / 1024 / 1024))
+    if report is not None:
+        report(result)
+    return result
+
+
+def upload_object(request, file_path, object_name=None, report=None):
+    """Upload a file to the project bucket.
+
+    Files over the multipart threshold are sent with a ResumableUpload, so
+    a retry after a failure only sends the parts S3 is missing. The ETag of
+    the object is checked against the one computed from the file.
+
+    :param report: called with the transfer plan, measures and digest, see
+                   transfer_tuning.plan and multipart.PartDigests
+    :raises multipart.UploadVerifyError: when S3 holds other data
+    """
     LOG.debug("Start Upload To S3 Image File  : %s" % file_path)
     if not object_name:
         object_name = file_path
     project_id = request.user.tenant_id
-    transfer = S3Transfer(s3_client(request), s3_config)
-    transfer.upload_file(file_path, project_id, object_name, callback=UploadProgress(file_path))
+    file_size = os.path.getsize(file_path)
+    transfer_plan = transfer_tuning.plan(transfer_tuning.UPLOAD, file_size)
+    start_time = time.time()
+    if file_size < transfer_tuning.MULTIPART_THRESHOLD:
+        transfer = S3Transfer(s3_client(request), transfer_tuning.transfer_config(transfer_plan))
+        transfer.upload_file(file_path, project_id, object_name, callback=UploadProgress(file_path))
+        sent = file_size
+        digest = _verify_small_object(request, file_path, object_name)
+    else:
+        upload = multipart.ResumableUpload(s3_client(request), project_id, object_name, file_path,
+                                           transfer_plan["part_size"],
+                                           transfer_plan["concurrency"],
+                                           progress=UploadProgress(file_path))
+        upload.run()
+        sent = upload.bytes_sent
+        digest = upload.digests.as_dict()
+    _record_transfer(transfer_tuning.UPLOAD, transfer_plan, sent, start_time, report, digest)
     LOG.debug("Upload Complete : %s" % file_path)
 
 
-def download_object(request, object_name, download_dir):
+def _verify_small_object(request, file_path, object_name):
+    """Check the ETag of an object sent in a single PUT, the MD5 of the file."""
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            md5.update(chunk)
+    etag = s3_client(request).head_object(Bucket=request.user.tenant_id,
+                                          Key=object_name).get("ETag", "").strip('"')
+    if etag != md5.hexdigest():
+        raise multipart.UploadVerifyError("%s/%s ETag %s does not match the MD5 of %s (%s)"
+                                          % (request.user.tenant_id, object_name, etag,
+                                             file_path, md5.hexdigest()))
+    return {"etag": etag, "sha256": None, "parts": 1}
+
+
+def abort_orphaned_uploads(project_id, max_age=multipart.AWS_MULTIPART_ORPHAN_AGE):
+    """Abort the multipart uploads of the project bucket nobody resumed."""
+    return multipart.abort_orphaned_uploads(client_pool.get_client(project_id, "s3"),
+                                            project_id, max_age)
+
+
+def multipart_uploader(request, object_name, size=None):
+    """MultipartUploader of an object of the project bucket.
+
+    :param size: expected size in bytes, if known, to size the parts
+    """
+    # Parts are held in memory, so the concurrency stays AWS_MULTIPART_CONCURRENCY.
+    transfer_plan = transfer_tuning.plan(transfer_tuning.UPLOAD, size)
+    return multipart.MultipartUploader(s3_client(request), request.user.tenant_id,
+                                       object_name, transfer_plan["part_size"])
+
+
+def report_upload(uploader, start_time, report):
+    """Report the measures and digest of a MultipartUploader, as upload_object does.
+
+    Its concurrency is the default one, not a plan, so it is not recorded
+    in the transfer history.
+    """
+    duration = max(time.time() - start_time, 0.001)
+    result = {"part_size": uploader.part_size, "concurrency": uploader.max_concurrency,
+              "size": uploader.bytes_sent, "duration": duration,
+              "rate": uploader.bytes_sent / duration, "digest": uploader.digests.as_dict()}
+    if report is not None:
+        report(result)
+    return result
+
+
+def upload_stream(request, chunks, object_name, size=None, report=None):
+    """Upload an iterable of chunks without staging them in a file.
+
+    :param report: called with the measures and digest, see report_upload
+    """
+    LOG.debug("Start Stream Upload To S3 : %s" % object_name)
+    start_time = time.time()
+    uploader = multipart_uploader(request, object_name, size)
+    uploader.start()
+    uploader.upload_stream(chunks)
+    report_upload(uploader, start_time, report)
+    LOG.debug("Upload Complete : %s" % object_name)
+    return uploader.bytes_sent
+
+
+def download_object(request, object_name, download_dir, report=None):
+    """Download an object of the project bucket into ``download_dir``.
+
+    The object is fetched by concurrent ranges, and a retry after a failure
+    only fetches the ranges missing from the file.
+
+    :param report: called with the transfer plan and measures, see
+                   transfer_tuning.plan
+    """
     bucket_name = request.user.tenant_id
     download_path = "%s/%s" % (download_dir, object_name)
     LOG.debug('Start Download S3 Object : %s/%s"' % (bucket_name, object_name))
     file_size = s3_client(request).head_object(Bucket=bucket_name, Key=object_name).get("ContentLength")
-    transfer = S3Transfer(s3_client(request), s3_config)
-    transfer.download_file(bucket_name, object_name, download_path,
-                           callback=DownloadProgress(download_path, file_size))
+    transfer_plan = transfer_tuning.plan(transfer_tuning.DOWNLOAD, file_size)
+    start_time = time.time()
+    fetched = ranged_download.RangedDownload(
+        s3_client(request), bucket_name, object_name, download_path,
+        transfer_plan["part_size"], transfer_plan["concurrency"],
+        progress=DownloadProgress(download_path, file_size)).run()
+    _record_transfer(transfer_tuning.DOWNLOAD, transfer_plan, fetched, start_time, report)
     LOG.debug('Download S3 Object Complete : %s (%d MB)' % (download_path, round(file_size / 1024 / 1024)))
     return download_path
 
@@ -0,0 +1,838 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from botocore.exceptions import ClientError
+from django.core.cache import caches
+from django.test.utils import override_settings
+
+from aws_dashboard.api import cache
+from aws_dashboard.api import catalog_builder
+from aws_dashboard.api import ebs
+from aws_dashboard.api.hybrid import jobs
+from aws_dashboard.api.hybrid import poller
+from aws_dashboard.api import multipart
+from aws_dashboard.api import ranged_download
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
+
+
+def fixture(name):
+    return io.open(os.path.join(FIXTURES, name), "r", encoding="utf-8")
+
+
+class JsonStreamTests(unittest.TestCase):
+
+    def test_walk_small_chunks(self):
+        # Values and strings split across every chunk boundary.
+        text = u'{"a": [1, 23456, {"x": "\\"}"}], "b": {"k": [true, null, -1.5e3]}}'
+        for chunk_size in (1, 2, 3, 7):
+            found = []
+            stream = catalog_builder.JsonStream(io.StringIO(text), chunk_size)
+            catalog_builder.walk(stream, {("b",): lambda k, v: found.append((k, v))})
+            self.assertEqual([(u"k", [True, None, -1500.0])], found)
+
+    def test_walk_documents(self):
+        text = u'{"p": [1]}\n{"p": [2, 3]}\n'
+        found = []
+        stream = catalog_builder.JsonStream(io.StringIO(text), 4)
+        catalog_builder.walk_documents(stream, {("p",): lambda i, v: found.append(v)})
+        self.assertEqual([1, 2, 3], found)
+
+    def test_read_floats_small_chunks(self):
+        # Numbers split at ".", "e" and their sign, as well as after digits.
+        text = u'[12.25, 1.5e3, 0.0416, -7.5E-2, 100]'
+        for chunk_size in range(1, len(text) + 1):
+            found = []
+            stream = catalog_builder.JsonStream(io.StringIO(text), chunk_size)
+            for index in stream.iter_container():
+                found.append(stream.read_value())
+            self.assertEqual([12.25, 1500.0, 0.0416, -0.075, 100], found)
+
+    def test_skip_value_small_chunks(self):
+        # Brackets and escapes inside skipped strings, split across chunks.
+        text = u'{"skip": {"s": "]}\\\\\\"[{", "l": [[], {}]}, "keep": [7]}'
+        for chunk_size in (1, 2, 3, 5):
+            found = []
+            stream = catalog_builder.JsonStream(io.StringIO(text), chunk_size)
+            catalog_builder.walk(stream, {("keep",): lambda i, v: found.append(v)})
+            self.assertEqual([7], found)
+
+
+class CatalogBuilderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_read_offer_file(self):
+        builder = catalog_builder.CatalogBuilder()
+        with fixture("ec2_offer.json") as f:
+            builder.read_offer_file(f)
+
+        self.assertEqual(["ap-northeast-2", "us-east-1"], sorted(builder.catalogs))
+        seoul = builder.catalogs["ap-northeast-2"]
+        self.assertEqual(["m4.large", "t2.micro"], sorted(seoul))
+        # The Windows product and the reserved term are ignored.
+        self.assertEqual("0.1230000000", seoul["m4.large"]["OnDemandPrice"])
+        self.assertEqual("8", seoul["m4.large"]["Memory"])
+        self.assertEqual("2.4", seoul["m4.large"]["ClockSpeed"])
+        self.assertEqual("Yes", seoul["m4.large"]["EBS_OPT"])
+        self.assertEqual("0.0144000000", seoul["t2.micro"]["OnDemandPrice"])
+        self.assertEqual("0.1000000000",
+                         builder.catalogs["us-east-1"]["m4.large"]["OnDemandPrice"])
+
+    def test_read_offer_file_terms_first(self):
+        text = u'{"terms": {"OnDemand": {"SKU": {}}}, "products": {}}'
+        builder = catalog_builder.CatalogBuilder()
+        self.assertRaises(ValueError, builder.read_offer_file, io.StringIO(text))
+
+    def test_read_offer_file_empty_products(self):
+        text = u'{"products": {}, "terms": {"OnDemand": {"SKU": {}}}}'
+        builder = catalog_builder.CatalogBuilder()
+        builder.read_offer_file(io.StringIO(text))
+        self.assertEqual({}, builder.catalogs)
+
+    def test_read_instance_types(self):
+        builder = catalog_builder.CatalogBuilder()
+        with fixture("ec2_offer.json") as f:
+            builder.read_offer_file(f)
+        with fixture("describe_instance_types.json") as f:
+            builder.read_instance_types(f, "ap-northeast-2")
+
+        seoul = builder.catalogs["ap-northeast-2"]
+        self.assertEqual(["c5d.large", "m4.large", "t2.micro"], sorted(seoul))
+        self.assertEqual("1 x 50 SSD", seoul["c5d.large"]["Storage"])
+        self.assertEqual("Yes", seoul["c5d.large"]["EnhancedNetworking"])
+        self.assertEqual("-", seoul["c5d.large"]["OnDemandPrice"])
+        # Specs are updated, the price from the offer file is kept.
+        self.assertEqual("-", seoul["m4.large"]["EnhancedNetworking"])
+        self.assertEqual("0.1230000000", seoul["m4.large"]["OnDemandPrice"])
+
+    def test_write(self):
+        builder = catalog_builder.CatalogBuilder()
+        with fixture("ec2_offer.json") as f:
+            builder.read_offer_file(f)
+        paths = builder.write(self.output_dir)
+
+        self.assertEqual([os.path.join(self.output_dir, "ap-northeast-2.json"),
+                          os.path.join(self.output_dir, "us-east-1.json")], paths)
+        with open(paths[0]) as f:
+            catalog = json.load(f)
+        self.assertEqual(builder.catalogs["ap-northeast-2"], catalog)
+        self.assertEqual(set(catalog_builder.CATALOG_KEYS), set(catalog["t2.micro"]))
+
+
+class FakeEbsClient(object):
+    """Local stand-in for the EBS direct APIs, keeping the blocks put."""
+
+    def __init__(self, fail_index=None, fail_read_index=None):
+        self.fail_index = fail_index
+        self.fail_read_index = fail_read_index
+        self.snapshots = {}
+        self.completed = {}
+
+    def start_snapshot(self, VolumeSize, Description, ClientToken, Timeout):
+        snapshot_id = "snap-%d" % (len(self.snapshots) + 1)
+        self.snapshots[snapshot_id] = {"volume_size": VolumeSize, "blocks": {}}
+        return {"SnapshotId": snapshot_id, "BlockSize": ebs.BLOCK_SIZE}
+
+    def put_snapshot_block(self, SnapshotId, BlockIndex, BlockData, DataLength,
+                           Checksum, ChecksumAlgorithm):
+        if BlockIndex == self.fail_index:
+            raise IOError("connection reset")
+        assert DataLength == len(BlockData) == ebs.BLOCK_SIZE
+        assert Checksum == base64.b64encode(hashlib.sha256(BlockData).digest()).decode("ascii")
+        self.snapshots[SnapshotId]["blocks"][BlockIndex] = BlockData
+        return {"Checksum": Checksum, "ChecksumAlgorithm": ChecksumAlgorithm}
+
+    def complete_snapshot(self, SnapshotId, ChangedBlocksCount):
+        self.completed[SnapshotId] = ChangedBlocksCount
+        return {"Status": "pending"}
+
+    def list_snapshot_blocks(self, SnapshotId, NextToken=None):
+        # One block per page, to go through the pagination
+        indexes = sorted(self.snapshots[SnapshotId]["blocks"])
+        position = int(NextToken or 0)
+        response = {"VolumeSize": self.snapshots[SnapshotId]["volume_size"],
+                    "BlockSize": ebs.BLOCK_SIZE,
+                    "Blocks": [{"BlockIndex": i, "BlockToken": "token-%d" % i}
+                               for i in indexes[position:position + 1]]}
+        if position + 1 < len(indexes):
+            response["NextToken"] = str(position + 1)
+        return response
+
+    def get_snapshot_block(self, SnapshotId, BlockIndex, BlockToken):
+        assert BlockToken == "token-%d" % BlockIndex
+        if BlockIndex == self.fail_read_index:
+            raise IOError("connection reset")
+        data = self.snapshots[SnapshotId]["blocks"][BlockIndex]
+        return {"BlockData": io.BytesIO(data), "DataLength": len(data),
+                "Checksum": base64.b64encode(hashlib.sha256(data).digest()).decode("ascii"),
+                "ChecksumAlgorithm": "SHA256"}
+
+
+class EbsSnapshotWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.image_path = tempfile.mkstemp(suffix=".raw")
+        os.close(fd)
+        block = ebs.BLOCK_SIZE
+        with open(self.image_path, "wb") as f:
+            f.write(b"boot" * (block // 4))
+            # Block 3 written with zeros, blocks 1-2 and 4-9 left as holes
+            f.seek(3 * block)
+            f.write(b"\0" * block)
+            # Short last block
+            f.seek(10 * block)
+            f.write(b"tail")
+
+    def tearDown(self):
+        os.remove(self.image_path)
+
+    def test_write_sends_non_zero_blocks(self):
+        client = FakeEbsClient()
+        result = ebs.SnapshotWriter(client, "test-image", max_concurrency=4).write(
+            self.image_path)
+
+        snapshot = client.snapshots[result["snapshot_id"]]
+        self.assertEqual([0, 10], sorted(snapshot["blocks"]))
+        self.assertEqual(b"boot" * (ebs.BLOCK_SIZE // 4), snapshot["blocks"][0])
+        self.assertEqual(b"tail" + b"\0" * (ebs.BLOCK_SIZE - 4), snapshot["blocks"][10])
+        self.assertEqual(1, snapshot["volume_size"])
+        self.assertEqual(2, client.completed[result["snapshot_id"]])
+        self.assertEqual(2, result["blocks_sent"])
+        self.assertEqual(2048, result["volume_blocks"])
+
+    def test_read_restores_image(self):
+        client = FakeEbsClient()
+        snapshot_id = ebs.SnapshotWriter(client, "test-image").write(self.image_path)["snapshot_id"]
+        output_path = self.image_path + ".read"
+        self.addCleanup(os.remove, output_path)
+
+        result = ebs.SnapshotReader(client, snapshot_id, max_concurrency=4).read(output_path)
+
+        self.assertEqual(2, result["blocks_read"])
+        self.assertEqual(ebs.GiB, os.path.getsize(output_path))
+        with open(self.image_path, "rb") as f:
+            original = f.read()
+        with open(output_path, "rb") as f:
+            self.assertEqual(original, f.read(len(original)))
+
+    def test_failed_block_leaves_snapshot_incomplete(self):
+        client = FakeEbsClient(fail_index=10)
+        writer = ebs.SnapshotWriter(client, "test-image", max_concurrency=1)
+        self.assertRaises(IOError, writer.write, self.image_path)
+        self.assertEqual("snap-1", writer.snapshot_id)
+        self.assertEqual({}, client.completed)
+
+    def test_failed_block_releases_budget(self):
+        with open(self.image_path, "wb") as f:
+            f.write(b"data" * (16 * ebs.BLOCK_SIZE // 4))
+        client = FakeEbsClient(fail_index=0)
+        writer = ebs.SnapshotWriter(client, "test-image", max_concurrency=1)
+        self.assertRaises(IOError, writer.write, self.image_path)
+        self.assertEqual(multipart.BUDGET.capacity, multipart.BUDGET.available)
+
+    def test_failed_read_releases_budget(self):
+        with open(self.image_path, "wb") as f:
+            f.write(b"data" * (16 * ebs.BLOCK_SIZE // 4))
+        client = FakeEbsClient(fail_read_index=0)
+        snapshot_id = ebs.SnapshotWriter(client, "test-image").write(self.image_path)["snapshot_id"]
+        output_path = self.image_path + ".read"
+        self.addCleanup(os.remove, output_path)
+
+        reader = ebs.SnapshotReader(client, snapshot_id, max_concurrency=1)
+        self.assertRaises(IOError, reader.read, output_path)
+        self.assertEqual(multipart.BUDGET.capacity, multipart.BUDGET.available)
+
+
+class FakeS3Client(object):
+    """Local stand-in for the S3 multipart and object APIs."""
+
+    def __init__(self, fail_part=None, fail_range=None):
+        self.fail_part = fail_part
+        self.fail_range = fail_range
+        self.uploads = {}
+        self.objects = {}
+        self.aborted = []
+        self.part_calls = []
+        self.range_calls = []
+        self._lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = "upload-%d" % (len(self.uploads) + 1)
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5):
+        with self._lock:
+            self.part_calls.append(PartNumber)
+        if PartNumber == self.fail_part:
+            raise IOError("connection reset")
+        data = bytes(Body.read() if hasattr(Body, "read") else Body)
+        md5 = hashlib.md5(data).digest()
+        assert ContentMD5 == base64.b64encode(md5).decode("ascii")
+        self.uploads[UploadId][PartNumber] = (data, md5)
+        return {"ETag": '"%s"' % hashlib.md5(data).hexdigest()}
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0):
+        if UploadId not in self.uploads:
+            raise ClientError({"Error": {"Code": "NoSuchUpload"}}, "ListParts")
+        return {"Parts": [{"PartNumber": n, "ETag": '"%s"' % hashlib.md5(d).hexdigest()}
+                          for n, (d, md5) in sorted(self.uploads[UploadId].items())],
+                "IsTruncated": False}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [p["PartNumber"] for p in MultipartUpload["Parts"]]
+        self.objects[Key] = b"".join(parts[n][0] for n in numbers)
+        etag = hashlib.md5(b"".join(parts[n][1] for n in numbers)).hexdigest()
+        return {"ETag": '"%s-%d"' % (etag, len(numbers))}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+        self.aborted.append(UploadId)
+
+    def head_object(self, Bucket, Key):
+        data = self.objects[Key]
+        return {"ContentLength": len(data), "ETag": '"%s"' % hashlib.md5(data).hexdigest()}
+
+    def get_object(self, Bucket, Key, Range, IfMatch):
+        start, end = [int(n) for n in Range[len("bytes="):].split("-")]
+        with self._lock:
+            self.range_calls.append(start)
+        if start == self.fail_range:
+            raise IOError("connection reset")
+        head = self.head_object(Bucket, Key)
+        if IfMatch != head["ETag"]:
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "GetObject")
+        data = self.objects[Key][start:end + 1]
+        return {"Body": io.BytesIO(data), "ContentLength": len(data), "ETag": head["ETag"]}
+
+
+class ResumableUploadTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.file_path = tempfile.mkstemp(suffix=".raw")
+        os.close(fd)
+        self.part_size = multipart.MIN_PART_SIZE
+        with open(self.file_path, "wb") as f:
+            for n in range(6):
+                f.write(bytes(bytearray([n + 1])) * self.part_size)
+        self.addCleanup(self._remove, self.file_path + ".upload.json")
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    @staticmethod
+    def _remove(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _upload(self, client):
+        return multipart.ResumableUpload(client, "bucket", "key", self.file_path,
+                                         part_size=self.part_size, max_concurrency=1)
+
+    def test_failed_part_cancels_queued_parts(self):
+        client = FakeS3Client(fail_part=1)
+        self.assertRaises(IOError, self._upload(client).run)
+        # The part running when the first one failed may still be sent.
+        self.assertLessEqual(len(client.part_calls), 2)
+        self.assertEqual(multipart.BUDGET.capacity, multipart.BUDGET.available)
+
+    def test_resume_sends_missing_parts(self):
+        client = FakeS3Client(fail_part=3)
+        self.assertRaises(IOError, self._upload(client).run)
+        self.assertTrue(os.path.exists(self.file_path + ".upload.json"))
+
+        client.fail_part = None
+        client.part_calls = []
+        self._upload(client).run()
+
+        self.assertNotIn(1, client.part_calls)
+        self.assertNotIn(2, client.part_calls)
+        self.assertIn(3, client.part_calls)
+        # Completed the first upload rather than starting another one.
+        self.assertEqual({}, client.uploads)
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(f.read(), client.objects["key"])
+        self.assertFalse(os.path.exists(self.file_path + ".upload.json"))
+
+    def test_resume_sends_parts_which_do_not_match_again(self):
+        client = FakeS3Client(fail_part=3)
+        self.assertRaises(IOError, self._upload(client).run)
+        data, md5 = client.uploads["upload-1"][2]
+        client.uploads["upload-1"][2] = (b"corrupt" + data[7:], md5)
+
+        client.fail_part = None
+        client.part_calls = []
+        self._upload(client).run()
+
+        self.assertNotIn(1, client.part_calls)
+        self.assertIn(2, client.part_calls)
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(f.read(), client.objects["key"])
+
+    def test_gone_upload_starts_over(self):
+        client = FakeS3Client(fail_part=3)
+        self.assertRaises(IOError, self._upload(client).run)
+        client.abort_multipart_upload(Bucket="bucket", Key="key", UploadId="upload-1")
+
+        client.fail_part = None
+        client.part_calls = []
+        self._upload(client).run()
+
+        self.assertEqual([1, 2, 3, 4, 5, 6], sorted(client.part_calls))
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(f.read(), client.objects["key"])
+
+
+class RangedDownloadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.output_dir, "image.raw")
+        self.data = b"".join(bytes(bytearray([n + 1])) * 1024 for n in range(6))
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _download(self, client):
+        return ranged_download.RangedDownload(client, "bucket", "key", self.file_path,
+                                              part_size=1024, max_concurrency=1)
+
+    def test_failed_range_cancels_queued_ranges(self):
+        client = FakeS3Client(fail_range=0)
+        client.objects["key"] = self.data
+        self.assertRaises(IOError, self._download(client).run)
+        # The range running when the first one failed may still be fetched.
+        self.assertLessEqual(len(client.range_calls), 2)
+
+    def test_resume_fetches_missing_ranges(self):
+        client = FakeS3Client(fail_range=2048)
+        client.objects["key"] = self.data
+        self.assertRaises(IOError, self._download(client).run)
+        self.assertTrue(os.path.exists(self.file_path + ".download.json"))
+
+        client.fail_range = None
+        client.range_calls = []
+        fetched = self._download(client).run()
+
+        self.assertNotIn(0, client.range_calls)
+        self.assertNotIn(1024, client.range_calls)
+        self.assertIn(2048, client.range_calls)
+        self.assertEqual(1024 * len(client.range_calls), fetched)
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(self.data, f.read())
+        self.assertFalse(os.path.exists(self.file_path + ".download.json"))
+
+    def test_changed_object_starts_over(self):
+        client = FakeS3Client()
+        client.objects["key"] = self.data
+        get_object = client.get_object
+
+        def get_object_of_new_version(**kwargs):
+            client.objects["key"] = b"new" + self.data[3:]
+            return get_object(**kwargs)
+
+        client.get_object = get_object_of_new_version
+        self.assertRaises(ranged_download.ObjectChanged, self._download(client).run)
+        # The ranges written belong to the old version, nothing is resumed.
+        self.assertFalse(os.path.exists(self.file_path + ".download.json"))
+
+        client.get_object = get_object
+        client.range_calls = []
+        self.assertEqual(len(self.data), self._download(client).run())
+        self.assertEqual([0, 1024, 2048, 3072, 4096, 5120], sorted(client.range_calls))
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(client.objects["key"], f.read())
+
+
+class MultipartUploaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.part_size = multipart.MIN_PART_SIZE
+        self.client = FakeS3Client()
+        self.uploader = multipart.MultipartUploader(self.client, "bucket", "key",
+                                                    part_size=self.part_size,
+                                                    max_concurrency=2)
+        self.uploader.start()
+
+    def test_write_takes_budget_before_buffering(self):
+        self.uploader.write(b"x")
+        self.assertEqual(multipart.BUDGET.capacity - self.part_size,
+                         multipart.BUDGET.available)
+        self.uploader.abort()
+        self.assertEqual(multipart.BUDGET.capacity, multipart.BUDGET.available)
+        self.assertEqual(["upload-1"], self.client.aborted)
+
+    def test_upload_in_parts(self):
+        data = b"".join(bytes(bytearray([n])) * (self.part_size // 2) for n in range(5))
+        for start in range(0, len(data), 1024 * 1024):
+            self.uploader.write(data[start:start + 1024 * 1024])
+        self.uploader.complete()
+
+        self.assertEqual(data, self.client.objects["key"])
+        self.assertEqual([1, 2, 3], sorted(self.client.part_calls))
+        self.assertEqual(multipart.BUDGET.capacity, multipart.BUDGET.available)
+
+
+class MemoryBudgetTests(unittest.TestCase):
+
+    def test_acquire_and_release(self):
+        budget = multipart.MemoryBudget(100)
+        self.assertEqual(60, budget.acquire(60))
+        self.assertEqual(40, budget.available)
+        budget.release(60)
+        self.assertEqual(100, budget.available)
+
+    def test_acquire_more_than_capacity(self):
+        # A part larger than the budget takes all of it rather than blocking forever.
+        budget = multipart.MemoryBudget(100)
+        self.assertEqual(100, budget.acquire(250))
+        self.assertEqual(0, budget.available)
+        budget.release(100)
+        self.assertEqual(100, budget.available)
+
+    def test_acquire_waits_for_release(self):
+        budget = multipart.MemoryBudget(100)
+        budget.acquire(80)
+        acquired = threading.Event()
+
+        def acquire():
+            budget.acquire(50)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.2))
+        budget.release(80)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(50, budget.available)
+
+
+class PartDigestsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.parts = [b"a" * 10, b"b" * 10, b"c" * 5]
+        self.digests = multipart.PartDigests()
+        # Added out of order, as the parts of concurrent uploads complete.
+        for part_number in (2, 1, 3):
+            self.digests.add(part_number, self.parts[part_number - 1])
+
+    def test_etag(self):
+        md5 = hashlib.md5(b"".join(hashlib.md5(p).digest() for p in self.parts))
+        self.assertEqual("%s-3" % md5.hexdigest(), self.digests.etag)
+
+    def test_verify(self):
+        self.digests.verify("bucket", "key", '"%s"' % self.digests.etag)
+        self.digests.verify("bucket", "key", self.digests.etag)
+
+    def test_verify_mismatch(self):
+        other = multipart.PartDigests()
+        for part_number, data in enumerate([b"a" * 10, b"x" * 10, b"c" * 5], 1):
+            other.add(part_number, data)
+        self.assertRaises(multipart.UploadVerifyError, self.digests.verify,
+                          "bucket", "key", '"%s"' % other.etag)
+        self.assertRaises(multipart.UploadVerifyError, self.digests.verify,
+                          "bucket", "key", None)
+
+
+class FakeUser(object):
+
+    def __init__(self, user_id, tenant_id):
+        self.id = user_id
+        self.tenant_id = tenant_id
+
+
+class FakeRequest(object):
+
+    def __init__(self, user_id="user-1", tenant_id="project-1"):
+        self.user = FakeUser(user_id, tenant_id)
+
+
+class PollerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.objects = {}
+        self.fetches = []
+        self.bad_ids = set()
+        poller.RESOURCES["test_resource"] = (self._fetch, lambda o: o["state"],
+                                             ("done",), ("failed",))
+        self.addCleanup(poller.RESOURCES.pop, "test_resource")
+        # Not started: the tests poll by hand.
+        self.poller = poller.Poller(backoff=2, max_interval=60, max_misses=2)
+
+    def _fetch(self, request, ids):
+        self.fetches.append((request.user.id, request.user.tenant_id, list(ids)))
+        if self.bad_ids & set(ids):
+            raise ValueError("invalid id")
+        return dict((i, self.objects[i]) for i in ids if i in self.objects)
+
+    def _submit(self, resource_id, request=None):
+        return self.poller.submit("test_resource", request or FakeRequest(), resource_id, 10)
+
+    def _poll(self):
+        self.poller.poll(list(self.poller._waits))
+
+    def test_poll_in_one_batch(self):
+        self.objects = {"a": {"state": "done"}, "b": {"state": "running"},
+                        "c": {"state": "failed"}}
+        waits = [self._submit(resource_id) for resource_id in ("c", "a", "b")]
+        self._poll()
+
+        self.assertEqual([("user-1", "project-1", ["a", "b", "c"])], self.fetches)
+        self.assertEqual({"state": "done"}, waits[1].result(0))
+        self.assertRaises(poller.WaitFailed, waits[0].result, 0)
+        self.assertFalse(waits[2].done())
+        # The running one backs off and is checked again later.
+        wait = self.poller._waits[0]
+        self.assertEqual(20, wait.delay)
+        self.assertGreaterEqual(wait.due, wait.ready)
+
+    def test_batch_per_project_and_user(self):
+        self.objects = {"a": {"state": "done"}, "b": {"state": "done"},
+                        "c": {"state": "done"}}
+        self._submit("a", FakeRequest("user-1", "project-1"))
+        self._submit("b", FakeRequest("user-1", "project-2"))
+        self._submit("c", FakeRequest("user-2", "project-1"))
+        self._poll()
+
+        self.assertEqual([("user-1", "project-1", ["a"]), ("user-1", "project-2", ["b"]),
+                          ("user-2", "project-1", ["c"])], sorted(self.fetches))
+        self.assertEqual([], self.poller._waits)
+
+    def test_isolate_failing_id(self):
+        self.objects = {"a": {"state": "done"}, "c": {"state": "running"}}
+        self.bad_ids = set(["bad"])
+        waits = [self._submit(resource_id) for resource_id in ("a", "bad", "c")]
+        self._poll()
+
+        # The failed batch is fetched again one id at a time.
+        self.assertEqual([["a", "bad", "c"], ["a"], ["bad"], ["c"]],
+                         [ids for user_id, project_id, ids in self.fetches])
+        self.assertEqual({"state": "done"}, waits[0].result(0))
+        self.assertFalse(waits[1].done())
+        self.assertFalse(waits[2].done())
+        self.assertEqual(set(["bad"]), self.poller._isolated)
+
+        # The others are batched again, the bad one stays on its own.
+        del self.fetches[:]
+        self.objects["c"] = {"state": "done"}
+        self._poll()
+        self.assertEqual([["c"], ["bad"]], [ids for user_id, project_id, ids in self.fetches])
+        self.assertEqual({"state": "done"}, waits[2].result(0))
+        self.assertFalse(waits[1].done())
+
+    def test_fail_after_misses(self):
+        wait = self._submit("a")
+        self._poll()
+        self.assertFalse(wait.done())
+        self._poll()
+        self.assertRaises(poller.WaitFailed, wait.result, 0)
+
+    def test_found_resets_misses(self):
+        wait = self._submit("a")
+        self._poll()
+        self.objects["a"] = {"state": "running"}
+        self._poll()
+        del self.objects["a"]
+        self._poll()
+        self.assertFalse(wait.done())
+
+    def test_timeout(self):
+        self.objects = {"a": {"state": "running"}}
+        wait = self.poller.submit("test_resource", FakeRequest(), "a", 10, timeout=-1)
+        self._poll()
+        self.assertRaises(poller.WaitTimeout, wait.result, 0)
+
+
+class CacheTests(unittest.TestCase):
+
+    def setUp(self):
+        keys = {"AWS_ACCESS_KEY_ID": "key", "AWS_SECRET_ACCESS_KEY": "secret",
+                "AWS_REGION_NAME": "ap-northeast-2"}
+        settings = override_settings(AWS_API_KEY_DICT={"project-1": keys, "project-2": keys})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        caches[cache.AWS_CACHE_BACKEND].clear()
+        cache.LOCAL_CACHE.clear()
+        self.addCleanup(cache.LOCAL_CACHE.clear)
+        cache.AWS_CACHE_TTL["test_resource"] = 60
+        self.addCleanup(cache.AWS_CACHE_TTL.pop, "test_resource")
+        self.calls = []
+
+    def _describe(self, *args):
+        self.calls.append(args)
+        return {"args": args, "call": len(self.calls)}
+
+    def _get(self, project_id, *args):
+        return cache.get_or_call(project_id, "test_resource", "describe", self._describe, *args)
+
+    def test_cached(self):
+        self.assertEqual(1, self._get("project-1", "a")["call"])
+        self.assertEqual(1, self._get("project-1", "a")["call"])
+        self.assertEqual(2, self._get("project-1", "b")["call"])
+        self.assertEqual(3, self._get("project-2", "a")["call"])
+
+    def test_shared_between_workers(self):
+        self._get("project-1", "a")
+        # Another worker has nothing in its local cache.
+        cache.LOCAL_CACHE.clear()
+        self.assertEqual(1, self._get("project-1", "a")["call"])
+        self.assertEqual(1, len(self.calls))
+
+    def test_invalidate_bumps_generation(self):
+        self._get("project-1", "a")
+        self._get("project-2", "a")
+        cache.invalidate("project-1", "test_resource")
+
+        # Stale in every worker, the local cache included.
+        self.assertEqual(3, self._get("project-1", "a")["call"])
+        self.assertEqual(2, self._get("project-2", "a")["call"])
+        self.assertEqual(3, self._get("project-1", "a")["call"])
+
+    def test_invalidate_without_generation(self):
+        # Evicted or never read generation: invalidated all the same.
+        cache.invalidate("project-1", "test_resource")
+        self.assertEqual(1, self._get("project-1", "a")["call"])
+        cache.invalidate("project-1", "test_resource")
+        self.assertEqual(2, self._get("project-1", "a")["call"])
+
+    def test_without_ttl(self):
+        cache.AWS_CACHE_TTL["test_resource"] = 0
+        self._get("project-1", "a")
+        self._get("project-1", "a")
+        self.assertEqual(2, len(self.calls))
+
+
+class JobStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        self.store = jobs.JobStore(os.path.join(self.store_dir, "jobs", "jobs.sqlite3"))
+        self.payload = {"user": {"id": "user-1", "project_id": "project-1",
+                                 "region": "RegionOne"},
+                        "trust_id": "trust-1", "data": {"name": "vm"}, "kwargs": {"a": 1}}
+
+    def _create(self, name="vm"):
+        return self.store.create("import_instance", "project-1", name, self.payload,
+                                 ["snapshot", "upload", "import"])
+
+    def test_private_store(self):
+        self._create()
+        self.assertEqual(0o600, os.stat(self.store.path).st_mode & 0o777)
+        self.assertEqual(0o700, os.stat(os.path.dirname(self.store.path)).st_mode & 0o777)
+
+    def test_claim_oldest(self):
+        first = self._create("first")
+        self._create("second")
+
+        job, payload = self.store.claim("worker-1")
+        self.assertEqual(first, job.id)
+        self.assertEqual(jobs.RUNNING, job.status)
+        self.assertEqual("worker-1", job.worker)
+        self.assertEqual(1, job.attempts)
+        self.assertEqual(self.payload, payload)
+        self.assertEqual(["snapshot", "upload", "import"], [s["name"] for s in job.stages])
+
+        job, payload = self.store.claim("worker-2")
+        self.assertEqual("second", job.name)
+        self.assertIsNone(self.store.claim("worker-3"))
+
+    def test_claim_stale_job(self):
+        job_id = self._create()
+        self.store.claim("worker-1")
+        self.assertIsNone(self.store.claim("worker-2"))
+
+        # Its worker died: no heartbeat since.
+        job, payload = self.store.claim("worker-2", stale_timeout=-1)
+        self.assertEqual(job_id, job.id)
+        self.assertEqual("worker-2", job.worker)
+        self.assertEqual(2, job.attempts)
+
+    def test_claim_retry_after_delay(self):
+        job_id = self._create()
+        self.store.claim("worker-1")
+        self.store.retry(job_id, "failed", 3600)
+        self.assertIsNone(self.store.claim("worker-1"))
+
+        self.store.retry(job_id, "failed", 0)
+        job, payload = self.store.claim("worker-1")
+        self.assertEqual(job_id, job.id)
+        self.assertEqual(2, job.attempts)
+
+    def test_resume_failed_job(self):
+        job_id = self._create()
+        job, payload = self.store.claim("worker-1")
+        self.store.update_stage(job_id, "snapshot", jobs.COMPLETED)
+        self.store.save_outputs(job_id, "snapshot", {"snapshot_id": "snap-1"})
+        self.store.finish(job_id, jobs.FAILED, error="failed")
+
+        user = {"id": "user-2", "project_id": "project-1", "region": "RegionOne"}
+        self.assertTrue(self.store.resume(job_id, user, "trust-2"))
+        # Only failed jobs are resumed.
+        self.assertFalse(self.store.resume(job_id, user, "trust-3"))
+
+        job, payload = self.store.claim("worker-2")
+        self.assertEqual(job_id, job.id)
+        self.assertEqual(1, job.attempts)
+        self.assertIsNone(job.error)
+        self.assertEqual(user, payload["user"])
+        self.assertEqual("trust-2", payload["trust_id"])
+        self.assertEqual({"name": "vm"}, payload["data"])
+        self.assertEqual({"snapshot_id": "snap-1"}, job.stages[0]["outputs"])
+
+    def test_run_stages_resumes_at_first_incomplete_stage(self):
+        job_id = self._create()
+        job, payload = self.store.claim("worker-1")
+        calls = []
+
+        def stage(name, fail=False):
+            def func(request, job, state):
+                calls.append(name)
+                if fail:
+                    raise IOError("connection reset")
+                return {name + "_id": "%s-%d" % (name, len(calls))}
+            return name, func
+
+        flow = [stage("snapshot"), stage("upload", fail=True), stage("import")]
+        self.assertRaises(IOError, jobs.RunningJob(job, self.store).run_stages,
+                          None, flow, {})
+        job = self.store.get(job_id)
+        self.assertEqual([jobs.COMPLETED, jobs.FAILED, jobs.PENDING],
+                         [s["status"] for s in job.stages])
+
+        del calls[:]
+        flow[1] = stage("upload")
+        state = jobs.RunningJob(job, self.store).run_stages(None, flow, {})
+        self.assertEqual(["upload", "import"], calls)
+        self.assertEqual({"snapshot_id": "snapshot-1", "upload_id": "upload-1",
+                          "import_id": "import-2"}, state)
+        self.assertEqual([jobs.COMPLETED] * 3,
+                         [s["status"] for s in self.store.get(job_id).stages])
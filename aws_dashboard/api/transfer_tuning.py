@@ -0,0 +1,146 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""S3 transfer settings picked per object.
+
+The part size grows with the object so that it stays well under the
+10,000-part limit of S3. The concurrency comes from the aggregate
+throughput measured at each concurrency on the last transfers of the host,
+kept in a small JSON history: the best one so far, or twice as many threads
+while the best is also the highest tried, short of AWS_TRANSFER_TARGET_RATE
+and still gaining on the level below. A host whose link or CPU is already
+saturated thus stays where more threads stopped helping.
+"""
+import json
+import logging
+import os
+import threading
+
+from boto3.s3.transfer import TransferConfig
+from django.conf import settings
+
+from aws_dashboard.api import multipart
+
+LOG = logging.getLogger(__name__)
+AWS_TRANSFER_HISTORY_PATH = getattr(settings, "AWS_TRANSFER_HISTORY_PATH", os.path.join(
+    getattr(settings, "IMAGE_TASK_WORKING_PATH", "/tmp"), "aws_dashboard_transfers.json"))
+AWS_TRANSFER_HISTORY_SIZE = getattr(settings, "AWS_TRANSFER_HISTORY_SIZE", 20)
+# Aggregate bytes/s the concurrency is sized for
+AWS_TRANSFER_TARGET_RATE = getattr(settings, "AWS_TRANSFER_TARGET_RATE", 1024 * 1024 * 1024)
+AWS_TRANSFER_MIN_CONCURRENCY = getattr(settings, "AWS_TRANSFER_MIN_CONCURRENCY", 4)
+AWS_TRANSFER_MAX_CONCURRENCY = getattr(settings, "AWS_TRANSFER_MAX_CONCURRENCY", 32)
+
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+# Concurrency until the history has a measure
+DEFAULT_CONCURRENCY = 10
+# Parts used at most, leaving headroom under the S3 limit
+MAX_PARTS = int(multipart.MAX_PARTS * 0.8)
+# Transfers too short to measure the link
+MIN_RECORDED_SIZE = 64 * 1024 * 1024
+# Gain over the level below for more threads to be tried
+MIN_GAIN = 0.1
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+
+class TransferHistory(object):
+    """Concurrency and aggregate throughput of the last transfers, by direction."""
+
+    def __init__(self, path=AWS_TRANSFER_HISTORY_PATH, size=AWS_TRANSFER_HISTORY_SIZE):
+        self.path = path
+        self.size = size
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as history_file:
+                return json.load(history_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, history):
+        tmp_path = "%s.tmp" % self.path
+        try:
+            with open(tmp_path, "w") as history_file:
+                json.dump(history, history_file)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            LOG.warning("Save Transfer History Fail : %s (%s)" % (self.path, e))
+
+    def record(self, direction, transfer_plan, size, duration):
+        """Add a transfer of ``size`` bytes in ``duration`` seconds made with a plan."""
+        if size < MIN_RECORDED_SIZE or duration <= 0:
+            return
+        entry = {"concurrency": transfer_plan["concurrency"], "rate": size / float(duration)}
+        with self._lock:
+            history = self._load()
+            entries = history.setdefault(direction, [])
+            entries.append(entry)
+            del entries[:-self.size]
+            self._save(history)
+
+    def aggregate_rates(self, direction):
+        """Median aggregate bytes/s of the transfers by concurrency."""
+        with self._lock:
+            entries = self._load().get(direction, [])
+        by_concurrency = {}
+        for entry in entries:
+            by_concurrency.setdefault(entry["concurrency"], []).append(entry["rate"])
+        return dict((c, sorted(r)[len(r) // 2]) for c, r in by_concurrency.items())
+
+
+history = TransferHistory()
+
+
+def pick_concurrency(rates):
+    """Concurrency of the next transfer given aggregate ``rates`` by concurrency."""
+    if not rates:
+        return DEFAULT_CONCURRENCY
+    # Fewest threads among equal rates
+    best = max(rates, key=lambda c: (rates[c], -c))
+    concurrency = best
+    if best == max(rates) and rates[best] < AWS_TRANSFER_TARGET_RATE:
+        lower = [c for c in rates if c < best]
+        if not lower or rates[best] >= rates[max(lower)] * (1 + MIN_GAIN):
+            # Still gaining at the highest concurrency tried: try more.
+            concurrency = best * 2
+    return max(AWS_TRANSFER_MIN_CONCURRENCY, min(concurrency, AWS_TRANSFER_MAX_CONCURRENCY))
+
+
+def plan(direction, size):
+    """Part size and concurrency of a transfer of ``size`` bytes.
+
+    :returns: dict of the part_size, concurrency and the aggregate_rate
+              measured at that concurrency (None without history), stored
+              as is in the job metadata
+    """
+    part_size = multipart.part_size_for(size, max_parts=MAX_PARTS)
+    rates = history.aggregate_rates(direction)
+    concurrency = pick_concurrency(rates)
+    if size:
+        # No more threads than parts
+        concurrency = max(min(concurrency, -(-size // part_size)), 1)
+    return {"part_size": part_size, "concurrency": concurrency,
+            "aggregate_rate": rates.get(concurrency)}
+
+
+def transfer_config(transfer_plan):
+    """boto3 TransferConfig of a plan."""
+    return TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        max_concurrency=transfer_plan["concurrency"],
+        num_download_attempts=10,
+        multipart_chunksize=transfer_plan["part_size"],
+        max_io_queue=10000
+    )
@@ -13,6 +13,7 @@
 # limitations under the License.
 import logging
 
+from botocore.exceptions import ClientError
 from openstack_dashboard.api import base
 
 from aws_dashboard.api.ec2 import ec2_client
@@ -73,6 +74,47 @@ def get_import_image_task(request, task_id):
     return ImportTask(response.get('ImportImageTasks')[0])
 
 
+def _is_unknown_id(error):
+    code = error.response.get("Error", {}).get("Code", "")
+    return (code.endswith(".NotFound") or code.endswith(".Malformed") or
+            code.startswith("InvalidParameter"))
+
+
+def _describe_tasks(describe, ids_name, key, task_ids):
+    """Describe the tasks of several ids, leaving the unknown ones out.
+
+    These calls have no id filter and fail as a whole on one unknown id,
+    in which case the ids are described one by one.
+    """
+    task_ids = list(task_ids)
+    try:
+        return describe(**{ids_name: task_ids}).get(key, [])
+    except ClientError as e:
+        if not _is_unknown_id(e):
+            raise
+        if len(task_ids) == 1:
+            LOG.debug("Unknown Task : %s (%s)" % (task_ids[0], e))
+            return []
+    tasks = []
+    for task_id in task_ids:
+        tasks.extend(_describe_tasks(describe, ids_name, key, [task_id]))
+    return tasks
+
+
+def get_export_tasks(request, task_ids):
+    """Get several export tasks; unknown ids are left out of the result."""
+    tasks = _describe_tasks(ec2_client(request).describe_export_tasks, "ExportTaskIds",
+                            "ExportTasks", task_ids)
+    return [ExportTask(t) for t in tasks]
+
+
+def get_import_image_tasks(request, task_ids):
+    """Get several import image tasks; unknown ids are left out of the result."""
+    tasks = _describe_tasks(ec2_client(request).describe_import_image_tasks,
+                            "ImportTaskIds", "ImportImageTasks", task_ids)
+    return [ImportTask(t) for t in tasks]
+
+
 def cancel_export_task(request, task_id):
     ec2_client(request).cancel_export_task(ExportTaskIds=[task_id])
 
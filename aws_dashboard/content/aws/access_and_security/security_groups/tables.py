@@ -24,6 +24,7 @@ from openstack_dashboard import api
 from openstack_dashboard import policy
 
 from aws_dashboard.api import ec2
+from aws_dashboard.content.aws import regions
 
 
 class DeleteGroup(policy.PolicyTargetMixin, tables.DeleteAction):
@@ -103,9 +104,10 @@ class SecurityGroupsFilterAction(tables.FilterAction):
                 if query in security_group.name.lower()]
 
 
-class SecurityGroupsTable(tables.DataTable):
+class SecurityGroupsTable(regions.RegionTableMixin, tables.DataTable):
     name = tables.Column("name", verbose_name=_("Name"))
     description = tables.Column("description", verbose_name=_("Description"))
+    region = tables.Column("region", verbose_name=_("Region"))
 
     def sanitize_id(self, obj_id):
         return obj_id
@@ -113,7 +115,9 @@ class SecurityGroupsTable(tables.DataTable):
     class Meta(object):
         name = "security_groups"
         verbose_name = _("Security Groups")
-        table_actions = (ImportGroup, DeleteGroup, SecurityGroupsFilterAction)
+        row_class = regions.RegionRow
+        table_actions = (ImportGroup, DeleteGroup, regions.AllRegionsAction,
+                         SecurityGroupsFilterAction)
         row_actions = (DeleteGroup,)
 
 
@@ -30,6 +30,7 @@ from aws_dashboard.content.aws.access_and_security.\
     security_groups.tables import SecurityGroupsTable
 
 from aws_dashboard.api import ec2
+from aws_dashboard.content.aws import regions
 
 
 class SecurityGroupsTab(tabs.TableTab):
@@ -41,7 +42,12 @@ class SecurityGroupsTab(tabs.TableTab):
     def get_security_groups_data(self):
         security_groups = []
         try:
-            security_groups = ec2.list_security_groups(self.request)
+            if regions.is_all_regions(self.request):
+                security_groups = regions.list_in_all_regions(
+                    self.request, ec2.list_security_groups,
+                    _("Unable to retrieve security groups of %(region)s: %(reason)s"))
+            else:
+                security_groups = ec2.list_security_groups(self.request)
         except ImproperlyConfigured:
             exceptions.handle(self.request, _("Not Found AWS API KEY in this project."))
         except Exception:
@@ -0,0 +1,100 @@
+# Copyright 2017 dennis.hong.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Batched AJAX row updates.
+
+Horizon polls every transitional row with its own request, which costs one
+AWS describe call per row. Rows of a table using ``BatchUpdateMixin`` are
+instead polled together by ``horizon.aws.tables.js``: one request carries
+all pending row ids and returns all rendered rows, resolved by a single
+``get_data_batch`` call.
+"""
+from collections import OrderedDict
+import logging
+
+from django import http
+from django.utils.http import urlencode
+
+from horizon import exceptions
+from horizon import tables
+
+LOG = logging.getLogger(__name__)
+MAX_BATCH_ROWS = 500
+
+
+class BatchUpdateRow(tables.Row):
+    ajax = True
+    batch_action_name = "rows_update"
+
+    def get_data_batch(self, request, obj_ids):
+        """Return a dict of the data of the given ids, keyed by id.
+
+        Ids missing in the returned dict are removed from the table.
+        """
+        raise NotImplementedError
+
+    def get_data(self, request, obj_id):
+        datum = self.get_data_batch(request, [obj_id]).get(obj_id)
+        if datum is None:
+            raise http.Http404()
+        return datum
+
+    def get_batch_update_url(self):
+        table_url = self.table.get_full_url()
+        params = urlencode(OrderedDict([
+            ("action", self.batch_action_name),
+            ("table", self.table.name)
+        ]))
+        return "%s?%s" % (table_url, params)
+
+    def load_cells(self, datum=None):
+        super(BatchUpdateRow, self).load_cells(datum)
+        self.attrs["data-object-id"] = self.table.get_object_id(self.datum)
+        if "ajax-update" in self.classes:
+            # Hand the row over from Horizon's per-row poller to the batch one.
+            self.classes.remove("ajax-update")
+            self.classes.append("ajax-batch-update")
+            self.attrs["data-batch-update-url"] = self.get_batch_update_url()
+            self.attrs["data-batch-max-rows"] = MAX_BATCH_ROWS
+
+
+class BatchUpdateMixin(object):
+    """DataTable mixin answering batched row update requests."""
+
+    def maybe_preempt(self):
+        table_name, action_name, obj_id = self.check_handler(self.request)
+        row_class = self._meta.row_class
+        if (table_name == self.name and
+                action_name == getattr(row_class, "batch_action_name", None)):
+            return self.update_rows(row_class)
+        return super(BatchUpdateMixin, self).maybe_preempt()
+
+    def update_rows(self, row_class):
+        obj_ids = self.request.GET.getlist("obj_id")
+        # Rows missing from the response are removed: refuse rather than
+        # drop ids. horizon.aws.tables.js splits larger tables.
+        if len(obj_ids) > MAX_BATCH_ROWS:
+            return http.HttpResponseBadRequest()
+        try:
+            data = row_class(self).get_data_batch(self.request, obj_ids)
+        except Exception:
+            error = exceptions.handle(self.request, ignore=True)
+            return http.HttpResponse(status=error.status_code)
+
+        rows = []
+        for obj_id in obj_ids:
+            datum = data.get(obj_id)
+            if datum is not None:
+                rows.append(row_class(self, datum).render())
+        return http.HttpResponse("".join(rows))
@@ -20,6 +20,7 @@ from django.core import urlresolvers
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse  # noqa
 from django.template.defaultfilters import title  # noqa
+from django.utils import http
 from django.utils.http import urlencode
 from django.utils.translation import npgettext_lazy
 from django.utils.translation import pgettext_lazy
@@ -33,6 +34,9 @@ from horizon.utils import filters
 from openstack_dashboard import api
 
 from aws_dashboard.api import ec2
+from aws_dashboard.content.aws.batch_update import BatchUpdateMixin
+from aws_dashboard.content.aws.batch_update import BatchUpdateRow
+from aws_dashboard.content.aws import regions
 
 
 LOG = logging.getLogger(__name__)
@@ -232,12 +236,11 @@ def get_instance_error(instance):
     return message
 
 
-class UpdateRow(tables.Row):
-    ajax = True
+class UpdateRow(regions.RegionRowMixin, BatchUpdateRow):
 
-    def get_data(self, request, instance_id):
-        instance = ec2.get_instance(request, instance_id)
-        return instance
+    def get_data_batch(self, request, instance_ids):
+        instances = ec2.get_instances(request, instance_ids)
+        return dict((instance.id, instance) for instance in instances)
 
 
 class ExportInstance(tables.LinkAction):
@@ -383,7 +386,7 @@ class InstancesFilterAction(tables.FilterAction):
                       ('flavor', _("Flavor ID ="), True))
 
 
-class Ec2InstanceTable(tables.DataTable):
+class Ec2InstanceTable(regions.RegionTableMixin, BatchUpdateMixin, tables.DataTable):
     STATUS_CHOICES = (
         ("running", True),
         ("stopped", False),
@@ -400,6 +403,7 @@ class Ec2InstanceTable(tables.DataTable):
                        attrs={'data-type': "ip"})
     size = tables.Column("InstanceType", sortable=False, verbose_name=_("Size"))
     keypair = tables.Column("KeyName", verbose_name=_("Key Pair"))
+    region = tables.Column("region", verbose_name=_("Region"))
     az = tables.Column(get_az,
                        verbose_name=_("Availability Zone"))
     status = tables.Column(get_state,
@@ -414,11 +418,23 @@ class Ec2InstanceTable(tables.DataTable):
                                      filters.timesince_sortable),
                             attrs={'data-type': 'timesince'})
 
+    # EC2 pages by an opaque NextToken rather than by the last row id, so
+    # the view hands the tokens of the current and next page to the table.
+    prev_token = None
+    next_token = None
+
+    def get_marker(self):
+        return http.urlquote_plus(self.next_token or "")
+
+    def get_prev_marker(self):
+        return http.urlquote_plus(self.prev_token or "")
+
     class Meta(object):
         name = "EC2"
         verbose_name = _("EC2 Instances")
         status_columns = ["status", ]
         row_class = UpdateRow
         table_actions_menu = (StartInstance, StopInstance, RebootInstance)
-        table_actions = (LaunchLinkNG, ImportInstanceLinkNG, DeleteInstance, InstancesFilterAction)
+        table_actions = (LaunchLinkNG, ImportInstanceLinkNG, DeleteInstance,
+                         regions.AllRegionsAction, InstancesFilterAction)
         row_actions = (ExportInstanceNG, StartInstance, StopInstance, RebootInstance, DeleteInstance)
@@ -23,13 +23,21 @@ from django.conf import settings
 from horizon import tables
 from horizon import exceptions
 from horizon import workflows
+from horizon.utils import functions as utils
 
 import tables as aws_tables
-from aws_dashboard.api.ec2 import list_instance
+from aws_dashboard.api import ec2
+from aws_dashboard.api.ec2 import list_instance_page
 from aws_dashboard.content.aws.ec2 import workflows as aws_workflows
+from aws_dashboard.content.aws import regions
 
 
 LOG = logging.getLogger(__name__)
+# Session key of {page token: previous page token}, used for the "Prev" link
+# since EC2 NextToken paging only moves forward.
+PAGE_TOKENS_SESSION_KEY = "aws_ec2_page_tokens"
+CURRENT_PAGE_SESSION_KEY = "aws_ec2_page_token"
+MAX_PAGE_TOKENS = 10
 
 
 class IndexView(tables.DataTableView):
@@ -37,10 +45,53 @@ class IndexView(tables.DataTableView):
     template_name = 'aws/ec2/index.html'
     page_title = _("EC2 Instances")
 
+    def has_prev_data(self, table):
+        return getattr(self, "_prev", False)
+
+    def has_more_data(self, table):
+        return getattr(self, "_more", False)
+
+    def _get_page_token(self):
+        """Resolve the NextToken of the requested page from the markers."""
+        meta = self.table_class._meta
+        page_tokens = self.request.session.get(PAGE_TOKENS_SESSION_KEY, [])
+        prev_marker = self.request.GET.get(meta.prev_pagination_param)
+        if prev_marker:
+            return dict(page_tokens).get(prev_marker)
+        marker = self.request.GET.get(meta.pagination_param)
+        if marker:
+            current_token = self.request.session.get(CURRENT_PAGE_SESSION_KEY)
+            page_tokens = [t for t in page_tokens if t[0] != marker]
+            page_tokens.append((marker, current_token))
+            self.request.session[PAGE_TOKENS_SESSION_KEY] = page_tokens[-MAX_PAGE_TOKENS:]
+        return marker
+
     def get_data(self):
         instances = []
+        self._prev = self._more = False
+        if regions.is_all_regions(self.request):
+            # Every region is listed at once, without paging.
+            try:
+                instances = regions.list_in_all_regions(
+                    self.request, ec2.list_instance,
+                    _("Unable to retrieve instances of %(region)s: %(reason)s"))
+            except ImproperlyConfigured:
+                exceptions.handle(self.request, _("Not Found AWS API KEY in this project."))
+            except Exception:
+                exceptions.handle(self.request, _("Unable to retrieve instances."))
+            return instances
+
+        page_token = self._get_page_token()
         try:
-            instances = list_instance(self.request)
+            instances, next_token = list_instance_page(
+                self.request, next_token=page_token,
+                page_size=utils.get_page_size(self.request))
+            self.request.session[CURRENT_PAGE_SESSION_KEY] = page_token
+            self._prev = page_token is not None
+            self._more = next_token is not None
+            table = self.get_table()
+            table.prev_token = page_token
+            table.next_token = next_token
         except ImproperlyConfigured:
             exceptions.handle(self.request, _("Not Found AWS API KEY in this project."))
         except Exception:
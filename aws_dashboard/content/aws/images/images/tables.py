@@ -26,6 +26,9 @@ from horizon import tables
 from horizon.utils.memoized import memoized  # noqa
 
 from aws_dashboard.api import ec2
+from aws_dashboard.content.aws.batch_update import BatchUpdateMixin
+from aws_dashboard.content.aws.batch_update import BatchUpdateRow
+from aws_dashboard.content.aws import regions
 
 NOT_LAUNCHABLE_FORMATS = ['aki', 'ari']
 
@@ -128,12 +131,11 @@ def get_image_type(image):
     return getattr(image, "properties", {}).get("image_type", "image")
 
 
-class UpdateRow(tables.Row):
-    ajax = True
+class UpdateRow(regions.RegionRowMixin, BatchUpdateRow):
 
-    def get_data(self, request, image_id):
-        image = ec2.get_image(request, image_id)
-        return image
+    def get_data_batch(self, request, image_ids):
+        images = ec2.get_images(request, image_ids)
+        return dict((image.id, image) for image in images)
 
     def load_cells(self, image=None):
         super(UpdateRow, self).load_cells(image)
@@ -152,7 +154,7 @@ class InstancesFilterAction(tables.FilterAction):
                       ('id', _("Image ID ="), True))
 
 
-class ImagesTable(tables.DataTable):
+class ImagesTable(regions.RegionTableMixin, BatchUpdateMixin, tables.DataTable):
     STATUS_CHOICES = (
         ("available", True),
         ("pending", None),
@@ -184,6 +186,7 @@ class ImagesTable(tables.DataTable):
                                  verbose_name=_("Image Name"),)
     image_id = tables.Column("id",
                              verbose_name=_("Image ID"))
+    region = tables.Column("region", verbose_name=_("Region"))
     image_type = tables.Column(get_image_type,
                                verbose_name=_("Type"),
                                display_choices=TYPE_CHOICES)
@@ -202,6 +205,6 @@ class ImagesTable(tables.DataTable):
         row_class = UpdateRow
         status_columns = ["status"]
         verbose_name = _("Images")
-        table_actions = (InstancesFilterAction, DeleteImage,)
+        table_actions = (regions.AllRegionsAction, InstancesFilterAction, DeleteImage,)
         launch_actions = (LaunchImageNG,)
         row_actions = launch_actions + (DeleteImage, )
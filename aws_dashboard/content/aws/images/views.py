@@ -30,6 +30,7 @@ from horizon import tables
 from aws_dashboard.content.aws.images.images \
     import tables as images_tables
 from aws_dashboard.api import ec2
+from aws_dashboard.content.aws import regions
 
 
 class AngularIndexView(generic.TemplateView):
@@ -50,7 +51,12 @@ class IndexView(tables.DataTableView):
     def get_data(self):
         images = []
         try:
-            images = ec2.list_image(self.request)
+            if regions.is_all_regions(self.request):
+                images = regions.list_in_all_regions(
+                    self.request, ec2.list_image,
+                    _("Unable to retrieve images of %(region)s: %(reason)s"))
+            else:
+                images = ec2.list_image(self.request)
         except ImproperlyConfigured:
             exceptions.handle(self.request, _("Not Found AWS API KEY in this project."))
         except Exception:
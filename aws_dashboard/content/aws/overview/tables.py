@@ -0,0 +1,62 @@
+# Copyright (c) 2017 dennis.hong.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+from django.utils.translation import ugettext_lazy as _
+
+from horizon import tables
+
+
+class AccountsTable(tables.DataTable):
+    project = tables.Column("project_name", verbose_name=_("Project"))
+    region = tables.Column("region", verbose_name=_("Region"))
+    instances = tables.Column("instances", verbose_name=_("Instances"))
+    running = tables.Column("running", verbose_name=_("Running"))
+    running_vcpus = tables.Column("running_vcpus", verbose_name=_("Running vCPUs"))
+    transport_tasks = tables.Column("transport_tasks",
+                                    verbose_name=_("In-flight Transport Tasks"))
+
+    def get_object_id(self, datum):
+        return datum["project_id"]
+
+    class Meta(object):
+        name = "accounts"
+        verbose_name = _("Accounts")
+
+
+class CountTable(tables.DataTable):
+    name = tables.Column("name", verbose_name=_("Name"))
+    count = tables.Column("count", verbose_name=_("Instances"))
+
+    def get_object_id(self, datum):
+        return datum["name"]
+
+
+class StatesTable(CountTable):
+
+    class Meta(object):
+        name = "states"
+        verbose_name = _("Instances by State")
+
+
+class InstanceTypesTable(CountTable):
+
+    class Meta(object):
+        name = "instance_types"
+        verbose_name = _("Instances by Type")
+
+
+class RegionsTable(CountTable):
+
+    class Meta(object):
+        name = "regions"
+        verbose_name = _("Instances by Region")
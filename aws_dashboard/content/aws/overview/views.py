@@ -0,0 +1,95 @@
+# Copyright (c) 2017 dennis.hong.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Views for the cross-account overview.
+"""
+import logging
+
+from django.utils.translation import ugettext_lazy as _
+from horizon import exceptions
+from horizon import messages
+from horizon import tables
+from horizon.utils.memoized import memoized
+
+from openstack_dashboard.api import keystone
+
+from aws_dashboard.api import overview
+from aws_dashboard.content.aws.overview import tables as overview_tables
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _to_rows(counter):
+    return [{"name": name, "count": count}
+            for name, count in sorted(counter.items(), key=lambda c: (-c[1], c[0]))]
+
+
+class IndexView(tables.MultiTableView):
+    table_classes = (overview_tables.AccountsTable,
+                     overview_tables.StatesTable,
+                     overview_tables.InstanceTypesTable,
+                     overview_tables.RegionsTable)
+    template_name = 'aws/overview/index.html'
+    page_title = _("Accounts Overview")
+
+    def _get_project_names(self):
+        try:
+            projects, has_more = keystone.tenant_list(self.request)
+            return dict((p.id, p.name) for p in projects)
+        except Exception:
+            LOG.warning("Unable to retrieve project names.")
+            return {}
+
+    @memoized
+    def get_summaries(self):
+        summaries = []
+        try:
+            summaries, errors = overview.list_account_summaries()
+            for project_id, reason in sorted(errors.items()):
+                messages.warning(self.request,
+                                 _("Unable to retrieve account of project %(project)s: "
+                                   "%(reason)s") % {"project": project_id, "reason": reason})
+        except Exception:
+            exceptions.handle(self.request, _("Unable to retrieve accounts overview."))
+        return summaries
+
+    @memoized
+    def get_totals(self):
+        return overview.aggregate(self.get_summaries())
+
+    def get_accounts_data(self):
+        project_names = self._get_project_names()
+        accounts = []
+        for summary in self.get_summaries():
+            account = dict(summary)
+            account["project_name"] = project_names.get(summary["project_id"],
+                                                        summary["project_id"])
+            account["running"] = summary["states"].get("running", 0)
+            accounts.append(account)
+        return accounts
+
+    def get_states_data(self):
+        return _to_rows(self.get_totals()["states"])
+
+    def get_instance_types_data(self):
+        return _to_rows(self.get_totals()["instance_types"])
+
+    def get_regions_data(self):
+        return _to_rows(self.get_totals()["regions"])
+
+    def get_context_data(self, **kwargs):
+        context = super(IndexView, self).get_context_data(**kwargs)
+        context["totals"] = self.get_totals()
+        return context
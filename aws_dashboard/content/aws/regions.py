@@ -0,0 +1,110 @@
+# Copyright 2017 dennis.hong.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+"All regions" mode of the AWS tables.
+
+With ``?all_regions=1`` a listing is fetched from every region of the
+account at once and shows a Region column. Rows of other regions than the
+project's are read only: actions and status polling of the panels only
+address the project region.
+"""
+from django.utils.translation import ugettext_lazy as _
+
+from horizon import messages
+from horizon import tables
+
+from aws_dashboard.api import ec2
+
+ALL_REGIONS_PARAM = "all_regions"
+
+
+def is_all_regions(request):
+    return request.GET.get(ALL_REGIONS_PARAM) == "1"
+
+
+def is_home_region(request, datum):
+    region_name = getattr(datum, "region", None)
+    return region_name is None or region_name == ec2.get_region_name(request)
+
+
+def list_in_all_regions(request, func, error_message):
+    """Get the merged listing of every region.
+
+    Regions which failed are reported with a warning each, the listing
+    still shows the others.
+
+    :param error_message: message with %(region)s and %(reason)s
+    """
+    items, errors = ec2.all_regions(request, func)
+    for region_name, reason in sorted(errors.items()):
+        messages.warning(request, error_message % {"region": region_name,
+                                                   "reason": reason})
+    return items
+
+
+class AllRegionsAction(tables.LinkAction):
+    name = "all_regions"
+    verbose_name = _("All Regions")
+    icon = "globe"
+
+    def allowed(self, request, datum=None):
+        if is_all_regions(request):
+            self.verbose_name = _("Current Region")
+        return True
+
+    def get_link_url(self, datum=None):
+        params = self.table.request.GET.copy()
+        # Markers of a paged listing do not apply to the other mode.
+        for param in (ALL_REGIONS_PARAM, self.table._meta.pagination_param,
+                      self.table._meta.prev_pagination_param):
+            params.pop(param, None)
+        if not is_all_regions(self.table.request):
+            params[ALL_REGIONS_PARAM] = "1"
+        query = params.urlencode()
+        return "%s?%s" % (self.table.request.path, query) if query else self.table.request.path
+
+
+class RegionRowMixin(object):
+    """Row mixin making rows of other regions read only."""
+
+    def can_be_selected(self, datum):
+        return (is_home_region(self.table.request, datum) and
+                super(RegionRowMixin, self).can_be_selected(datum))
+
+    def load_cells(self, datum=None):
+        if datum is not None and not is_home_region(self.table.request, datum):
+            self.ajax = False
+        super(RegionRowMixin, self).load_cells(datum)
+
+
+class RegionRow(RegionRowMixin, tables.Row):
+    pass
+
+
+class RegionTableMixin(object):
+    """DataTable mixin for the "all regions" mode.
+
+    The table declares a ``region`` column, shown in "all regions" mode
+    only, and a row class based on RegionRowMixin.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        super(RegionTableMixin, self).__init__(request, *args, **kwargs)
+        if not is_all_regions(request):
+            del self.columns["region"]
+
+    def get_row_actions(self, datum):
+        if not is_home_region(self.request, datum):
+            return []
+        return super(RegionTableMixin, self).get_row_actions(datum)
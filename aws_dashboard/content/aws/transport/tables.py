@@ -14,12 +14,16 @@
 import logging
 
 from horizon import tables
+from django import template
 from django.template.defaultfilters import title  # noqa
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import pgettext_lazy
 from django.utils.translation import ungettext_lazy
 
 from aws_dashboard.api import transport
+from aws_dashboard.api.hybrid import jobs
+from aws_dashboard.content.aws.batch_update import BatchUpdateMixin
+from aws_dashboard.content.aws.batch_update import BatchUpdateRow
 
 LOG = logging.getLogger(__name__)
 TASK_DISPLAY_NONE = pgettext_lazy("Task status of an Instance", u"None")
@@ -31,17 +35,17 @@ STATUS_CHOICES = (
 )
 
 
-class UpdateRow(tables.Row):
-    ajax = True
+class UpdateRow(BatchUpdateRow):
 
-    def get_data(self, request, task_id):
-        if task_id.startswith("import"):
-            task = transport.get_import_image_task(request, task_id)
-        elif task_id.startswith("export"):
-            task = transport.get_export_task(request, task_id)
-        else:
-            task = None
-        return task
+    def get_data_batch(self, request, task_ids):
+        import_task_ids = [i for i in task_ids if i.startswith("import")]
+        export_task_ids = [i for i in task_ids if i.startswith("export")]
+        tasks = []
+        if import_task_ids:
+            tasks.extend(transport.get_import_image_tasks(request, import_task_ids))
+        if export_task_ids:
+            tasks.extend(transport.get_export_tasks(request, export_task_ids))
+        return dict((task.id, task) for task in tasks)
 
 
 class CancelTask(tables.DeleteAction):
@@ -82,7 +86,7 @@ class InstancesFilterAction(tables.FilterAction):
                       ('state', _("State ="), True))
 
 
-class TransportTaskTable(tables.DataTable):
+class TransportTaskTable(BatchUpdateMixin, tables.DataTable):
     type = tables.WrappingColumn("type",
                                  verbose_name=_("Task Type"))
     id = tables.WrappingColumn("id",
@@ -108,3 +112,91 @@ class TransportTaskTable(tables.DataTable):
         row_class = UpdateRow
         table_actions = (InstancesFilterAction, CancelTask)
         row_actions = (CancelTask,)
+
+
+JOB_STATUS_CHOICES = (
+    ("queued", None),
+    ("running", None),
+    ("completed", True),
+    ("failed", False),
+)
+
+
+def get_job_stages(job):
+    template_name = 'aws/transport/_job_stages.html'
+    context = {"stages": job.stages}
+    return template.loader.render_to_string(template_name, context)
+
+
+def get_current_stage(job):
+    stage = job.current_stage
+    return stage["name"] if stage else None
+
+
+class JobUpdateRow(BatchUpdateRow):
+
+    def get_data_batch(self, request, job_ids):
+        job_list = [jobs.get_job(request, job_id) for job_id in job_ids]
+        return dict((job.id, job) for job in job_list if job is not None)
+
+
+class ResumeJob(tables.BatchAction):
+    name = "resume"
+    classes = ('btn-confirm',)
+    help_text = _("A resumed job starts again at its first incomplete stage.")
+
+    @staticmethod
+    def action_present(count):
+        return ungettext_lazy(
+            u"Resume Job",
+            u"Resume Jobs",
+            count
+        )
+
+    @staticmethod
+    def action_past(count):
+        return ungettext_lazy(
+            u"Resumed Job",
+            u"Resumed Jobs",
+            count
+        )
+
+    def allowed(self, request, job=None):
+        if not jobs.enabled():
+            return False
+        if job:
+            return job.status == jobs.FAILED
+        return True
+
+    def action(self, request, obj_id):
+        if not jobs.resume_job(request, obj_id):
+            raise Exception("Job %s is not failed" % obj_id)
+
+
+class JobsTable(BatchUpdateMixin, tables.DataTable):
+    name = tables.WrappingColumn("name",
+                                 verbose_name=_("Name"))
+    job_type = tables.Column("job_type",
+                             verbose_name=_("Job Type"),
+                             filters=(title,))
+    id = tables.Column("id",
+                       verbose_name=_("Job ID"))
+    current_stage = tables.Column(get_current_stage,
+                                  verbose_name=_("Current Stage"))
+    stages = tables.Column(get_job_stages,
+                           verbose_name=_("Stages"))
+    status = tables.Column("status",
+                           verbose_name=_("Status"),
+                           filters=(title,),
+                           status=True,
+                           status_choices=JOB_STATUS_CHOICES)
+    error = tables.Column("error",
+                          verbose_name=_("Error"))
+
+    class Meta(object):
+        name = "jobs"
+        verbose_name = _("Import/Export Jobs")
+        status_columns = ["status", ]
+        row_class = JobUpdateRow
+        table_actions = (ResumeJob,)
+        row_actions = (ResumeJob,)
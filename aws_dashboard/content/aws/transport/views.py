@@ -21,20 +21,30 @@ from django.core.exceptions import ImproperlyConfigured
 from horizon import tables
 from horizon import exceptions
 
+from aws_dashboard.api.hybrid import jobs
 from aws_dashboard.api.transport import list_export_task
 from aws_dashboard.api.transport import list_import_image_task
+from aws_dashboard.content.aws.transport.tables import JobsTable
 from aws_dashboard.content.aws.transport.tables import TransportTaskTable
 
 
 LOG = logging.getLogger(__name__)
 
 
-class IndexView(tables.DataTableView):
-    table_class = TransportTaskTable
+class IndexView(tables.MultiTableView):
+    table_classes = (JobsTable, TransportTaskTable)
     template_name = 'aws/transport/index.html'
     page_title = _("Transport Task")
 
-    def get_data(self):
+    def get_jobs_data(self):
+        job_list = []
+        try:
+            job_list = jobs.list_jobs(self.request)
+        except Exception:
+            exceptions.handle(self.request, _("Unable to retrieve jobs."))
+        return job_list
+
+    def get_EC2_data(self):
         transport_tasks = []
         try:
             export_tasks = list_export_task(self.request)
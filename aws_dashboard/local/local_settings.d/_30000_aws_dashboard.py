@@ -49,6 +49,187 @@ AWS_API_KEY_DICT = {
 # In the comment state, the default value is applied.
 #
 # OPENSTACK_IMAGE_FORMAT = "qcow2"
-# CONVERT_IMAGE_FORMAT = "raw"
+# CONVERT_IMAGE_FORMAT = "auto"
 # IMAGE_TASK_WORKING_PATH = "/tmp"
 # STATUS_CHECK_INTERVAL = 10
+#
+# AWS client pool. Clients are shared by all requests of a Horizon process,
+# keyed by project, region, service and API key.
+# AWS_CLIENT_POOL_SIZE = 64
+# AWS_MAX_POOL_CONNECTIONS = 10
+# AWS_CLIENT_KEEPALIVE = 300
+#
+# Inventory cache of describe_* results, shared by all Horizon workers
+# through the Django cache backend. TTLs are in seconds, 0 disables caching.
+# AWS_CACHE_BACKEND = "default"
+# AWS_CACHE_TTL = {
+#     "instances": 10,
+#     "images": 300,
+#     "security_groups": 60,
+#     "keypairs": 60,
+#     "regions": 3600,
+#     "availability_zones": 3600,
+# }
+# AWS_CACHE_LOCAL_MAX_BYTES = 32 * 1024 * 1024
+# AWS_CACHE_LOCK_TIMEOUT = 10
+#
+# Public AMI catalog. These describe_images filters are refreshed in the
+# background every AMI_CATALOG_REFRESH_INTERVAL seconds; the project's own
+# images are always fetched live.
+# AMI_CATALOG_FILTERS = [
+#     {
+#         "Name": "name",
+#         "Values": [
+#             "RHEL-7*",
+#             "suse-sles-12-*",
+#             "ubuntu/images/hvm-ssd/ubuntu-xenial-16.04-amd64-server-*",
+#             "amzn-ami-hvm-*",
+#             "Windows_Server-2016*",
+#         ]
+#     },
+# ]
+# AMI_CATALOG_REFRESH_INTERVAL = 6 * 60 * 60
+#
+# Per-region flavor catalogs written by
+#   manage.py build_flavor_catalog --offer-file index.json
+# Regions without a catalog here use the bundled instanceType.json.
+# FLAVOR_CATALOG_DIR = "/var/lib/openstack-dashboard/aws_flavor_catalog"
+#
+# "All regions" listings call every region on a shared thread pool; a region
+# slower than AWS_REGION_FANOUT_TIMEOUT seconds is reported as unavailable.
+# AWS_REGION_FANOUT_WORKERS = 16
+# AWS_REGION_FANOUT_TIMEOUT = 20
+#
+# Admin "Accounts Overview" panel. Every project of AWS_API_KEY_DICT is
+# summarized on its own pool; an account slower than
+# AWS_OVERVIEW_ACCOUNT_TIMEOUT seconds is reported as unavailable. Summaries
+# are cached for AWS_CACHE_TTL["overview"] seconds (60 by default).
+# AWS_OVERVIEW_WORKERS = 8
+# AWS_OVERVIEW_ACCOUNT_TIMEOUT = 15
+# AWS_OVERVIEW_TIMEOUT = 60
+#
+# Import/export jobs are queued in this SQLite database and run by
+#   manage.py aws_job_worker
+# processes outside the web server, running as the same user: the file is
+# created readable by that user only, in a directory it owns and others
+# cannot write to.
+# AWS_JOB_DB_PATH = "/tmp/aws_dashboard_jobs/jobs.sqlite3"
+#
+# Workers do not reuse the token of the submitting user. Each job gets a
+# Keystone trust from that user to this service user, valid for
+# AWS_JOB_TRUST_LIFETIME days, and workers authenticate through it. Without
+# it, jobs are disabled and imports/exports run inside the web request.
+# AWS_JOB_SERVICE_AUTH = {
+#     "auth_url": "http://controller:5000/v3",
+#     "username": "aws-dashboard",
+#     "password": "secret",
+#     "user_domain_name": "Default",
+# }
+# AWS_JOB_TRUST_LIFETIME = 7
+#
+# A failed job is queued again after AWS_JOB_RETRY_DELAY seconds per attempt
+# and resumes at its first incomplete stage, up to AWS_JOB_MAX_ATTEMPTS
+# attempts. Running jobs report a heartbeat every AWS_JOB_HEARTBEAT_INTERVAL
+# seconds; a job without one for AWS_JOB_STALE_TIMEOUT seconds is taken over
+# by another worker.
+# AWS_JOB_MAX_ATTEMPTS = 3
+# AWS_JOB_RETRY_DELAY = 60
+# AWS_JOB_HEARTBEAT_INTERVAL = 60
+# AWS_JOB_STALE_TIMEOUT = 600
+#
+# Jobs of a worker process wait on snapshots, AWS import/export tasks,
+# Glance images and Nova servers through one shared poller, which checks
+# them in batches. A wait is checked after STATUS_CHECK_INTERVAL seconds,
+# then AWS_POLLER_BACKOFF times later on each check, up to
+# AWS_POLLER_MAX_INTERVAL seconds. A wait fails once its resource is not
+# found AWS_POLLER_MAX_MISSES checks in a row.
+# AWS_POLLER_BACKOFF = 2
+# AWS_POLLER_MAX_INTERVAL = 120
+# AWS_POLLER_MAX_MISSES = 3
+#
+# Glance images already in the CONVERT_IMAGE_FORMAT set by the deployment
+# are streamed to S3 with a multipart upload instead of being staged in
+# IMAGE_TASK_WORKING_PATH. At most AWS_MULTIPART_CONCURRENCY parts of
+# AWS_MULTIPART_PART_SIZE bytes are in flight, plus one being filled.
+# AWS_MULTIPART_PART_SIZE = 16 * 1024 * 1024
+# AWS_MULTIPART_CONCURRENCY = 4
+#
+# For raw imports, the converted image is uploaded to S3 while qemu-img
+# writes it. Conversion is paused while it is more than
+# AWS_PIPELINE_MAX_LEAD bytes ahead of the upload. This needs a file system
+# reporting holes (SEEK_DATA) under IMAGE_TASK_WORKING_PATH; elsewhere the
+# image is converted then uploaded.
+# AWS_PIPELINE_CONVERT_UPLOAD = True
+# AWS_PIPELINE_MAX_LEAD = 2 * 1024 * 1024 * 1024
+#
+# Glance downloads are written through a buffer of this many bytes into a
+# preallocated file and checked against the image size and checksum.
+# AWS_DOWNLOAD_BUFFER_SIZE = 8 * 1024 * 1024
+#
+# qemu-img convert options, see aws_dashboard/api/hybrid/convert.py. For
+# example, faster qcow2 exports on a qemu 5.1+ host with cores to spare:
+# AWS_QEMU_IMG_OPTIONS = {
+#     "coroutines": 16,
+#     "out_of_order": True,
+#     "sparse_size": "4k",
+#     "compression": "zstd",
+#     "timeout": 4 * 60 * 60,
+# }
+#
+# CONVERT_IMAGE_FORMAT is the EC2 import format: "raw", "vmdk" (stream
+# optimized) or "auto", which uploads a VMDK when at most
+# AWS_IMPORT_VMDK_MAX_ALLOCATED of the disk holds data, raw otherwise.
+# AWS_IMPORT_VMDK_MAX_ALLOCATED = 0.7
+#
+# Disk formats Glance and Nova of this cloud run, by order of preference.
+# Exports ask EC2 for the first one it can produce (vmdk, raw or vhd) and
+# upload it to Glance as it is; otherwise the VMDK export is converted to
+# OPENSTACK_IMAGE_FORMAT.
+# OPENSTACK_ACCEPTED_IMAGE_FORMATS = ["qcow2"]
+#
+# S3 transfers of files use parts large enough to stay under 8000 parts.
+# The aggregate throughput of the last AWS_TRANSFER_HISTORY_SIZE transfers
+# is recorded in AWS_TRANSFER_HISTORY_PATH by number of threads, and the
+# threads are doubled, between the min and max, while that still improves
+# it and AWS_TRANSFER_TARGET_RATE bytes/s is not reached.
+# AWS_TRANSFER_HISTORY_PATH = "/tmp/aws_dashboard_transfers.json"
+# AWS_TRANSFER_HISTORY_SIZE = 20
+# AWS_TRANSFER_TARGET_RATE = 1024 * 1024 * 1024
+# AWS_TRANSFER_MIN_CONCURRENCY = 4
+# AWS_TRANSFER_MAX_CONCURRENCY = 32
+#
+# Large S3 uploads keep their state next to the file and resume where they
+# stopped when the job is retried. The aws_sweep_uploads command aborts the
+# uploads left unfinished for longer than this many seconds.
+# AWS_MULTIPART_ORPHAN_AGE = 2 * 24 * 60 * 60
+#
+# Bytes of S3 part data all the transfers of a worker process may hold at
+# once. Parts wait for budget before they are read, so memory use does not
+# grow with the image size or the number of jobs.
+# AWS_TRANSFER_MEMORY_BUDGET = 1024 * 1024 * 1024
+#
+# Uploads are checked against the MD5 ETag S3 computes. Set this to also
+# keep a SHA-256 tree hash of each uploaded image in its job.
+# AWS_UPLOAD_SHA256 = False
+#
+# "s3" imports through an S3 upload and EC2 import_image. "ebs" writes the
+# raw image straight into an EBS snapshot with the EBS direct APIs, only
+# sending its non-zero 512 KiB blocks, and registers an HVM AMI of it. The
+# AWS keys then need the ebs:StartSnapshot, ebs:PutSnapshotBlock,
+# ebs:CompleteSnapshot and ec2:RegisterImage permissions.
+# Unlike import_image, nothing adapts the guest to EC2: it must already
+# boot on Nitro instances (NVMe and ENA drivers). The AMI takes the
+# architecture and boot mode of the image from its Glance "architecture"
+# and "hw_firmware_type" properties, and ENA support only when the image
+# sets ena_support=true.
+# AWS_IMPORT_ENGINE = "s3"
+# AWS_EBS_CONCURRENCY = 32
+# AWS_EBS_SNAPSHOT_TIMEOUT = 60
+#
+# "s3" exports through an EC2 export task to S3. "ebs" snapshots the root
+# volume of the instance and reads its allocated blocks with the EBS
+# direct APIs into a sparse raw image, converted for Glance unless raw is
+# in OPENSTACK_ACCEPTED_IMAGE_FORMATS. The AWS keys then need the
+# ec2:CreateSnapshot, ec2:DeleteSnapshot, ebs:ListSnapshotBlocks and
+# ebs:GetSnapshotBlock permissions.
+# AWS_EXPORT_ENGINE = "s3"
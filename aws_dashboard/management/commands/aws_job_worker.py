@@ -0,0 +1,55 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from concurrent import futures
+import time
+
+from django.core.management.base import BaseCommand
+
+from aws_dashboard.api.hybrid import jobs
+
+
+class Command(BaseCommand):
+    help = ("Run queued AWS import/export jobs. Jobs of a process share one "
+            "status poller, which batches their AWS and OpenStack status calls.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--poll-interval", type=float, default=5,
+                            help="Seconds between checks for queued jobs")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit when no job is queued")
+        parser.add_argument("--concurrency", type=int, default=8,
+                            help="Number of jobs to run at once")
+
+    def handle(self, *args, **options):
+        worker = jobs.worker_name()
+        self.stdout.write("AWS job worker %s started" % worker)
+        executor = futures.ThreadPoolExecutor(options["concurrency"])
+        running = set()
+        while True:
+            claimed = None
+            if len(running) < options["concurrency"]:
+                claimed = jobs.STORE.claim(worker)
+            if claimed is not None:
+                job, payload = claimed
+                self.stdout.write("Running job %s (%s)" % (job.id, job.job_type))
+                running.add(executor.submit(jobs.run, job, payload))
+                continue
+            if not running and options["once"]:
+                executor.shutdown()
+                return
+            if running:
+                running = futures.wait(running, timeout=options["poll_interval"],
+                                       return_when=futures.FIRST_COMPLETED).not_done
+            else:
+                time.sleep(options["poll_interval"])
@@ -0,0 +1,43 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from aws_dashboard.api import multipart
+from aws_dashboard.api import s3
+
+
+class Command(BaseCommand):
+    help = ("Abort the S3 multipart uploads of the project buckets left "
+            "unfinished for longer than AWS_MULTIPART_ORPHAN_AGE, which "
+            "AWS bills until they are aborted. Run it from cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-age", type=int, default=multipart.AWS_MULTIPART_ORPHAN_AGE,
+                            help="Age in seconds of the uploads to abort")
+        parser.add_argument("--project", action="append", default=[],
+                            help="Project to sweep, may be given more than once "
+                                 "(default: every project of AWS_API_KEY_DICT)")
+
+    def handle(self, *args, **options):
+        projects = options["project"] or sorted(getattr(settings, "AWS_API_KEY_DICT", {}))
+        for project_id in projects:
+            try:
+                aborted = s3.abort_orphaned_uploads(project_id, options["max_age"])
+            except ClientError as e:
+                self.stderr.write("Sweep of %s failed : %s" % (project_id, e))
+                continue
+            for key, upload_id in aborted:
+                self.stdout.write("Aborted %s/%s (%s)" % (project_id, key, upload_id))
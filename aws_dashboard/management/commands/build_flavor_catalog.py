@@ -0,0 +1,58 @@
+# Copyright 2017 Dennis Hong.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from aws_dashboard.api import catalog_builder
+from aws_dashboard.api import flavor_catalog
+
+
+class Command(BaseCommand):
+    help = ("Build per-region flavor catalogs from a downloaded EC2 price list "
+            "offer file and/or saved describe-instance-types output.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--offer-file", action="append", default=[],
+                            help="EC2 price list offer file (index.json), "
+                                 "may be given more than once")
+        parser.add_argument("--instance-types-file", action="append", default=[],
+                            help="Saved 'aws ec2 describe-instance-types' output, "
+                                 "one or more pages, may be given more than once")
+        parser.add_argument("--region",
+                            help="Region of the describe-instance-types output "
+                                 "and of offer products without a known location")
+        parser.add_argument("--output-dir", default=flavor_catalog.FLAVOR_CATALOG_DIR,
+                            help="Directory of the <region>.json catalogs")
+
+    def handle(self, *args, **options):
+        if not options["offer_file"] and not options["instance_types_file"]:
+            raise CommandError("Give at least one --offer-file or --instance-types-file.")
+        if options["instance_types_file"] and not options["region"]:
+            raise CommandError("--instance-types-file needs --region.")
+
+        builder = catalog_builder.CatalogBuilder()
+        for file_path in options["offer_file"]:
+            with open(file_path, "r") as f:
+                builder.read_offer_file(f, options["region"])
+        for file_path in options["instance_types_file"]:
+            with open(file_path, "r") as f:
+                builder.read_instance_types(f, options["region"])
+
+        output_dir = options["output_dir"]
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        for file_path in builder.write(output_dir):
+            self.stdout.write("Wrote %s" % file_path)
@@ -42,6 +42,7 @@
       createServer: createServer,
       importServer: importServer,
       exportServer: exportServer,
+      getJob: getJob,
       getServers: getServers,
       getImages: getImages,
       getFlavors: getFlavors,
@@ -155,6 +156,13 @@
         });
     }
 
+    function getJob(jobId) {
+      return apiService.get('/api/aws/jobs/' + jobId + '/')
+        .error(function () {
+          toastService.add('error', gettext('Unable to retrieve the job.'));
+        });
+    }
+
     function getRegions() {
       return apiService.get('/api/aws/ec2/regions/')
         .error(function () {
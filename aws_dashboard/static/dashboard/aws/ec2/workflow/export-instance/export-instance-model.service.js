@@ -281,9 +281,13 @@
       return ec2API.exportServer(finalSpec).then(successMessage);
     }
 
-    function successMessage() {
+    function successMessage(response) {
       var numberInstances = model.newInstanceSpec.instance_count;
-      var message = ngettext('%s instance exported.', '%s instances exported.', numberInstances);
+      // A job is returned when the export runs in the background.
+      var message = response.data.stages
+        ? ngettext('Export of %s instance queued. See Transport Task for progress.',
+          'Export of %s instances queued. See Transport Task for progress.', numberInstances)
+        : ngettext('%s instance exported.', '%s instances exported.', numberInstances);
       toast.add('success', interpolate(message, [numberInstances]));
     }
 
@@ -220,9 +220,13 @@
       return ec2API.importServer(finalSpec).then(successMessage);
     }
 
-    function successMessage() {
+    function successMessage(response) {
       var numberInstances = 1;
-      var message = ngettext('%s instance imported.', '%s instances imported.', numberInstances);
+      // A job is returned when the import runs in the background.
+      var message = response.data.stages
+        ? ngettext('Import of %s instance queued. See Transport Task for progress.',
+          'Import of %s instances queued. See Transport Task for progress.', numberInstances)
+        : ngettext('%s instance imported.', '%s instances imported.', numberInstances);
       toast.add('success', interpolate(message, [numberInstances]));
     }
 
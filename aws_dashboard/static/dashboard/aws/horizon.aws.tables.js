@@ -0,0 +1,131 @@
+/*
+ * © Copyright 2017 dennis hong.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/*
+ * Batched status polling for AWS tables.
+ *
+ * Rows rendered by aws_dashboard.content.aws.batch_update.BatchUpdateRow are
+ * polled together: one request per table carries the ids of up to
+ * data-batch-max-rows pending rows and returns every refreshed row, instead
+ * of one request per row.
+ */
+horizon.aws = horizon.aws || {};
+
+horizon.aws.tables = {
+  selector: 'tr.warning.ajax-batch-update',
+  timer: null,
+
+  schedule: function (interval) {
+    if (horizon.aws.tables.timer === null) {
+      horizon.aws.tables.timer = setTimeout(function () {
+        horizon.aws.tables.timer = null;
+        horizon.aws.tables.update();
+      }, interval);
+    }
+  },
+
+  replace_rows: function ($table, $rows, data) {
+    var $new_rows = $($.parseHTML('<table><tbody>' + data + '</tbody></table>'))
+      .find('tbody').children('tr');
+    var found = {};
+
+    $new_rows.each(function () {
+      var $new_row = $(this);
+      var obj_id = $new_row.attr('data-object-id');
+      var $row = $rows.filter(function () {
+        return $(this).attr('data-object-id') === obj_id;
+      });
+      found[obj_id] = true;
+      if ($row.find('.table-row-multi-select:checkbox').is(':checked')) {
+        $new_row.find('.table-row-multi-select:checkbox').prop('checked', true);
+      }
+      $row.replaceWith($new_row);
+    });
+
+    // Rows missing from the response are gone, as a 404 is for a single row.
+    $rows.each(function () {
+      if (!found[$(this).attr('data-object-id')]) {
+        horizon.datatables.update_footer_count($table, -1);
+        $(this).remove();
+      }
+    });
+    $table.trigger('update');
+    horizon.datatables.update_actions();
+  },
+
+  update: function () {
+    var $rows_to_update = $(horizon.aws.tables.selector);
+    if ($rows_to_update.length === 0) {
+      return;
+    }
+    var interval = $rows_to_update.attr('data-update-interval');
+    var groups = {};
+    $rows_to_update.each(function () {
+      var url = $(this).attr('data-batch-update-url');
+      groups[url] = (groups[url] || $()).add(this);
+    });
+    // The server looks up that many rows per request at most.
+    var batches = [];
+    $.each(groups, function (url, $rows) {
+      var max_rows = parseInt($rows.attr('data-batch-max-rows'), 10) || $rows.length;
+      for (var i = 0; i < $rows.length; i += max_rows) {
+        batches.push({url: url, $rows: $rows.slice(i, i + max_rows)});
+      }
+    });
+    var pending = batches.length;
+
+    $.each(batches, function (index, batch) {
+      var url = batch.url;
+      var $rows = batch.$rows;
+      var $table = $rows.closest('table.datatable');
+      var submit_in_progress = $table.closest('form').attr('data-submitted');
+      if ($rows.find('.actions_column .btn-group.open').length || submit_in_progress) {
+        pending--;
+        if (pending === 0) {
+          horizon.aws.tables.schedule(interval);
+        }
+        return;
+      }
+      horizon.ajax.queue({
+        url: url,
+        data: {obj_id: $rows.map(function () {
+          return $(this).attr('data-object-id');
+        }).get()},
+        traditional: true,
+        success: function (data) {
+          horizon.aws.tables.replace_rows($table, $rows, data);
+        },
+        error: function () {
+          console.log(gettext("An error occurred while updating."));
+        },
+        complete: function () {
+          horizon.datatables.validate_button();
+          pending--;
+          if (pending === 0) {
+            horizon.aws.tables.schedule(interval);
+          }
+        }
+      });
+    });
+  }
+};
+
+horizon.addInitFunction(horizon.aws.tables.init = function () {
+  var $rows = $(horizon.aws.tables.selector);
+  if ($rows.length) {
+    horizon.aws.tables.schedule($rows.attr('data-update-interval'));
+  }
+});